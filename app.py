@@ -1,17 +1,44 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, abort, session, jsonify
+from flask import Flask, Request, Response, g, render_template, request, redirect, url_for, flash, abort, session, jsonify
 from flask_cors import CORS
+import io
 import os
-from models import db, User
-from image_routes import image_bp
+import time
+from auth_cache import AUTH_CACHE_TTL, user_cache
+from passwords import PasswordHasherBusy, stats as password_stats
+from models import db, User, database_uri, engine_options, ensure_columns, ensure_indexes, ensure_prediction_counts
+from image_routes import image_bp, model_loader
+from metrics import REGISTRY
+
+PROCESS_START = time.monotonic()
+MAX_CONTENT_LENGTH = 16 * 1024 * 1024
+
+
+class InMemoryUploadRequest(Request):
+    # Werkzeug spools uploads over 500 KB to a temporary file. Requests within
+    # MAX_CONTENT_LENGTH stay in memory so the prediction path decodes straight
+    # from the request bytes; larger batch uploads still spool to disk.
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if total_content_length is not None and total_content_length <= MAX_CONTENT_LENGTH:
+            return io.BytesIO()
+        return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+
+    def close(self):
+        # Streaming views that keep reading uploads after returning (see
+        # /api/upload/batch) set keep_files_open and close the files themselves.
+        if not getattr(self, 'keep_files_open', False):
+            super().close()
+
 
 app = Flask(__name__)
+app.request_class = InMemoryUploadRequest
 app.secret_key = os.environ.get("SECRET_KEY", "fallback-secret")
 
 app.config['SESSION_COOKIE_SAMESITE'] = 'None'
 app.config['SESSION_COOKIE_SECURE'] = True
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///users.db'
+app.config['SQLALCHEMY_DATABASE_URI'] = database_uri()
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config['SQLALCHEMY_DATABASE_URI'])
 app.config['UPLOAD_FOLDER'] = os.path.join('static', 'uploads')
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
+app.config['MAX_CONTENT_LENGTH'] = MAX_CONTENT_LENGTH
 
 # Enable CORS for API endpoints
 CORS(app, supports_credentials=True)
@@ -20,6 +47,69 @@ CORS(app, supports_credentials=True)
 db.init_app(app)
 app.register_blueprint(image_bp)
 
+# Load the model in the background; pages are served while it warms up.
+model_loader.start()
+ROUTES_READY_SECONDS = time.monotonic() - PROCESS_START
+print(f"Routes registered {ROUTES_READY_SECONDS:.2f}s after startup")
+first_request_seconds = None
+
+REQUEST_SECONDS = REGISTRY.histogram(
+    'agrovision_request_seconds', 'HTTP request latency by endpoint and status.', ['endpoint', 'method', 'status'])
+
+@app.before_request
+def record_first_request():
+    global first_request_seconds
+    g.request_start = time.perf_counter()
+    # Also re-arms the loader in workers forked after import.
+    model_loader.start()
+    if first_request_seconds is None:
+        first_request_seconds = time.monotonic() - PROCESS_START
+        print(f"First request served {first_request_seconds:.2f}s after startup")
+
+@app.after_request
+def record_request_latency(response):
+    start = g.get('request_start')
+    if start is not None:
+        REQUEST_SECONDS.observe(
+            time.perf_counter() - start,
+            endpoint=request.endpoint or 'unmatched',
+            method=request.method,
+            status=response.status_code,
+        )
+    return response
+
+@REGISTRY.collector
+def _auth_gauges():
+    stats = user_cache.stats()
+    yield 'agrovision_auth_cache_hits_total', 'counter', 'Auth checks answered from the user cache.', stats['hits']
+    yield 'agrovision_auth_cache_misses_total', 'counter', 'Auth checks that missed the user cache.', stats['misses']
+    yield 'agrovision_auth_cache_entries', 'gauge', 'User records held in the auth cache.', stats['entries']
+    yield 'agrovision_password_hash_pending', 'gauge', 'Password hashes running or queued.', password_stats()['pending']
+
+@app.route('/metrics')
+def metrics():
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+# Liveness: the process is up and serving requests.
+@app.route('/healthz')
+def healthz():
+    return jsonify({'status': 'ok'}), 200
+
+# Readiness: the model has finished loading and predictions can be served.
+@app.route('/readyz')
+def readyz():
+    model_state = model_loader.snapshot()
+    body = {
+        'ready': model_state['status'] == 'ready',
+        'model': model_state,
+        'startup': {
+            'routes_ready_seconds': round(ROUTES_READY_SECONDS, 3),
+            'first_request_seconds': round(first_request_seconds, 3) if first_request_seconds is not None else None,
+            'model_ready_seconds': model_state['load_seconds'],
+        },
+    }
+    return jsonify(body), 200 if body['ready'] else 503
+
 # Expose request and session in all templates
 @app.context_processor
 def inject_request():
@@ -71,9 +161,83 @@ MESSAGES = {
     'logged_out': {
         'en': "Logged out.",
         'az': "Sistemdən çıxıldı."
+    },
+    'server_busy': {
+        'en': "The server is busy. Please try again in a moment.",
+        'az': "Server hazırda məşğuldur. Zəhmət olmasa bir az sonra yenidən cəhd edin."
     }
 }
 
+# Session claims: the signed cookie carries the email and a password stamp
+# next to the user id. Auth checks trust a claim verified within
+# AUTH_CACHE_TTL and only go to the database when it is older.
+def start_session(user):
+    record = user_cache.put(user)
+    session['user_id'] = user.id
+    session['email'] = record['email']
+    session['auth_stamp'] = record['stamp']
+    session['auth_at'] = int(time.time())
+
+def end_session():
+    user_id = session.pop('user_id', None)
+    for key in ('email', 'auth_stamp', 'auth_at'):
+        session.pop(key, None)
+    if user_id is not None:
+        user_cache.invalidate(user_id)
+
+def authenticated_email():
+    user_id = session.get('user_id')
+    if not user_id:
+        return None
+
+    record = user_cache.get(user_id)
+    if record is None and session.get('auth_stamp') and time.time() - session.get('auth_at', 0) < AUTH_CACHE_TTL:
+        return session.get('email')
+
+    if record is None:
+        user = db.session.get(User, user_id)
+        if user is None:
+            end_session()
+            return None
+        record = user_cache.put(user)
+
+    if 'auth_stamp' not in session:
+        # Sessions issued before the claims existed pick them up here,
+        # whether or not the record was already cached.
+        session['auth_stamp'] = record['stamp']
+    if session.get('auth_stamp') != record['stamp']:
+        end_session()
+        return None
+    # Only rewrite the cookie when a claim actually changes or goes stale.
+    if session.get('email') != record['email']:
+        session['email'] = record['email']
+    if time.time() - session.get('auth_at', 0) >= AUTH_CACHE_TTL:
+        session['auth_at'] = int(time.time())
+    return record['email']
+
+# Stored hashes made with older PASSWORD_HASH_METHOD parameters are upgraded
+# on the next successful login, while the plaintext is at hand.
+def upgrade_password_hash(user, password):
+    if not user.password_needs_rehash():
+        return
+    try:
+        user.rehash_password(password)
+    except PasswordHasherBusy:
+        return
+    db.session.commit()
+
+# Hashing runs in a bounded pool (see passwords.py); when it is saturated,
+# turn the login away instead of queueing it behind inference.
+@app.errorhandler(PasswordHasherBusy)
+def password_hasher_busy(exc):
+    lang = (request.view_args or {}).get('lang') or (request.get_json(silent=True) or {}).get('lang') or 'en'
+    retry_after = {'Retry-After': '1'}
+    if request.path.startswith('/api/'):
+        message = MESSAGES['server_busy'].get(lang, MESSAGES['server_busy']['en'])
+        return jsonify({'success': False, 'message': message}), 503, retry_after
+    flash_message('server_busy', lang)
+    return redirect(request.url), 303, retry_after
+
 # Flash message helper
 def flash_message(key, lang):
     category = 'success' if key in ['signup_success', 'login_success', 'logged_out'] else 'danger'
@@ -131,7 +295,8 @@ def login(lang):
             flash_message('wrong_password', lang)
             return redirect(request.url)
 
-        session['user_id'] = user.id
+        upgrade_password_hash(user, password)
+        start_session(user)
         flash_message('login_success', lang)
         return redirect(url_for('image.upload_image', lang=lang))
 
@@ -140,7 +305,7 @@ def login(lang):
 # Logout
 @app.route('/logout')
 def logout():
-    session.pop('user_id', None)
+    end_session()
     flash_message('logged_out', session.get('lang', 'en'))
     return redirect('/')
 
@@ -183,21 +348,20 @@ def api_login():
     if not user.check_password(password):
         return jsonify({'success': False, 'message': MESSAGES['wrong_password'].get(lang, MESSAGES['wrong_password']['en'])}), 401
     
-    session['user_id'] = user.id
+    upgrade_password_hash(user, password)
+    start_session(user)
     return jsonify({'success': True, 'message': MESSAGES['login_success'].get(lang, MESSAGES['login_success']['en']), 'user_id': user.id}), 200
 
 @app.route('/api/logout', methods=['POST'])
 def api_logout():
-    session.pop('user_id', None)
+    end_session()
     return jsonify({'success': True, 'message': 'Logged out successfully.'}), 200
 
 @app.route('/api/check-auth', methods=['GET'])
 def api_check_auth():
-    user_id = session.get('user_id')
-    if user_id:
-        user = User.query.get(user_id)
-        if user:
-            return jsonify({'authenticated': True, 'email': user.email}), 200
+    email = authenticated_email()
+    if email:
+        return jsonify({'authenticated': True, 'email': email}), 200
     return jsonify({'authenticated': False}), 200
 
 # Run the app
@@ -205,6 +369,9 @@ if __name__ == '__main__':
     os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
     with app.app_context():
         db.create_all()
+        ensure_columns()
+        ensure_indexes()
+        ensure_prediction_counts()
 
     port = int(os.environ.get("PORT", 7860))
     app.run(host="0.0.0.0", port=port, debug=False)
@@ -0,0 +1,79 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+AUTH_CACHE_TTL = float(os.environ.get("AUTH_CACHE_TTL", 300))
+AUTH_CACHE_SIZE = int(os.environ.get("AUTH_CACHE_SIZE", 10000))
+
+
+def password_stamp(password_hash):
+    """Short fingerprint of a stored hash, the stamp of accounts without one of their own.
+
+    The session carries the stamp; changing the password changes it, which
+    retires every session issued before the change.
+    """
+    return hashlib.sha256(password_hash.encode()).hexdigest()[:16]
+
+
+class UserCache:
+    """Bounded TTL cache of authenticated user records keyed by user id.
+
+    Holds only what auth checks need (id, email, password stamp), so the
+    hot path never touches the ORM. Entries expire after ``ttl`` seconds,
+    and logout or a password change drops them right away.
+    """
+
+    def __init__(self, ttl=AUTH_CACHE_TTL, max_entries=AUTH_CACHE_SIZE):
+        self.ttl = float(ttl)
+        self.max_entries = max(0, int(max_entries))
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._counts = {'hits': 0, 'misses': 0, 'expired': 0, 'invalidations': 0}
+
+    def get(self, user_id):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                self._counts['misses'] += 1
+                return None
+            record, expires = entry
+            if expires <= now:
+                del self._entries[user_id]
+                self._counts['expired'] += 1
+                self._counts['misses'] += 1
+                return None
+            self._entries.move_to_end(user_id)
+            self._counts['hits'] += 1
+            return record
+
+    def put(self, user):
+        record = {'id': user.id, 'email': user.email, 'stamp': user.session_stamp()}
+        if not self.max_entries or self.ttl <= 0:
+            return record
+        with self._lock:
+            self._entries[user.id] = (record, time.monotonic() + self.ttl)
+            self._entries.move_to_end(user.id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return record
+
+    def invalidate(self, user_id):
+        with self._lock:
+            if self._entries.pop(user_id, None) is not None:
+                self._counts['invalidations'] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counts)
+            stats['entries'] = len(self._entries)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = round(stats['hits'] / lookups, 4) if lookups else 0.0
+        stats['ttl_seconds'] = self.ttl
+        return stats
+
+
+user_cache = UserCache()
@@ -0,0 +1,91 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+
+
+class MicroBatcher:
+    """Coalesce concurrent prediction requests into batched forward passes.
+
+    Callers hand in preprocessed arrays of shape (n, H, W, C) and block until
+    their rows come back. A single scheduler thread waits up to ``max_wait_ms``
+    after the first pending request (or until ``max_batch_size`` rows are
+    queued), runs ``predict_fn`` once on the stacked batch and fans the output
+    rows back out to the waiting callers.
+    """
+
+    def __init__(self, predict_fn, max_batch_size=16, max_wait_ms=10.0, name="micro-batcher"):
+        self.predict_fn = predict_fn
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+        self._queue = queue.Queue()
+        self._stats_lock = threading.Lock()
+        self._batches = 0
+        self._samples = 0
+        self._largest_batch = 0
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, samples, timeout=None):
+        samples = np.asarray(samples)
+        if samples.ndim < 1 or samples.shape[0] == 0:
+            raise ValueError("submit() expects a non-empty batch of samples.")
+        future = Future()
+        self._queue.put((samples, future))
+        return future.result(timeout=timeout)
+
+    def stats(self):
+        with self._stats_lock:
+            avg = self._samples / self._batches if self._batches else 0.0
+            return {
+                'batches': self._batches,
+                'samples': self._samples,
+                'avg_batch_size': round(avg, 2),
+                'largest_batch': self._largest_batch,
+                'pending': self._queue.qsize(),
+                'max_batch_size': self.max_batch_size,
+                'max_wait_ms': self.max_wait * 1000.0,
+            }
+
+    def _collect(self):
+        pending = [self._queue.get()]
+        rows = pending[0][0].shape[0]
+        deadline = time.monotonic() + self.max_wait
+        while rows < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            pending.append(item)
+            rows += item[0].shape[0]
+        return pending, rows
+
+    def _run(self):
+        while True:
+            pending, _ = self._collect()
+            live = [(samples, future) for samples, future in pending if future.set_running_or_notify_cancel()]
+            if not live:
+                continue
+            rows = sum(samples.shape[0] for samples, _ in live)
+
+            try:
+                batch = live[0][0] if len(live) == 1 else np.concatenate([s for s, _ in live], axis=0)
+                outputs = np.asarray(self.predict_fn(batch))
+            except Exception as exc:
+                for _, future in live:
+                    future.set_exception(exc)
+                continue
+
+            offset = 0
+            for samples, future in live:
+                count = samples.shape[0]
+                future.set_result(outputs[offset:offset + count])
+                offset += count
+
+            with self._stats_lock:
+                self._batches += 1
+                self._samples += rows
+                self._largest_batch = max(self._largest_batch, rows)
@@ -0,0 +1,100 @@
+"""Accuracy vs. latency of test-time augmentation on the serving path.
+
+Runs the held-out test split through image_routes (same backend, batcher
+and preprocessing as the web app) once per TTA mode and reports top-1/top-k
+accuracy and per-image latency, so each deployment can pick a mode:
+
+    python benchmark_tta.py --data-dir data/test --limit 50
+"""
+import argparse
+import json
+import os
+import time
+from pathlib import Path
+
+import numpy as np
+
+import image_routes
+
+
+IMAGE_EXTS = (".jpg", ".jpeg", ".png", ".bmp", ".webp")
+REPORT_PATH = Path("models") / "tta_benchmark.json"
+MODES = ["none", "flip", "flip_crop"]
+
+
+def load_samples(data_dir, limit_per_class):
+    samples = []
+    for class_dir in sorted(p for p in Path(data_dir).iterdir() if p.is_dir()):
+        files = sorted(f for f in class_dir.iterdir() if f.suffix.lower() in IMAGE_EXTS)
+        if limit_per_class:
+            files = files[:limit_per_class]
+        samples.extend((f, class_dir.name) for f in files)
+    return samples
+
+
+def benchmark_mode(arrays, labels, mode, top_k):
+    tta = mode != "none"
+    latencies = []
+    top1 = topk = 0
+    for array, label in zip(arrays, labels):
+        start = time.perf_counter()
+        scores = image_routes._predict_scores(array[None], tta=tta, tta_mode=mode)
+        predicted, _ = image_routes._postprocess(scores[0])
+        ranked = image_routes._top_k(scores, top_k)[0]
+        latencies.append(time.perf_counter() - start)
+        top1 += predicted == label
+        topk += any(candidate == label for candidate, _ in ranked)
+
+    latencies = np.array(latencies) * 1000
+    return {
+        "mode": mode,
+        "views": 1 if not tta else len(image_routes._tta_views(arrays[:1], mode)),
+        "images": len(labels),
+        "top1_accuracy": round(top1 / len(labels), 4),
+        f"top{top_k}_accuracy": round(topk / len(labels), 4),
+        "latency_ms_mean": round(float(latencies.mean()), 2),
+        "latency_ms_p95": round(float(np.percentile(latencies, 95)), 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark test-time augmentation modes.")
+    parser.add_argument("--data-dir", default=os.path.join("data", "test"))
+    parser.add_argument("--limit", type=int, default=0, help="Images per class (0 = all).")
+    parser.add_argument("--top-k", type=int, default=3)
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=MODES)
+    args = parser.parse_args()
+
+    image_routes.model_loader.start()
+    image_routes.model_loader.wait()
+    if image_routes.model is None:
+        raise SystemExit(f"No model available ({image_routes.model_loader.status}).")
+
+    samples = load_samples(args.data_dir, args.limit)
+    if not samples:
+        raise SystemExit(f"No images found under {args.data_dir}")
+    print(f"Decoding {len(samples)} images from {args.data_dir}")
+    arrays = np.stack([image_routes._preprocess(str(path)) for path, _ in samples])
+    labels = [label for _, label in samples]
+
+    # One untimed pass so graph tracing and allocation do not count.
+    image_routes._predict_scores(arrays[:1], tta=True, tta_mode="flip_crop")
+
+    results = []
+    for mode in args.modes:
+        result = benchmark_mode(arrays, labels, mode, args.top_k)
+        results.append(result)
+        print(
+            f"{mode:<10} views={result['views']}  top1={result['top1_accuracy']:.4f}  "
+            f"top{args.top_k}={result[f'top{args.top_k}_accuracy']:.4f}  "
+            f"mean={result['latency_ms_mean']:.2f}ms  p95={result['latency_ms_p95']:.2f}ms"
+        )
+
+    report = {"model_id": image_routes.MODEL_ID, "backend": image_routes.INFERENCE_BACKEND, "results": results}
+    REPORT_PATH.parent.mkdir(exist_ok=True)
+    REPORT_PATH.write_text(json.dumps(report, indent=2), encoding="utf-8")
+    print(f"Report written to {REPORT_PATH}")
+
+
+if __name__ == "__main__":
+    main()
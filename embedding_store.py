@@ -0,0 +1,333 @@
+"""Append-only store of image embeddings with nearest-neighbour search.
+
+Each record is (image id, user id, L2-normalized float16 vector), kept in
+one flat file that is memory-mapped for search, so cosine similarity is a
+dot product. The file only grows by appends, made under an advisory file
+lock, so several web processes can share it. Deleted images are
+tombstoned in place (id = -1). The ids and user ids are also held in
+memory, read once per appended row, so lookups and user filtering never
+touch the vectors.
+
+meta.json records the dimension and the model the vectors came from;
+binding a different model resets the store (``bind_model``), since
+vectors from two models are not comparable.
+
+Search is an exact, blocked matrix-vector product over the memmap, or with
+an IVF index (``python embedding_store.py build-ivf``) it is a scan of the
+closest clusters plus any rows appended since the index was built. A
+user-scoped search only looks at that user's rows, probing further
+clusters until it has ``k`` of them. Candidates are always ranked on the
+stored vectors.
+"""
+import argparse
+import fcntl
+import json
+import os
+import threading
+
+import numpy as np
+
+
+SEARCH_BLOCK_ROWS = 262144
+IVF_TRAIN_SAMPLE = 100000
+IVF_ITERATIONS = 20
+# User-scoped searches over at most this many rows skip the IVF index.
+EXACT_SEARCH_MAX_ROWS = 50000
+
+
+def _record_dtype(dim):
+    return np.dtype([('id', '<i8'), ('user_id', '<i8'), ('vector', '<f2', (dim,))])
+
+
+def _top_indices(scores, k):
+    if len(scores) <= k:
+        return np.argsort(-scores)
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top])]
+
+
+class EmbeddingStore:
+    def __init__(self, directory, dim=None):
+        self.directory = directory
+        self.data_path = os.path.join(directory, 'embeddings.bin')
+        self.meta_path = os.path.join(directory, 'meta.json')
+        self.ivf_path = os.path.join(directory, 'ivf.npz')
+        self.lock_path = os.path.join(directory, '.lock')
+        self._lock = threading.Lock()
+        self._ivf = None
+        self._ivf_mtime = None
+        self.dim = dim
+        self.model_id = None
+        self._read_meta()
+        self._reset_index()
+
+    def _read_meta(self):
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path, 'r', encoding='utf-8') as fh:
+                meta = json.load(fh)
+            self.dim = meta['dim']
+            self.model_id = meta.get('model_id')
+
+    def _write_meta(self):
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = self.meta_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as fh:
+            json.dump({'dim': self.dim, 'model_id': self.model_id}, fh)
+        os.replace(tmp_path, self.meta_path)
+
+    def _reset_index(self):
+        self._records = None
+        self._ids = np.zeros(0, dtype=np.int64)
+        self._users = np.zeros(0, dtype=np.int64)
+        self._rows = {}
+
+    def _exclusive(self):
+        os.makedirs(self.directory, exist_ok=True)
+        fh = open(self.lock_path, 'a')
+        fcntl.flock(fh, fcntl.LOCK_EX)
+        return fh
+
+    def bind_model(self, model_id):
+        """Tie the store to a model; returns True if vectors of another model were dropped."""
+        with self._exclusive():
+            self._read_meta()
+            if self.model_id == model_id:
+                return False
+            stale = self.model_id is not None or len(self)
+            for path in (self.data_path, self.ivf_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            self.model_id = model_id
+            if self.dim is not None:
+                self._write_meta()
+        with self._lock:
+            self._reset_index()
+        return bool(stale)
+
+    @property
+    def dtype(self):
+        return _record_dtype(self.dim)
+
+    def _ensure_meta(self, dim):
+        if self.dim is None:
+            self.dim = dim
+        if self.dim != dim:
+            raise ValueError(f"Embedding has {dim} dimensions; store holds {self.dim}.")
+        if not os.path.exists(self.meta_path):
+            self._write_meta()
+
+    def __len__(self):
+        if self.dim is None or not os.path.exists(self.data_path):
+            return 0
+        return os.path.getsize(self.data_path) // self.dtype.itemsize
+
+    def _map(self):
+        """Memmap of every complete record; rows appended since the last call are indexed."""
+        count = len(self)
+        with self._lock:
+            known = len(self._ids)
+            if count < known:
+                # The store was reset by another process.
+                self._reset_index()
+                known = 0
+            if self._records is None or len(self._records) != count:
+                self._records = np.memmap(self.data_path, dtype=self.dtype, mode='r', shape=(count,)) if count else None
+            if count > known:
+                new = self._records[known:count]
+                ids, users = np.array(new['id']), np.array(new['user_id'])
+                self._ids = np.concatenate([self._ids, ids])
+                self._users = np.concatenate([self._users, users])
+                for offset, image_id in enumerate(ids.tolist()):
+                    if image_id >= 0:
+                        self._rows[image_id] = known + offset
+            return self._records
+
+    def add(self, image_id, user_id, vector):
+        vector = np.asarray(vector, dtype=np.float32).ravel()
+        self._ensure_meta(vector.shape[0])
+        record = np.zeros(1, dtype=self.dtype)
+        record['id'] = image_id
+        record['user_id'] = user_id
+        record['vector'] = vector / max(float(np.linalg.norm(vector)), 1e-12)
+        with open(self.data_path, 'ab') as fh:
+            fcntl.flock(fh, fcntl.LOCK_EX)
+            try:
+                fh.write(record.tobytes())
+            finally:
+                fcntl.flock(fh, fcntl.LOCK_UN)
+
+    def find(self, image_id):
+        """Row index of an image's record, or None."""
+        records = self._map()
+        with self._lock:
+            row = self._rows.get(image_id)
+        # Another process may have tombstoned it since it was indexed.
+        if row is None or records[row]['id'] != image_id:
+            return None
+        return row
+
+    def vector(self, row):
+        return np.asarray(self._map()['vector'][row], dtype=np.float32)
+
+    def remove(self, image_id):
+        row = self.find(image_id)
+        if row is None:
+            return
+        with open(self.data_path, 'r+b') as fh:
+            fh.seek(row * self.dtype.itemsize)
+            fh.write(np.int64(-1).tobytes())
+        with self._lock:
+            self._rows.pop(image_id, None)
+            self._ids[row] = -1
+
+    def _load_ivf(self):
+        if not os.path.exists(self.ivf_path):
+            self._ivf = None
+            return None
+        mtime = os.path.getmtime(self.ivf_path)
+        if self._ivf is None or mtime != self._ivf_mtime:
+            with np.load(self.ivf_path) as data:
+                self._ivf = {name: data[name] for name in data.files}
+            self._ivf_mtime = mtime
+        return self._ivf
+
+    def _candidate_rows(self, query, count, k, user_id, exclude_id, nprobe):
+        """Rows to score, or None for a full scan."""
+        ivf = self._load_ivf() if nprobe else None
+        with self._lock:
+            ids, users = self._ids[:count], self._users[:count]
+        valid = ids >= 0
+        if exclude_id is not None:
+            valid &= ids != exclude_id
+        if user_id is not None:
+            valid &= users == user_id
+            if ivf is None or np.count_nonzero(valid) <= EXACT_SEARCH_MAX_ROWS:
+                return np.flatnonzero(valid)
+        if ivf is None:
+            return None
+
+        offsets = ivf['offsets']
+        indexed = int(ivf['indexed_count'])
+        order = np.argsort(-(ivf['centroids'] @ query))
+        tail = np.arange(indexed, count)
+        lists = []
+        found = np.count_nonzero(valid[tail])
+        probes = min(nprobe, len(order))
+        while True:
+            for i in order[len(lists):probes]:
+                rows = ivf['order'][offsets[i]:offsets[i + 1]]
+                rows = rows[rows < count]
+                lists.append(rows)
+                found += np.count_nonzero(valid[rows])
+            # Keep probing until the filters leave k hits.
+            if found >= k or probes >= len(order):
+                break
+            probes = min(probes * 2, len(order))
+        rows = np.sort(np.concatenate(lists + [tail]))
+        return rows[valid[rows]]
+
+    def search(self, query, k=10, user_id=None, exclude_id=None, nprobe=0):
+        """Top-k (image id, user id, cosine similarity) for a query vector.
+
+        ``nprobe`` > 0 uses the IVF index when one has been built.
+        """
+        records = self._map()
+        if records is None:
+            return []
+        query = np.asarray(query, dtype=np.float32).ravel()
+        query = query / max(float(np.linalg.norm(query)), 1e-12)
+        candidates = self._candidate_rows(query, len(records), k, user_id, exclude_id, nprobe)
+
+        best_scores, best_rows = [], []
+        total = len(records) if candidates is None else len(candidates)
+        for start in range(0, total, SEARCH_BLOCK_ROWS):
+            if candidates is None:
+                rows = np.arange(start, min(start + SEARCH_BLOCK_ROWS, total))
+                block = records[start:start + SEARCH_BLOCK_ROWS]
+            else:
+                rows = candidates[start:start + SEARCH_BLOCK_ROWS]
+                block = records[rows]
+            scores = block['vector'].astype(np.float32) @ query
+            valid = block['id'] >= 0
+            if user_id is not None:
+                valid &= block['user_id'] == user_id
+            if exclude_id is not None:
+                valid &= block['id'] != exclude_id
+            scores = np.where(valid, scores, -np.inf)
+            top = _top_indices(scores, k)
+            best_scores.append(scores[top])
+            best_rows.append(rows[top])
+        if not best_scores:
+            return []
+
+        scores = np.concatenate(best_scores)
+        rows = np.concatenate(best_rows)
+        top = _top_indices(scores, k)
+        results, seen = [], set()
+        for row, score in zip(rows[top], scores[top]):
+            image_id = int(records['id'][row])
+            # A racing backfill can append an image twice; report it once.
+            if np.isfinite(score) and image_id not in seen:
+                seen.add(image_id)
+                results.append((image_id, int(records['user_id'][row]), float(score)))
+        return results
+
+    def build_ivf(self, nlist=1024, seed=0):
+        """Cluster the stored vectors with k-means and write the IVF index."""
+        records = self._map()
+        if records is None:
+            raise RuntimeError("The embedding store is empty.")
+        count = len(records)
+        nlist = max(1, min(nlist, count))
+        rng = np.random.default_rng(seed)
+        sample = records['vector'][np.sort(rng.choice(count, min(count, IVF_TRAIN_SAMPLE), replace=False))]
+        sample = sample.astype(np.float32)
+        centroids = sample[rng.choice(len(sample), nlist, replace=False)]
+        for _ in range(IVF_ITERATIONS):
+            assign = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assign, sample)
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            # Empty clusters keep their previous centroid.
+            centroids = np.where(norms > 0, sums / np.maximum(norms, 1e-12), centroids)
+
+        assign = np.empty(count, dtype=np.int32)
+        for start in range(0, count, SEARCH_BLOCK_ROWS):
+            block = records['vector'][start:start + SEARCH_BLOCK_ROWS].astype(np.float32)
+            assign[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+        order = np.argsort(assign, kind='stable').astype(np.int64)
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=nlist))]).astype(np.int64)
+
+        tmp_path = self.ivf_path + '.tmp.npz'
+        np.savez(tmp_path, centroids=centroids.astype(np.float32), order=order, offsets=offsets, indexed_count=count)
+        os.replace(tmp_path, self.ivf_path)
+        return nlist
+
+    def stats(self):
+        ivf = self._load_ivf()
+        return {
+            'embeddings': len(self),
+            'dim': self.dim,
+            'model_id': self.model_id,
+            'ivf_lists': int(len(ivf['centroids'])) if ivf is not None else 0,
+            'ivf_indexed': int(ivf['indexed_count']) if ivf is not None else 0,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintain the image embedding store.")
+    parser.add_argument('command', choices=['stats', 'build-ivf'])
+    parser.add_argument('--path', default=os.environ.get('EMBEDDING_STORE_PATH', os.path.join('instance', 'embeddings')))
+    parser.add_argument('--lists', type=int, default=None,
+                        help="IVF clusters (default: about 4 * sqrt(number of embeddings)).")
+    args = parser.parse_args()
+
+    store = EmbeddingStore(args.path)
+    if args.command == 'build-ivf':
+        nlist = args.lists or max(1, int(4 * np.sqrt(len(store))))
+        print(f"Built IVF index with {store.build_ivf(nlist)} lists over {len(store)} embeddings")
+    print(json.dumps(store.stats(), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+import argparse
+import json
+import time
+from pathlib import Path
+
+import numpy as np
+import tensorflow as tf
+
+from train_model import BATCH_SIZE, IMAGE_SIZE, OUTPUT_DIR, TEST_DIR, VAL_DIR
+
+
+KERAS_MODEL_PATH = OUTPUT_DIR / "agrovision_final.keras"
+TFLITE_VARIANTS = {
+    "fp16": OUTPUT_DIR / "agrovision_fp16.tflite",
+    "int8": OUTPUT_DIR / "agrovision_int8.tflite",
+}
+DRIFT_REPORT_PATH = OUTPUT_DIR / "tflite_drift.json"
+CALIBRATION_BATCHES = 20
+
+
+def load_split(directory, shuffle=False):
+    return tf.keras.utils.image_dataset_from_directory(
+        directory,
+        labels="inferred",
+        label_mode="int",
+        image_size=IMAGE_SIZE,
+        batch_size=BATCH_SIZE,
+        shuffle=shuffle,
+        seed=42,
+    )
+
+
+def make_converter(model):
+    # Convert from an inference-mode concrete function so the augmentation
+    # layers are traced as identity ops rather than random transforms.
+    @tf.function(input_signature=[tf.TensorSpec((None,) + IMAGE_SIZE + (3,), tf.float32)])
+    def serve(images):
+        return model(images, training=False)
+
+    concrete = serve.get_concrete_function()
+    return tf.lite.TFLiteConverter.from_concrete_functions([concrete], model)
+
+
+def convert_fp16(model):
+    converter = make_converter(model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.target_spec.supported_types = [tf.float16]
+    return converter.convert()
+
+
+def convert_int8(model, calibration_batches):
+    val_ds = load_split(VAL_DIR, shuffle=True)
+
+    def representative_dataset():
+        for images, _ in val_ds.take(calibration_batches):
+            for image in images:
+                yield [tf.expand_dims(tf.cast(image, tf.float32), 0)]
+
+    converter = make_converter(model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.representative_dataset = representative_dataset
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    # Keep float32 input/output so the serving code can feed either backend.
+    converter.inference_input_type = tf.float32
+    converter.inference_output_type = tf.float32
+    return converter.convert()
+
+
+def load_interpreter(path, num_threads):
+    """(interpreter, input index, output index), ready for run_tflite."""
+    interpreter = tf.lite.Interpreter(model_path=str(path), num_threads=num_threads)
+    interpreter.allocate_tensors()
+    return interpreter, interpreter.get_input_details()[0]["index"], interpreter.get_output_details()[0]["index"]
+
+
+def fit_input(interpreter, shape):
+    """Resize the input tensor when the batch shape changes (only the last, partial batch)."""
+    details = interpreter.get_input_details()[0]
+    if tuple(details["shape"]) != tuple(shape):
+        interpreter.resize_tensor_input(details["index"], list(shape))
+        interpreter.allocate_tensors()
+
+
+def run_tflite(interpreter, input_index, output_index, images):
+    interpreter.set_tensor(input_index, images)
+    interpreter.invoke()
+    return interpreter.get_tensor(output_index)
+
+
+def measure_drift(model, variant_paths, num_threads):
+    test_ds = load_split(TEST_DIR)
+    # Interpreters are built once, like the Keras model, so only inference is timed.
+    interpreters = {name: load_interpreter(path, num_threads) for name, path in variant_paths.items()}
+
+    labels = []
+    keras_probs = []
+    tflite_probs = {name: [] for name in variant_paths}
+    timings = {name: 0.0 for name in ["keras"] + list(variant_paths)}
+
+    for images, y in test_ds:
+        batch = images.numpy().astype(np.float32)
+        labels.append(y.numpy())
+
+        start = time.perf_counter()
+        keras_probs.append(model(batch, training=False).numpy())
+        timings["keras"] += time.perf_counter() - start
+
+        for name, (interpreter, input_index, output_index) in interpreters.items():
+            fit_input(interpreter, batch.shape)
+            start = time.perf_counter()
+            tflite_probs[name].append(run_tflite(interpreter, input_index, output_index, batch))
+            timings[name] += time.perf_counter() - start
+
+    labels = np.concatenate(labels)
+    keras_probs = np.concatenate(keras_probs)
+    keras_pred = keras_probs.argmax(axis=1)
+    n = len(labels)
+
+    report = {
+        "test_images": int(n),
+        "keras": {
+            "accuracy": float((keras_pred == labels).mean()),
+            "ms_per_image": 1000.0 * timings["keras"] / max(n, 1),
+        },
+    }
+    for name, path in variant_paths.items():
+        probs = np.concatenate(tflite_probs[name])
+        pred = probs.argmax(axis=1)
+        accuracy = float((pred == labels).mean())
+        report[name] = {
+            "path": str(path),
+            "size_mb": path.stat().st_size / (1024 * 1024),
+            "accuracy": accuracy,
+            "accuracy_drift": accuracy - report["keras"]["accuracy"],
+            "top1_agreement": float((pred == keras_pred).mean()),
+            "max_abs_prob_diff": float(np.abs(probs - keras_probs).max()),
+            "ms_per_image": 1000.0 * timings[name] / max(n, 1),
+        }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the Keras model to quantized TFLite variants.")
+    parser.add_argument("--model", type=Path, default=KERAS_MODEL_PATH)
+    parser.add_argument("--variants", nargs="+", choices=sorted(TFLITE_VARIANTS), default=sorted(TFLITE_VARIANTS))
+    parser.add_argument("--calibration-batches", type=int, default=CALIBRATION_BATCHES)
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--skip-eval", action="store_true", help="Do not measure drift on the test split.")
+    args = parser.parse_args()
+
+    model = tf.keras.models.load_model(args.model)
+    print(f"Loaded Keras model from {args.model}")
+
+    exported = {}
+    for name in args.variants:
+        start = time.perf_counter()
+        if name == "fp16":
+            flatbuffer = convert_fp16(model)
+        else:
+            flatbuffer = convert_int8(model, args.calibration_batches)
+        path = TFLITE_VARIANTS[name]
+        path.write_bytes(flatbuffer)
+        exported[name] = path
+        print(f"Wrote {name} model to {path} ({len(flatbuffer) / (1024 * 1024):.2f} MB) "
+              f"in {time.perf_counter() - start:.1f}s")
+
+    if args.skip_eval:
+        return
+
+    report = measure_drift(model, exported, args.threads)
+    DRIFT_REPORT_PATH.write_text(json.dumps(report, indent=2), encoding="utf-8")
+
+    print(f"\nAccuracy on {report['test_images']} test images:")
+    print(f"  keras: {report['keras']['accuracy']:.4f} ({report['keras']['ms_per_image']:.2f} ms/image)")
+    for name in exported:
+        entry = report[name]
+        print(
+            f"  {name}: {entry['accuracy']:.4f} (drift {entry['accuracy_drift']:+.4f}, "
+            f"agreement {entry['top1_agreement']:.4f}, {entry['ms_per_image']:.2f} ms/image)"
+        )
+    print(f"Drift report saved to {DRIFT_REPORT_PATH}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,28 +1,130 @@
+import base64
+import fcntl
+import io
 import json
 import os
+import threading
+import time
 import uuid
-from PIL import Image as PILImage
-from flask import Blueprint, request, render_template, redirect, url_for, session, abort, flash, jsonify
+import zipfile
+import zlib
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from PIL import Image as PILImage, ImageOps
+from flask import Blueprint, Response, current_app, request, render_template, redirect, url_for, session, abort, flash, jsonify, stream_with_context
+from sqlalchemy import and_, or_
 from werkzeug.utils import secure_filename
-from models import db, Image, User
+from models import db, Image, PredictionDailyCount, FleetDailyCount
+from jobs import JobQueue
+from metrics import REGISTRY
+from prediction_cache import PredictionCache, content_hash
+from storage import create_storage
 
 # Optional ML dependencies
 try:
     import numpy as np
+    from batching import MicroBatcher
+    from embedding_store import EmbeddingStore
 except Exception:
     np = None
-try:
-    import tensorflow as tf
-except Exception:
-    tf = None
+    MicroBatcher = None
+    EmbeddingStore = None
+# TensorFlow / TFLite are imported by the background model loader, not at
+# import time, so the web app can serve pages while the model warms up.
+tf = None
+TFLiteInterpreter = None
 
 image_bp = Blueprint('image', __name__)
 UPLOAD_FOLDER = os.path.join('static', 'uploads')
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+MAX_IMAGE_BYTES = 16 * 1024 * 1024
 MODEL_LOCATIONS = ['model', 'models']
 MODEL_CANDIDATES = ['agrovision_final.keras', 'agrovision_best.keras', 'agrovision.h5']
+TFLITE_CANDIDATES = ['agrovision_int8.tflite', 'agrovision_fp16.tflite']
+# "keras" serves the SavedModel through TensorFlow; "tflite" serves a model
+# produced by export_tflite.py through the TFLite interpreter; "remote" sends
+# batches to an inference_worker.py pool at INFERENCE_WORKER_ADDRESS.
+INFERENCE_BACKEND = os.environ.get("INFERENCE_BACKEND", "keras").lower()
+# Unset means inference_worker.DEFAULT_ADDRESS, a private unix socket.
+INFERENCE_WORKER_ADDRESS = os.environ.get("INFERENCE_WORKER_ADDRESS")
+TFLITE_MODEL_PATH = os.environ.get("TFLITE_MODEL_PATH")
+TFLITE_NUM_THREADS = int(os.environ.get("TFLITE_NUM_THREADS", os.cpu_count() or 1))
+# Predictions are cached by image content hash and model identity.
+PREDICTION_CACHE_PATH = os.environ.get("PREDICTION_CACHE_PATH", os.path.join('instance', 'prediction_cache.db'))
+PREDICTION_CACHE_SIZE = int(os.environ.get("PREDICTION_CACHE_SIZE", 4096))
+# Row limit of the SQLite tier (0 for no limit).
+PREDICTION_CACHE_DISK_SIZE = int(os.environ.get("PREDICTION_CACHE_DISK_SIZE", 100000))
+# Store identical uploads once, named by their content hash.
+DEDUPLICATE_UPLOADS = os.environ.get("DEDUPLICATE_UPLOADS", "0").lower() in ("1", "true", "yes")
+# Upload files are written to disk by this many background threads.
+UPLOAD_WRITE_WORKERS = int(os.environ.get("UPLOAD_WRITE_WORKERS", 2))
+# WebP derivatives written next to each upload for the gallery: variant ->
+# longest edge in pixels.
+DERIVATIVE_SIZES = {
+    'thumbnail': int(os.environ.get("THUMBNAIL_SIZE", 256)),
+    'preview': int(os.environ.get("PREVIEW_SIZE", 1024)),
+}
+DERIVATIVE_QUALITY = int(os.environ.get("DERIVATIVE_QUALITY", 80))
+DERIVATIVE_WORKERS = int(os.environ.get("DERIVATIVE_WORKERS", 2))
+# Stored uploads and derivatives never change under a given name, so they
+# are served with a year-long immutable cache lifetime.
+UPLOAD_CACHE_MAX_AGE = 365 * 24 * 3600
+# /api/upload/batch limits: request size, image count, decode threads and
+# how many decoded images are sent to the model per forward pass.
+BATCH_UPLOAD_MAX_BYTES = int(os.environ.get("BATCH_UPLOAD_MAX_BYTES", 256 * 1024 * 1024))
+BATCH_UPLOAD_MAX_IMAGES = int(os.environ.get("BATCH_UPLOAD_MAX_IMAGES", 500))
+BATCH_DECODE_WORKERS = int(os.environ.get("BATCH_DECODE_WORKERS", os.cpu_count() or 2))
+BATCH_PREDICT_SIZE = int(os.environ.get("BATCH_PREDICT_SIZE", 32))
+# Async mode: /api/upload enqueues the prediction and answers 202 with a job
+# id to poll. Clients can also opt in or out per request with ?async=1|0.
+ASYNC_PREDICTIONS = os.environ.get("ASYNC_PREDICTIONS", "0").lower() in ("1", "true", "yes")
+PREDICTION_WORKERS = int(os.environ.get("PREDICTION_WORKERS", 2))
+JOB_MODEL_WAIT_TIMEOUT = 300
+# An Image row with no prediction and no job in this process is taken to
+# belong to a job in another worker process for this long, then reported
+# as unknown.
+JOB_ORPHAN_AFTER = JOB_MODEL_WAIT_TIMEOUT + 60
+JOB_EVENTS_TIMEOUT = 120
+# Image history pages (/api/my-images?limit=...).
+HISTORY_PAGE_SIZE = 50
+HISTORY_MAX_PAGE_SIZE = 200
+# /api/stats returns per-day counts for this many days by default.
+STATS_DEFAULT_DAYS = 30
+STATS_MAX_DAYS = 366
+# How long /api/upload waits for a warming-up model before answering 503.
+MODEL_READY_TIMEOUT = float(os.environ.get("MODEL_READY_TIMEOUT", 5))
 UNKNOWN_LABEL = "Unknown"
 UNKNOWN_CONFIDENCE_THRESHOLD = 0.5
+IMAGE_SIZE = (224, 224)
+# Micro-batching: concurrent requests are coalesced for up to this window
+# (or until this many images are queued) and run in one forward pass.
+PREDICT_BATCH_WINDOW_MS = float(os.environ.get("PREDICT_BATCH_WINDOW_MS", 10))
+PREDICT_MAX_BATCH = int(os.environ.get("PREDICT_MAX_BATCH", 16))
+# Opt-in per request: ?top_k=N returns the N most likely labels and ?tta=1
+# averages the model over augmented views of the image. TTA_MODE "flip" uses
+# 2 views (original, mirrored), "flip_crop" adds a centre zoom of each (4).
+# All views of an image go through the model in a single forward pass.
+TOP_K_MAX = 5
+TTA_MODE = os.environ.get("TTA_MODE", "flip_crop").lower()
+TTA_CROP_FRACTION = 0.875
+# Crop hints (?crop=tomato) restrict the answer to that crop's classes (the
+# label prefix) and renormalize. With CROP_INFERENCE_MODE=heads and a
+# crop_heads.npz from train_crop_heads.py next to the Keras model, hinted
+# requests are scored by a small per-crop classifier on the shared
+# MobileNetV2 embedding instead. Embeddings are kept per image, so asking
+# again with another hint skips the backbone.
+CROP_INFERENCE_MODE = os.environ.get("CROP_INFERENCE_MODE", "mask").lower()
+CROP_HEADS_FILE = 'crop_heads.npz'
+EMBEDDING_CACHE_SIZE = int(os.environ.get("EMBEDDING_CACHE_SIZE", 1024))
+# Pooled embeddings of every upload, for /api/similar (see embedding_store.py).
+EMBEDDING_STORE_PATH = os.environ.get("EMBEDDING_STORE_PATH", os.path.join('instance', 'embeddings'))
+EMBEDDING_WORKERS = int(os.environ.get("EMBEDDING_WORKERS", 1))
+SIMILAR_DEFAULT_K = 8
+SIMILAR_MAX_K = 50
+# IVF clusters scanned per query once an index is built; 0 = always exact.
+IVF_NPROBE = int(os.environ.get("IVF_NPROBE", 16))
+EMBEDDING_BACKFILL_CHUNK = 500
 CLASS_NAMES_FALLBACK = [
     "Corn_Blight",
     "Corn_Common_Rust",
@@ -49,8 +151,31 @@ CLASS_NAMES_FALLBACK = [
 ]
 
 
-def _load_model():
+def _import_tensorflow():
+    global tf
     if tf is None:
+        try:
+            import tensorflow
+            tf = tensorflow
+        except Exception:
+            tf = None
+    return tf
+
+
+def _import_tflite_interpreter():
+    global TFLiteInterpreter
+    if TFLiteInterpreter is None:
+        try:
+            from tflite_runtime.interpreter import Interpreter
+            TFLiteInterpreter = Interpreter
+        except Exception:
+            tensorflow = _import_tensorflow()
+            TFLiteInterpreter = tensorflow.lite.Interpreter if tensorflow is not None else None
+    return TFLiteInterpreter
+
+
+def _load_model():
+    if _import_tensorflow() is None:
         print("TensorFlow not available. Image prediction will be disabled.")
         return None, None
 
@@ -68,6 +193,102 @@ def _load_model():
     return None, None
 
 
+class TFLiteModel:
+    """Callable wrapper running a .tflite model on float32 image batches.
+
+    The interpreter is not thread-safe; calls are serialized by the
+    micro-batcher's single scheduler thread.
+    """
+
+    def __init__(self, path, num_threads):
+        self.path = path
+        self.interpreter = TFLiteInterpreter(model_path=path, num_threads=num_threads)
+        self.interpreter.allocate_tensors()
+        self._input = self.interpreter.get_input_details()[0]
+        self._output = self.interpreter.get_output_details()[0]
+        self._batch_size = int(self._input['shape'][0])
+        self.drift = self._load_drift_report()
+
+    def _load_drift_report(self):
+        report_path = os.path.join(os.path.dirname(self.path), 'tflite_drift.json')
+        if not os.path.exists(report_path):
+            return None
+        try:
+            with open(report_path, 'r', encoding='utf-8') as fh:
+                report = json.load(fh)
+        except Exception as exc:
+            print(f"Failed to read TFLite drift report {report_path}: {exc}")
+            return None
+        for name, entry in report.items():
+            if isinstance(entry, dict) and os.path.basename(entry.get('path', '')) == os.path.basename(self.path):
+                return {
+                    'variant': name,
+                    'accuracy': entry.get('accuracy'),
+                    'keras_accuracy': report.get('keras', {}).get('accuracy'),
+                    'accuracy_drift': entry.get('accuracy_drift'),
+                    'top1_agreement': entry.get('top1_agreement'),
+                }
+        return None
+
+    def _resize(self, batch_size):
+        self.interpreter.resize_tensor_input(self._input['index'], [batch_size] + list(IMAGE_SIZE) + [3])
+        self.interpreter.allocate_tensors()
+        self._input = self.interpreter.get_input_details()[0]
+        self._output = self.interpreter.get_output_details()[0]
+        self._batch_size = batch_size
+
+    def __call__(self, batch):
+        if batch.shape[0] != self._batch_size:
+            self._resize(batch.shape[0])
+
+        scale, zero_point = self._input['quantization']
+        if self._input['dtype'] != np.float32 and scale:
+            batch = np.round(batch / scale + zero_point)
+        self.interpreter.set_tensor(self._input['index'], batch.astype(self._input['dtype']))
+        self.interpreter.invoke()
+
+        output = self.interpreter.get_tensor(self._output['index'])
+        scale, zero_point = self._output['quantization']
+        if self._output['dtype'] != np.float32 and scale:
+            output = (output.astype(np.float32) - zero_point) * scale
+        return output
+
+
+def _load_tflite_model():
+    if _import_tflite_interpreter() is None or np is None:
+        print("TFLite interpreter not available. Image prediction will be disabled.")
+        return None, None
+
+    candidate_paths = [TFLITE_MODEL_PATH] if TFLITE_MODEL_PATH else [
+        os.path.join(directory, candidate)
+        for directory in MODEL_LOCATIONS
+        for candidate in TFLITE_CANDIDATES
+    ]
+    for candidate_path in candidate_paths:
+        if os.path.exists(candidate_path):
+            try:
+                loaded_model = TFLiteModel(candidate_path, TFLITE_NUM_THREADS)
+                print(f"TFLite model loaded from {candidate_path} ({TFLITE_NUM_THREADS} threads)")
+                if loaded_model.drift:
+                    print(f"TFLite accuracy drift vs Keras on test split: {loaded_model.drift['accuracy_drift']:+.4f}")
+                return loaded_model, candidate_path
+            except Exception as exc:
+                print(f"Error loading TFLite model at {candidate_path}: {exc}. Trying next candidate.")
+    print("Warning: No TFLite model file found. Image prediction will be disabled.")
+    return None, None
+
+
+def _connect_inference_worker():
+    try:
+        from inference_worker import RemoteModel
+        remote = RemoteModel(INFERENCE_WORKER_ADDRESS)
+    except Exception as exc:
+        print(f"Could not reach inference worker at {INFERENCE_WORKER_ADDRESS or 'the default socket'}: {exc}. Image prediction will be disabled.")
+        return None, None
+    print(f"Connected to inference worker at {remote.address} serving {remote.info['model_path']}")
+    return remote, remote.info['model_path']
+
+
 def _load_class_names(model_path):
     candidate_paths = []
     if model_path:
@@ -89,49 +310,694 @@ def _load_class_names(model_path):
     return CLASS_NAMES_FALLBACK
 
 
-model, MODEL_PATH = _load_model()
-CLASS_NAMES = _load_class_names(MODEL_PATH)
+def _build_inference_fn(loaded_model):
+    """Trace the serving call; returns (infer, score_columns).
+
+    When the model has a GlobalAveragePooling2D layer, each output row is the
+    class scores followed by the pooled MobileNetV2 embedding from the same
+    forward pass, and score_columns says where the scores end.
+    """
+    pooling = next(
+        (layer for layer in loaded_model.layers if isinstance(layer, tf.keras.layers.GlobalAveragePooling2D)), None)
+    if pooling is not None:
+        serving = tf.keras.Model(loaded_model.inputs, [loaded_model.output, pooling.output])
+        score_columns = int(loaded_model.output_shape[-1])
+    else:
+        serving, score_columns = loaded_model, None
+
+    # A traced call skips the tf.data pipeline and callback setup that
+    # model.predict() rebuilds on every invocation.
+    @tf.function(input_signature=[tf.TensorSpec(shape=(None,) + IMAGE_SIZE + (3,), dtype=tf.float32)])
+    def infer(images):
+        if score_columns is None:
+            return serving(images, training=False)
+        scores, embedding = serving(images, training=False)
+        return tf.concat([scores, embedding], axis=1)
+
+    start = time.perf_counter()
+    infer(tf.zeros((1,) + IMAGE_SIZE + (3,), dtype=tf.float32))
+    print(f"Inference function traced and warmed up in {(time.perf_counter() - start) * 1000:.1f} ms")
+    return infer, score_columns
+
+
+def _load_crop_heads(model_path):
+    global crop_heads
+    path = os.path.join(os.path.dirname(model_path), CROP_HEADS_FILE)
+    if not os.path.exists(path):
+        print(f"CROP_INFERENCE_MODE=heads but {path} does not exist; crop hints will mask the full model.")
+        return
+    heads = {}
+    with np.load(path) as data:
+        for crop in data['crops'].tolist():
+            labels = [str(label) for label in data[f'{crop}_labels']]
+            missing = [label for label in labels if label not in CLASS_NAMES]
+            if missing:
+                print(f"Skipping {crop} head: unknown labels {missing}")
+                continue
+            heads[crop] = (
+                data[f'{crop}_kernel'].astype(np.float32),
+                data[f'{crop}_bias'].astype(np.float32),
+                np.array([CLASS_NAMES.index(label) for label in labels]),
+            )
+    crop_heads = heads
+    print(f"Loaded per-crop heads for {', '.join(sorted(heads))} from {path}")
+
+
+class LatencyStats:
+    """Thread-safe running latency summary for one code path."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.count = 0
+        self.total_ms = 0.0
+        self.last_ms = 0.0
+        self.max_ms = 0.0
+
+    def record(self, elapsed_ms):
+        with self._lock:
+            self.count += 1
+            self.total_ms += elapsed_ms
+            self.last_ms = elapsed_ms
+            self.max_ms = max(self.max_ms, elapsed_ms)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'count': self.count,
+                'last_ms': round(self.last_ms, 3),
+                'avg_ms': round(self.total_ms / self.count, 3) if self.count else 0.0,
+                'max_ms': round(self.max_ms, 3),
+            }
+
+
+class ModelLoader:
+    """Loads the serving model on a background thread and tracks readiness.
+
+    Status moves from "pending" to "loading" and then to "ready" (a model is
+    serving), "unavailable" (no model or runtime found) or "failed".
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._pid = None
+        self.status = 'pending'
+        self.error = None
+        self.started_at = None
+        self.load_seconds = None
+
+    def start(self):
+        # Re-arm after a fork: the loader thread does not survive into a
+        # prefork server's worker processes.
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._ready.clear()
+            self.status = 'loading'
+            self.started_at = time.monotonic()
+            threading.Thread(target=self._load, name='model-loader', daemon=True).start()
+
+    def _load(self):
+        global model, MODEL_PATH, MODEL_ID, infer_fn, SCORE_COLUMNS, CLASS_NAMES
+        try:
+            score_columns = None
+            if INFERENCE_BACKEND == 'remote':
+                loaded_model, model_path = _connect_inference_worker()
+                loaded_fn = loaded_model
+            elif INFERENCE_BACKEND == 'tflite':
+                loaded_model, model_path = _load_tflite_model()
+                loaded_fn = loaded_model
+            else:
+                loaded_model, model_path = _load_model()
+                loaded_fn = None
+                if loaded_model is not None:
+                    loaded_fn, score_columns = _build_inference_fn(loaded_model)
+            if INFERENCE_BACKEND == 'remote' and loaded_model is not None:
+                # The workers own the model files; take identity and labels from them.
+                CLASS_NAMES = loaded_model.info['class_names']
+            else:
+                CLASS_NAMES = _load_class_names(model_path)
+            model, MODEL_PATH, infer_fn, SCORE_COLUMNS = loaded_model, model_path, loaded_fn, score_columns
+            if CROP_INFERENCE_MODE == 'heads' and score_columns is not None:
+                _load_crop_heads(model_path)
+            if loaded_model is not None:
+                MODEL_ID = loaded_model.info['model_id'] if INFERENCE_BACKEND == 'remote' else _model_identity(model_path)
+                purged = prediction_cache.purge_stale(MODEL_ID)
+                if purged:
+                    print(f"Dropped {purged} cached predictions from previous models")
+                if embedding_store is not None and score_columns is not None:
+                    _bind_embedding_store(MODEL_ID)
+            self.status = 'ready' if loaded_model is not None else 'unavailable'
+        except Exception as exc:
+            print(f"Model loading failed: {exc}")
+            self.error = str(exc)
+            self.status = 'failed'
+        finally:
+            self.load_seconds = time.monotonic() - self.started_at
+            print(f"Model loader finished with status '{self.status}' in {self.load_seconds:.2f}s")
+            self._ready.set()
+
+    @property
+    def loading(self):
+        return not self._ready.is_set()
+
+    def wait(self, timeout=None):
+        """Block until loading has finished; returns False on timeout."""
+        return self._ready.wait(timeout)
+
+    def snapshot(self):
+        return {
+            'status': self.status,
+            'error': self.error,
+            'backend': INFERENCE_BACKEND,
+            'model_path': MODEL_PATH,
+            'load_seconds': round(self.load_seconds, 3) if self.load_seconds is not None else None,
+        }
+
+
+def _model_identity(model_path):
+    return f"{INFERENCE_BACKEND}:{os.path.abspath(model_path)}:{os.path.getmtime(model_path)}"
+
+
+model, MODEL_PATH, MODEL_ID, infer_fn = None, None, None, None
+# Set when infer_fn also returns the pooled embedding after this many score columns.
+SCORE_COLUMNS = None
+crop_heads = {}
+CLASS_NAMES = CLASS_NAMES_FALLBACK
+prediction_cache = PredictionCache(
+    PREDICTION_CACHE_PATH, max_entries=PREDICTION_CACHE_SIZE, max_disk_entries=PREDICTION_CACHE_DISK_SIZE,
+)
+model_loader = ModelLoader()
+FORWARD_LATENCY = LatencyStats()
+PREDICT_LATENCY = LatencyStats()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    'agrovision_stage_seconds', 'Time spent in each stage of the upload and prediction path.', ['stage'])
+PREDICTION_SECONDS = REGISTRY.histogram(
+    'agrovision_prediction_seconds', 'End-to-end latency of one model prediction (decode to label).')
+PREDICTION_CONFIDENCE = REGISTRY.histogram(
+    'agrovision_prediction_confidence', 'Top-1 confidence of model predictions.',
+    buckets=(0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 0.95, 0.99, 1.0))
+FORWARD_BATCH_SIZE = REGISTRY.histogram(
+    'agrovision_forward_batch_size', 'Images per model forward pass.', buckets=(1, 2, 4, 8, 16, 32, 64, 128))
+PREDICTIONS_TOTAL = REGISTRY.counter(
+    'agrovision_predictions_total', 'Predictions served, by source (model or cache).', ['source'])
+UNKNOWN_PREDICTIONS = REGISTRY.counter(
+    'agrovision_unknown_predictions_total', 'Model predictions below UNKNOWN_CONFIDENCE_THRESHOLD.')
+PREDICTION_ERRORS = REGISTRY.counter(
+    'agrovision_prediction_errors_total', 'Failed predictions or uploads, by where they failed.', ['where'])
 
 
-def run_prediction(image_path):
+_batcher = None
+_batcher_lock = threading.Lock()
+
+
+def _get_batcher():
+    # Created on first use so the scheduler thread is started in the serving
+    # process, not in a parent that a prefork server later forks from.
+    global _batcher
+    if _batcher is None:
+        with _batcher_lock:
+            if _batcher is None:
+                _batcher = MicroBatcher(
+                    _forward,
+                    max_batch_size=PREDICT_MAX_BATCH,
+                    max_wait_ms=PREDICT_BATCH_WINDOW_MS,
+                )
+    return _batcher
+
+
+def _preprocess(image_source):
+    """Decode a path, file object or raw bytes into a uint8 HxWx3 array."""
+    if isinstance(image_source, (bytes, bytearray, memoryview)):
+        image_source = io.BytesIO(image_source)
+    with STAGE_SECONDS.time(stage='decode'):
+        img = PILImage.open(image_source)
+        # For JPEGs, let libjpeg decode at the smallest 1/2, 1/4 or 1/8 scale that
+        # still covers the target size instead of decoding all 12MP and resizing.
+        img.draft('RGB', IMAGE_SIZE)
+        img = img.convert('RGB')
+    with STAGE_SECONDS.time(stage='resize'):
+        img = img.resize(IMAGE_SIZE)
+    with STAGE_SECONDS.time(stage='to_array'):
+        return np.asarray(img, dtype=np.uint8)
+
+
+def _forward(batch):
+    start = time.perf_counter()
+    # Remote workers take the uint8 batch as-is (4x less data on the socket).
+    prediction = np.asarray(infer_fn(batch if INFERENCE_BACKEND == 'remote' else batch.astype(np.float32)))
+    elapsed = time.perf_counter() - start
+    FORWARD_LATENCY.record(elapsed * 1000)
+    STAGE_SECONDS.observe(elapsed, stage='forward')
+    FORWARD_BATCH_SIZE.observe(batch.shape[0])
+    if prediction.ndim == 1:
+        prediction = prediction.reshape(batch.shape[0], -1)
+    return prediction
+
+
+def _tta_views(arrays, mode=TTA_MODE):
+    """(n, H, W, C) -> (n * views, H, W, C), the views of each image adjacent."""
+    views = [arrays, arrays[:, :, ::-1]]
+    if mode == 'flip_crop':
+        # Centre crop scaled back up with nearest-neighbour index arrays, so
+        # the whole batch is zoomed in one gather without PIL round trips.
+        height, width = arrays.shape[1:3]
+        rows = ((height - height * TTA_CROP_FRACTION) / 2 + np.arange(height) * TTA_CROP_FRACTION).astype(np.intp)
+        cols = ((width - width * TTA_CROP_FRACTION) / 2 + np.arange(width) * TTA_CROP_FRACTION).astype(np.intp)
+        zoomed = arrays[:, rows][:, :, cols]
+        views += [zoomed, zoomed[:, :, ::-1]]
+    return np.stack(views, axis=1).reshape((-1,) + arrays.shape[1:])
+
+def _average_views(batcher, arrays, tta, tta_mode):
+    if not tta:
+        return batcher.submit(arrays)
+    outputs = batcher.submit(_tta_views(arrays, tta_mode))
+    return outputs.reshape(arrays.shape[0], -1, outputs.shape[-1]).mean(axis=1)
+
+def _split_outputs(outputs):
+    """Forward-pass rows -> (scores, embeddings or None)."""
+    if SCORE_COLUMNS is None:
+        return outputs, None
+    return outputs[:, :SCORE_COLUMNS], outputs[:, SCORE_COLUMNS:]
+
+def _predict_scores(arrays, tta=False, tta_mode=TTA_MODE, crop=None, digests=None):
+    """Model scores for a uint8 (n, H, W, C) batch, averaged over TTA views
+    and, with a crop hint, restricted to that crop's classes."""
+    if crop and _uses_crop_head(crop):
+        return _crop_head_scores(arrays, crop, tta, tta_mode, digests)
+    scores, embeddings = _split_outputs(_average_views(_get_batcher(), arrays, tta, tta_mode))
+    if embeddings is not None and digests:
+        _remember_embeddings([(digest, tta and tta_mode) for digest in digests], embeddings)
+    return _restrict_to_crop(scores, crop) if crop else scores
+
+def crop_of(label):
+    return label.split('_', 1)[0].lower()
+
+def available_crops():
+    return sorted({crop_of(name) for name in CLASS_NAMES})
+
+def _restrict_to_crop(scores, crop):
+    probabilities = _as_probabilities(np.asarray(scores, dtype=np.float32).reshape(len(scores), -1))
+    keep = [i for i, name in enumerate(_label_options(probabilities.shape[1])) if crop_of(name) == crop]
+    if not keep:
+        return probabilities
+    # Mask in log space: off-crop classes get -inf and the rest go through a
+    # softmax, which is what masking the logits would give.
+    with np.errstate(divide='ignore'):
+        log_probabilities = np.log(probabilities.astype(np.float64))
+    masked = np.full_like(log_probabilities, -np.inf)
+    masked[:, keep] = log_probabilities[:, keep]
+    row_max = masked.max(axis=1, keepdims=True)
+    # Every in-crop probability underflowed to 0: the model says nothing about
+    # this crop, so spread the mass evenly over its classes instead.
+    underflowed = ~np.isfinite(row_max[:, 0])
+    if underflowed.any():
+        masked[np.ix_(underflowed, keep)] = 0.0
+        row_max[underflowed] = 0.0
+    exp = np.exp(masked - row_max)
+    return (exp / exp.sum(axis=1, keepdims=True)).astype(np.float32)
+
+def _uses_crop_head(crop):
+    return CROP_INFERENCE_MODE == 'heads' and SCORE_COLUMNS is not None and crop in crop_heads
+
+_embedding_cache = OrderedDict()
+_embedding_cache_lock = threading.Lock()
+
+def _remember_embeddings(keys, embeddings):
+    if not EMBEDDING_CACHE_SIZE:
+        return
+    with _embedding_cache_lock:
+        for key, row in zip(keys, embeddings):
+            _embedding_cache[key] = row
+            _embedding_cache.move_to_end(key)
+        while len(_embedding_cache) > EMBEDDING_CACHE_SIZE:
+            _embedding_cache.popitem(last=False)
+
+def _cached_embedding(digest, tta_key=False):
+    with _embedding_cache_lock:
+        row = _embedding_cache.get((digest, tta_key))
+        if row is not None:
+            _embedding_cache.move_to_end((digest, tta_key))
+        return row
+
+def _embeddings(arrays, tta, tta_mode=TTA_MODE, digests=None):
+    """Pooled embeddings for a batch, reusing ones already computed per image digest."""
+    keys = [(digest, tta and tta_mode) for digest in digests] if digests else [None] * len(arrays)
+    rows = [_cached_embedding(*key) if key is not None else None for key in keys]
+    missing = [i for i, row in enumerate(rows) if row is None]
+    if missing:
+        _, computed = _split_outputs(_average_views(_get_batcher(), arrays[missing], tta, tta_mode))
+        for i, row in zip(missing, computed):
+            rows[i] = row
+        if digests:
+            _remember_embeddings([keys[i] for i in missing], computed)
+    return np.stack(rows)
+
+def _crop_head_scores(arrays, crop, tta, tta_mode, digests=None):
+    kernel, bias, class_indices = crop_heads[crop]
+    logits = _embeddings(arrays, tta, tta_mode, digests) @ kernel + bias
+    logits -= logits.max(axis=1, keepdims=True)
+    probabilities = np.exp(logits)
+    probabilities /= probabilities.sum(axis=1, keepdims=True)
+    # Scatter into the full label space so post-processing is shared.
+    scores = np.zeros((len(arrays), len(CLASS_NAMES)), dtype=np.float32)
+    scores[:, class_indices] = probabilities
+    return scores
+
+def _as_probabilities(scores):
+    # A single sigmoid output becomes the two-class distribution [1 - p, p].
+    if scores.shape[1] == 1:
+        return np.concatenate([1.0 - scores, scores], axis=1)
+    return scores
+
+def _label_options(num_classes):
+    if len(CLASS_NAMES) == num_classes:
+        return CLASS_NAMES
+    print(f"Warning: CLASS_NAMES length ({len(CLASS_NAMES)}) does not match model outputs ({num_classes}).")
+    return [f"Class_{i}" for i in range(num_classes)]
+
+def _postprocess_batch(scores):
+    """(n, outputs) scores -> [(label, confidence)] for every row at once."""
+    probabilities = _as_probabilities(np.asarray(scores, dtype=np.float32).reshape(len(scores), -1))
+    predicted = probabilities.argmax(axis=1)
+    confidences = probabilities[np.arange(len(predicted)), predicted]
+    labels = _label_options(probabilities.shape[1])
+
+    results = []
+    for idx, confidence in zip(predicted.tolist(), confidences.tolist()):
+        PREDICTION_CONFIDENCE.observe(confidence)
+        if confidence < UNKNOWN_CONFIDENCE_THRESHOLD:
+            UNKNOWN_PREDICTIONS.inc()
+            results.append((UNKNOWN_LABEL, confidence))
+        else:
+            results.append((labels[idx], confidence))
+    return results
+
+def _postprocess(scores):
+    return _postprocess_batch(np.asarray(scores)[None])[0]
+
+def _top_k(scores, k):
+    """(n, outputs) scores -> per row, the k most likely [(label, probability)]."""
+    probabilities = _as_probabilities(np.asarray(scores, dtype=np.float32).reshape(len(scores), -1))
+    k = max(1, min(k, probabilities.shape[1]))
+    top = np.argpartition(-probabilities, k - 1, axis=1)[:, :k]
+    top_probabilities = np.take_along_axis(probabilities, top, axis=1)
+    order = np.argsort(-top_probabilities, axis=1)
+    top = np.take_along_axis(top, order, axis=1)
+    top_probabilities = np.take_along_axis(top_probabilities, order, axis=1)
+    labels = _label_options(probabilities.shape[1])
+    return [
+        [(labels[idx], prob) for idx, prob in zip(row_idx, row_prob)]
+        for row_idx, row_prob in zip(top.tolist(), top_probabilities.tolist())
+    ]
+
+def _format_top_k(ranked):
+    return [{'label': label, 'confidence': round(prob * 100, 2)} for label, prob in ranked]
+
+def run_prediction(image_source, top_k=0, tta=False, crop=None, digest=None):
+    """Predict one image; returns (label, confidence), plus the top-k list when top_k > 0."""
+    if model_loader.loading:
+        raise RuntimeError("Model is still loading.")
     if model is None:
         raise RuntimeError("Model not loaded.")
     if np is None:
         raise RuntimeError("NumPy not available.")
 
-    img = PILImage.open(image_path).convert('RGB')
-    img = img.resize((224, 224))
-    img_array = np.array(img, dtype=np.float32)
-    img_array = np.expand_dims(img_array, axis=0)
+    start = time.perf_counter()
+    img_array = np.expand_dims(_preprocess(image_source), axis=0)
+    scores = _predict_scores(img_array, tta, crop=crop, digests=[digest] if digest else None)
+    result = _postprocess(scores[0])
+    if top_k:
+        result = result + (_top_k(scores, top_k)[0],)
+    elapsed = time.perf_counter() - start
+    PREDICT_LATENCY.record(elapsed * 1000)
+    PREDICTION_SECONDS.observe(elapsed)
+    return result
 
-    prediction = model.predict(img_array, verbose=0)
-    if prediction.ndim == 1:
-        prediction = np.expand_dims(prediction, axis=0)
+def _prediction_options(values):
+    """Parse ?top_k=, ?tta= and ?crop= into (top_k, tta, crop); raises ValueError."""
+    try:
+        top_k = int(values.get('top_k', 0) or 0)
+    except ValueError:
+        raise ValueError('Invalid top_k.')
+    if not 0 <= top_k <= TOP_K_MAX:
+        raise ValueError(f'top_k must be between 0 and {TOP_K_MAX}.')
+    tta = values.get('tta', '0').lower() in ('1', 'true', 'yes')
+    crop = values.get('crop', '').strip().lower() or None
+    if crop is not None and crop not in available_crops():
+        raise ValueError(f"Unknown crop; expected one of {', '.join(available_crops())}.")
+    return top_k, tta, crop
 
-    num_outputs = prediction.shape[1] if prediction.ndim > 1 else 1
+def _cache_model_id(tta, crop=None):
+    # TTA and crop hints change the answer, so their results are cached separately.
+    if MODEL_ID is None:
+        return None
+    model_id = MODEL_ID
+    if tta:
+        model_id += f"+tta:{TTA_MODE}"
+    if crop:
+        model_id += f"+crop:{crop}" + (":head" if _uses_crop_head(crop) else "")
+    return model_id
 
-    if num_outputs == 1:
-        confidence = float(prediction[0][0])
-        predicted_idx = int(confidence > 0.5)
-        label_options = CLASS_NAMES if len(CLASS_NAMES) >= 2 else ["Class_0", "Class_1"]
-        predicted_label = label_options[predicted_idx]
-        confidence = confidence if predicted_idx == 1 else 1.0 - confidence
-    else:
-        predicted_idx = int(np.argmax(prediction[0]))
-        confidence = float(prediction[0][predicted_idx])
-        if len(CLASS_NAMES) != num_outputs:
-            print(
-                f"Warning: CLASS_NAMES length ({len(CLASS_NAMES)}) does not match model outputs ({num_outputs})."
-            )
-        label_options = CLASS_NAMES if len(CLASS_NAMES) == num_outputs else [f"Class_{i}" for i in range(num_outputs)]
-        predicted_label = label_options[predicted_idx]
+def predict_cached(image_source, digest, tta=False, crop=None):
+    """run_prediction() backed by the content-hash prediction cache."""
+    model_id = _cache_model_id(tta, crop)
+    if model_id is not None:
+        cached = prediction_cache.get(digest, model_id)
+        if cached is not None:
+            PREDICTIONS_TOTAL.inc(source='cache')
+            return cached
+
+    predicted_label, confidence = run_prediction(image_source, tta=tta, crop=crop, digest=digest)
+    PREDICTIONS_TOTAL.inc(source='model')
+    if model_id is not None:
+        prediction_cache.put(digest, model_id, predicted_label, confidence)
+    return predicted_label, confidence
 
-    final_label = predicted_label if confidence >= UNKNOWN_CONFIDENCE_THRESHOLD else UNKNOWN_LABEL
-    return final_label, confidence
+def predict_upload(image_source, digest, top_k=0, tta=False, crop=None):
+    """Returns (label, confidence, top-k list or None) for an uploaded image.
+
+    Top-k answers need the full distribution, so they skip the cache lookup
+    but still store the top-1 result.
+    """
+    if not top_k:
+        return predict_cached(image_source, digest, tta, crop) + (None,)
+    predicted_label, confidence, ranked = run_prediction(image_source, top_k=top_k, tta=tta, crop=crop, digest=digest)
+    PREDICTIONS_TOTAL.inc(source='model')
+    model_id = _cache_model_id(tta, crop)
+    if model_id is not None:
+        prediction_cache.put(digest, model_id, predicted_label, confidence)
+    return predicted_label, confidence, _format_top_k(ranked)
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+# Uploads live in a storage backend (see storage.py): sharded local folders
+# under UPLOAD_FOLDER by default, or an S3-compatible bucket.
+storage = create_storage(UPLOAD_FOLDER)
+_write_pool = ThreadPoolExecutor(max_workers=UPLOAD_WRITE_WORKERS, thread_name_prefix='upload-writer')
+_pending_writes = {}
+_pending_writes_lock = threading.Lock()
+
+def _write_file(name, data):
+    try:
+        with STAGE_SECONDS.time(stage='file_save'):
+            storage.save(name, data)
+    except Exception as exc:
+        PREDICTION_ERRORS.inc(where='file_save')
+        print(f"Failed to write upload {name}: {exc}")
+    finally:
+        with _pending_writes_lock:
+            _pending_writes.pop(name, None)
+
+def _wait_for_write(name):
+    with _pending_writes_lock:
+        future = _pending_writes.get(name)
+    if future is not None:
+        future.result()
+
+def _save_upload(file):
+    """Read an upload into memory and queue its write to storage.
+
+    Returns (filename, bytes, content hash). The bytes are used for
+    prediction directly, so the storage write stays off the request path.
+    """
+    data = file.read()
+    digest = content_hash(data)
+    return _store_upload(file.filename, data, digest), data, digest
+
+def _store_upload(original_filename, data, digest):
+    if DEDUPLICATE_UPLOADS:
+        unique_name = f"{digest}.{original_filename.rsplit('.', 1)[1].lower()}"
+    else:
+        unique_name = f"{uuid.uuid4().hex}_{secure_filename(original_filename)}"
+    with _pending_writes_lock:
+        # Only content-hash names can already exist in storage.
+        if unique_name not in _pending_writes and not (DEDUPLICATE_UPLOADS and storage.exists(unique_name)):
+            _pending_writes[unique_name] = _write_pool.submit(_write_file, unique_name, data)
+    _queue_derivatives(unique_name, data)
+    return unique_name
+
+def _remove_upload(image):
+    # Deduplicated files may back several Image rows; keep them until the last one goes.
+    if Image.query.filter(Image.filename == image.filename, Image.id != image.id).first():
+        return
+    _wait_for_write(image.filename)
+    _wait_for_derivatives(image.filename)
+    for name in [image.filename] + [_derivative_name(image.filename, v) for v in DERIVATIVE_SIZES]:
+        try:
+            storage.delete(name)
+        except Exception as exc:
+            print(f"Failed to delete stored file {name}: {exc}")
+
+_derivative_pool = ThreadPoolExecutor(max_workers=DERIVATIVE_WORKERS, thread_name_prefix='derivative-writer')
+_pending_derivatives = {}
+
+def _derivative_name(filename, variant):
+    return f"{filename.rsplit('.', 1)[0]}.{variant}.webp"
+
+def _write_derivatives(filename, data=None):
+    """Write every missing WebP variant of an upload, decoding it once."""
+    try:
+        missing = [v for v in DERIVATIVE_SIZES if not storage.exists(_derivative_name(filename, v))]
+        if not missing:
+            return
+        with STAGE_SECONDS.time(stage='derivatives'):
+            source = io.BytesIO(data) if data is not None else storage.open(filename)
+            with source, PILImage.open(source) as img:
+                largest = max(DERIVATIVE_SIZES[v] for v in missing)
+                img.draft('RGB', (largest, largest))
+                # Phone photos are often stored sideways with an EXIF rotation.
+                img = ImageOps.exif_transpose(img).convert('RGB')
+                for variant in sorted(missing, key=DERIVATIVE_SIZES.get, reverse=True):
+                    size = DERIVATIVE_SIZES[variant]
+                    img.thumbnail((size, size), PILImage.LANCZOS)
+                    encoded = io.BytesIO()
+                    img.save(encoded, 'WEBP', quality=DERIVATIVE_QUALITY, method=4)
+                    encoded.seek(0)
+                    storage.save(_derivative_name(filename, variant), encoded)
+    except Exception as exc:
+        PREDICTION_ERRORS.inc(where='derivatives')
+        print(f"Failed to write derivatives for {filename}: {exc}")
+    finally:
+        with _pending_writes_lock:
+            _pending_derivatives.pop(filename, None)
+
+def _queue_derivatives(filename, data):
+    with _pending_writes_lock:
+        if filename not in _pending_derivatives:
+            _pending_derivatives[filename] = _derivative_pool.submit(_write_derivatives, filename, data)
+
+def _wait_for_derivatives(filename):
+    with _pending_writes_lock:
+        future = _pending_derivatives.get(filename)
+    if future is not None:
+        future.result()
+
+def _image_urls(filename):
+    urls = {'image_url': f'/uploads/{filename}'}
+    for variant in DERIVATIVE_SIZES:
+        urls[f'{variant}_url'] = f'/media/{variant}/{filename}'
+    return urls
+
+def _serve_stored(name, mimetype=None):
+    try:
+        response = storage.serve(name, mimetype=mimetype, max_age=UPLOAD_CACHE_MAX_AGE)
+    except FileNotFoundError:
+        abort(404)
+    if not response.cache_control.private:
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+    return response
+
+embedding_store = EmbeddingStore(EMBEDDING_STORE_PATH) if EmbeddingStore is not None else None
+_embedding_pool = ThreadPoolExecutor(max_workers=max(1, EMBEDDING_WORKERS), thread_name_prefix='embedding-writer')
+
+def _embedding_for(filename, digest, data=None):
+    """Un-augmented embedding of an upload, computed if no forward pass has cached it."""
+    vector = _cached_embedding(digest)
+    if vector is None:
+        if data is None:
+            _wait_for_write(filename)
+            with storage.open(filename) as fh:
+                data = fh.read()
+        vector = _embeddings(_preprocess(data)[None], False, digests=[digest])[0]
+    return vector
+
+def _store_embedding(image_id, user_id, filename, digest, data):
+    try:
+        if embedding_store.find(image_id) is not None:
+            return
+        embedding_store.add(image_id, user_id, _embedding_for(filename, digest, data))
+    except Exception as exc:
+        PREDICTION_ERRORS.inc(where='embedding')
+        print(f"Failed to store embedding for image {image_id}: {exc}")
+
+def _queue_embedding(image_id, user_id, filename, digest, data=None):
+    # Off the request path; the embedding is usually already cached by the
+    # prediction's forward pass, so this is just an append.
+    if embedding_store is not None and SCORE_COLUMNS is not None:
+        _embedding_pool.submit(_store_embedding, image_id, user_id, filename, digest, data)
+
+_app = None
+
+@image_bp.record_once
+def _remember_app(state):
+    # The model loader thread needs an app context to walk the image table.
+    global _app
+    _app = state.app
+
+def _bind_embedding_store(model_id):
+    if embedding_store.bind_model(model_id):
+        print(f"Embedding store held vectors from another model; re-embedding uploads for {model_id}")
+    if _app is not None:
+        # Also picks up uploads from before the store existed or from an
+        # interrupted backfill; images already stored are skipped.
+        _embedding_pool.submit(_backfill_embeddings, _app)
+
+def _backfill_embeddings(app):
+    os.makedirs(EMBEDDING_STORE_PATH, exist_ok=True)
+    lock = open(os.path.join(EMBEDDING_STORE_PATH, '.backfill.lock'), 'a')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock.close()
+        return  # another process is already on it
+    added = 0
+    try:
+        with app.app_context():
+            last_id = 0
+            while True:
+                rows = Image.query.filter(Image.id > last_id).order_by(Image.id).limit(EMBEDDING_BACKFILL_CHUNK).all()
+                if not rows:
+                    break
+                last_id = rows[-1].id
+                for row in rows:
+                    if embedding_store.find(row.id) is not None:
+                        continue
+                    try:
+                        with storage.open(row.filename) as fh:
+                            data = fh.read()
+                        embedding_store.add(row.id, row.user_id, _embedding_for(row.filename, content_hash(data), data))
+                        added += 1
+                    except Exception as exc:
+                        PREDICTION_ERRORS.inc(where='embedding')
+                        print(f"Failed to backfill embedding for image {row.id}: {exc}")
+                db.session.remove()
+    finally:
+        lock.close()
+    if added:
+        print(f"Backfilled {added} image embeddings")
+
+def _remove_embedding(image_id):
+    if embedding_store is not None:
+        try:
+            embedding_store.remove(image_id)
+        except Exception as exc:
+            print(f"Failed to remove embedding for image {image_id}: {exc}")
+
 @image_bp.route('/<lang>/upload', methods=['GET', 'POST'])
 def upload_image(lang):
     if lang not in ['az', 'en']:
@@ -147,12 +1013,14 @@ def upload_image(lang):
             'no_image': 'Şəkil seçilməyib.',
             'no_file': 'Fayl seçilməyib.',
             'wrong_format': 'Yalnız png, jpg, jpeg və gif formatları qəbul olunur.',
+            'warming_up': 'Model hələ yüklənir. Zəhmət olmasa bir az sonra yenidən cəhd edin.',
             'success': 'Şəkil uğurla yükləndi.'
         },
         'en': {
             'no_image': 'No image selected.',
             'no_file': 'No file selected.',
             'wrong_format': 'Only png, jpg, jpeg and gif files are allowed.',
+            'warming_up': 'The model is still warming up. Please try again in a moment.',
             'success': 'Image successfully uploaded.'
         }
     }
@@ -160,32 +1028,41 @@ def upload_image(lang):
     msg = messages[lang]
 
     if request.method == 'POST':
-        if 'image' not in request.files:
+        with STAGE_SECONDS.time(stage='request_parse'):
+            files = request.files
+        if 'image' not in files:
             flash(msg['no_image'])
             return redirect(request.url)
 
+        if not model_loader.wait(MODEL_READY_TIMEOUT):
+            flash(msg['warming_up'])
+            return redirect(request.url)
+
         file = request.files['image']
         if file.filename == '':
             flash(msg['no_file'])
             return redirect(request.url)
 
         if file and allowed_file(file.filename):
-            original_filename = secure_filename(file.filename)
-            unique_name = f"{uuid.uuid4().hex}_{original_filename}"
-            upload_path = os.path.join(UPLOAD_FOLDER, unique_name)
-            os.makedirs(UPLOAD_FOLDER, exist_ok=True)
-            file.save(upload_path)
-
-            # Save record in DB
-            new_image = Image(filename=unique_name, user_id=user_id)
-            db.session.add(new_image)
-            db.session.commit()
+            unique_name, data, digest = _save_upload(file)
 
+            error = None
             try:
-                predicted_label, confidence = run_prediction(upload_path)
+                predicted_label, confidence = predict_cached(data, digest)
             except Exception as e:
-                flash(f"Error during prediction: {str(e)}", "danger")
+                PREDICTION_ERRORS.inc(where='upload')
+                error = str(e)
+                predicted_label, confidence = f"Error: {error}", 0.0
+
+            # Save record in DB with its outcome, so /api/jobs never sees it as pending
+            new_image = Image(filename=unique_name, user_id=user_id, prediction=predicted_label)
+            db.session.add(new_image)
+            with STAGE_SECONDS.time(stage='db_commit'):
+                db.session.commit()
+            if error is not None:
+                flash(f"Error during prediction: {error}", "danger")
                 return redirect(request.url)
+            _queue_embedding(new_image.id, user_id, unique_name, digest, data)
 
             flash(msg['success'])
             return render_template(
@@ -201,6 +1078,64 @@ def upload_image(lang):
 
     return render_template(f"{lang}/upload.html", filename=None, lang=lang)
 
+def _encode_cursor(created_at, image_id):
+    return base64.urlsafe_b64encode(f"{created_at.isoformat()}|{image_id}".encode()).decode().rstrip('=')
+
+def _decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        created_at, image_id = raw.rsplit('|', 1)
+        return datetime.fromisoformat(created_at), int(image_id)
+    except Exception:
+        raise ValueError('Invalid cursor.')
+
+def _parse_datetime_arg(args, name):
+    value = args.get(name)
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f'Invalid {name}; expected an ISO 8601 date or datetime.')
+
+def _history_page(user_id, args):
+    """One page of a user's images, newest first, using keyset pagination.
+
+    Reads ``limit``, ``cursor``, ``prediction``, ``since`` and ``until`` from
+    ``args``. Only the needed columns are selected, so no ORM objects are
+    built. Returns (rows, next_cursor) and raises ValueError for bad arguments.
+    """
+    try:
+        limit = int(args.get('limit', HISTORY_PAGE_SIZE))
+    except ValueError:
+        raise ValueError('Invalid limit.')
+    limit = max(1, min(limit, HISTORY_MAX_PAGE_SIZE))
+
+    query = db.session.query(Image.id, Image.filename, Image.prediction, Image.created_at).filter(
+        Image.user_id == user_id
+    )
+    if args.get('prediction'):
+        query = query.filter(Image.prediction == args['prediction'])
+    since = _parse_datetime_arg(args, 'since')
+    if since is not None:
+        query = query.filter(Image.created_at >= since)
+    until = _parse_datetime_arg(args, 'until')
+    if until is not None:
+        query = query.filter(Image.created_at < until)
+    if args.get('cursor'):
+        created_at, image_id = _decode_cursor(args['cursor'])
+        query = query.filter(or_(
+            Image.created_at < created_at,
+            and_(Image.created_at == created_at, Image.id < image_id),
+        ))
+
+    rows = query.order_by(Image.created_at.desc(), Image.id.desc()).limit(limit + 1).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = _encode_cursor(rows[-1].created_at, rows[-1].id)
+    return rows, next_cursor
+
 @image_bp.route('/<lang>/my_images')
 def my_images(lang):
     if lang not in ['az', 'en']:
@@ -211,8 +1146,11 @@ def my_images(lang):
         flash("Please log in to see your images.")
         return redirect(url_for('login', lang=lang))
 
-    user = User.query.get(user_id)
-    return render_template(f"{lang}/my_images.html", images=user.images, lang=lang)
+    try:
+        images, next_cursor = _history_page(user_id, request.args)
+    except ValueError:
+        abort(400)
+    return render_template(f"{lang}/my_images.html", images=images, next_cursor=next_cursor, lang=lang)
 
 @image_bp.route('/<lang>/delete/<filename>', methods=['POST'])
 def delete_image(lang, filename):
@@ -228,9 +1166,8 @@ def delete_image(lang, filename):
     if not image:
         abort(403)
 
-    file_path = os.path.join(UPLOAD_FOLDER, filename)
-    if os.path.exists(file_path):
-        os.remove(file_path)
+    _remove_upload(image)
+    _remove_embedding(image.id)
 
     db.session.delete(image)
     db.session.commit()
@@ -249,7 +1186,100 @@ def display_image(filename):
     if not image:
         abort(403)
 
-    return redirect(url_for('static', filename='uploads/' + filename), code=301)
+    return redirect(url_for('image.uploaded_file', filename=filename), code=301)
+
+@image_bp.route('/uploads/<filename>')
+def uploaded_file(filename):
+    if secure_filename(filename) != filename:
+        abort(404)
+    _wait_for_write(filename)
+    return _serve_stored(filename)
+
+@image_bp.route('/media/<variant>/<filename>')
+def media(variant, filename):
+    if variant not in DERIVATIVE_SIZES or secure_filename(filename) != filename:
+        abort(404)
+    name = _derivative_name(filename, variant)
+    _wait_for_derivatives(filename)
+    if not storage.exists(name):
+        # An upload from before derivatives existed.
+        _wait_for_write(filename)
+        if not storage.exists(filename):
+            abort(404)
+        _queue_derivatives(filename, None)
+        _wait_for_derivatives(filename)
+    return _serve_stored(name, mimetype='image/webp')
+
+_job_queue = None
+_job_queue_lock = threading.Lock()
+
+def _get_job_queue():
+    # Started lazily for the same fork-safety reason as the micro-batcher.
+    global _job_queue
+    if _job_queue is None:
+        with _job_queue_lock:
+            if _job_queue is None:
+                _job_queue = JobQueue(_run_prediction_job, workers=PREDICTION_WORKERS, name='prediction-worker')
+    return _job_queue
+
+def _run_prediction_job(payload):
+    model_loader.wait(JOB_MODEL_WAIT_TIMEOUT)
+    try:
+        predicted_label, confidence, top = predict_upload(
+            payload['data'], payload['digest'], payload.get('top_k', 0), payload.get('tta', False), payload.get('crop'))
+    except Exception as e:
+        PREDICTION_ERRORS.inc(where='job')
+        print(f"Error during prediction: {str(e)}")
+        predicted_label, confidence, top = f"Error: {str(e)}", 0.0, None
+
+    with payload['app'].app_context():
+        image = db.session.get(Image, payload['image_id'])
+        if image is not None:
+            image.prediction = predicted_label
+            with STAGE_SECONDS.time(stage='db_commit'):
+                db.session.commit()
+            _queue_embedding(image.id, image.user_id, image.filename, payload['digest'], payload['data'])
+
+    result = {'prediction': predicted_label, 'confidence': round(confidence * 100, 2)}
+    if top is not None:
+        result['top_k'] = top
+    return result
+
+def _wants_async():
+    value = request.args.get('async', request.form.get('async'))
+    if value is None:
+        return ASYNC_PREDICTIONS
+    return value.lower() in ('1', 'true', 'yes')
+
+def _job_status(job_id, user_id):
+    """Status of a prediction job, or None if the user has no such job."""
+    job = _job_queue.get(job_id) if _job_queue is not None else None
+    if job is not None:
+        if job['owner'] != user_id:
+            return None
+        body = {'job_id': job['id'], 'status': job['status']}
+        if job['result'] is not None:
+            body.update(job['result'])
+        if job['error']:
+            body['message'] = job['error']
+        if job['started_at']:
+            body['wait_ms'] = round((job['started_at'] - job['enqueued_at']) * 1000, 3)
+        return body
+
+    # Jobs live in the memory of the worker process that accepted the upload;
+    # any other process answers from the Image row the job fills in.
+    if not str(job_id).isdigit():
+        return None
+    image = Image.query.filter_by(id=int(job_id), user_id=user_id).first()
+    if image is None:
+        return None
+    if image.prediction is None:
+        created_at = image.created_at or datetime.utcnow()
+        if (datetime.utcnow() - created_at).total_seconds() > JOB_ORPHAN_AFTER:
+            # Never had a job, or its process died before finishing it.
+            return None
+        return {'job_id': str(job_id), 'status': 'pending'}
+    return {'job_id': str(job_id), 'status': 'done', 'prediction': image.prediction}
 
 # API Routes for Frontend SPA
 @image_bp.route('/api/upload', methods=['POST'])
@@ -258,62 +1288,489 @@ def api_upload_image():
     if not user_id:
         return jsonify({'success': False, 'message': 'You must be logged in to upload.'}), 401
 
-    if 'image' not in request.files:
+    with STAGE_SECONDS.time(stage='request_parse'):
+        files = request.files
+    if 'image' not in files:
         return jsonify({'success': False, 'message': 'No image selected.'}), 400
 
     file = request.files['image']
     if file.filename == '':
         return jsonify({'success': False, 'message': 'No file selected.'}), 400
 
+    try:
+        top_k, tta, crop = _prediction_options(request.values)
+    except ValueError as exc:
+        return jsonify({'success': False, 'message': str(exc)}), 400
+
+    if file and allowed_file(file.filename) and _wants_async():
+        # Queued jobs wait for the model themselves, so no warm-up check here.
+        unique_name, data, digest = _save_upload(file)
+        new_image = Image(filename=unique_name, user_id=user_id)
+        db.session.add(new_image)
+        with STAGE_SECONDS.time(stage='db_commit'):
+            db.session.commit()
+
+        job_id = _get_job_queue().submit(
+            {'app': current_app._get_current_object(), 'image_id': new_image.id, 'data': data, 'digest': digest,
+             'top_k': top_k, 'tta': tta, 'crop': crop},
+            job_id=new_image.id,
+            owner=user_id,
+        )
+        return jsonify({
+            'success': True,
+            'message': 'Image uploaded; prediction queued.',
+            'job_id': job_id,
+            'status': 'queued',
+            'status_url': f'/api/jobs/{job_id}',
+            'events_url': f'/api/jobs/{job_id}/events',
+            'filename': unique_name,
+            **_image_urls(unique_name),
+        }), 202
+
+    if not model_loader.wait(MODEL_READY_TIMEOUT):
+        response = jsonify({
+            'success': False,
+            'warming_up': True,
+            'message': 'The model is still warming up. Please try again in a moment.',
+        })
+        response.headers['Retry-After'] = '5'
+        return response, 503
+
     if file and allowed_file(file.filename):
-        original_filename = secure_filename(file.filename)
-        unique_name = f"{uuid.uuid4().hex}_{original_filename}"
-        upload_path = os.path.join(UPLOAD_FOLDER, unique_name)
-        os.makedirs(UPLOAD_FOLDER, exist_ok=True)
-        file.save(upload_path)
+        unique_name, data, digest = _save_upload(file)
 
         # Predict using the model
         try:
-            predicted_label, confidence = run_prediction(upload_path)
+            predicted_label, confidence, top = predict_upload(data, digest, top_k, tta, crop)
         except Exception as e:
+            PREDICTION_ERRORS.inc(where='upload')
             print(f"Error during prediction: {str(e)}")
-            predicted_label = f"Error: {str(e)}"
-            confidence = 0.0
+            predicted_label, confidence, top = f"Error: {str(e)}", 0.0, None
 
         # Save record in DB
         new_image = Image(filename=unique_name, user_id=user_id, prediction=predicted_label)
         db.session.add(new_image)
-        db.session.commit()
+        with STAGE_SECONDS.time(stage='db_commit'):
+            db.session.commit()
+        _queue_embedding(new_image.id, user_id, unique_name, digest, data)
 
-        return jsonify({
+        body = {
             'success': True,
             'message': 'Image successfully uploaded.',
             'filename': unique_name,
             'prediction': predicted_label,
             'confidence': round(confidence * 100, 2),
-            'image_url': f'/static/uploads/{unique_name}'
-        }), 200
+            **_image_urls(unique_name),
+        }
+        if top is not None:
+            body['top_k'] = top
+        return jsonify(body), 200
 
     return jsonify({'success': False, 'message': 'Only png, jpg, jpeg and gif files are allowed.'}), 400
 
+@image_bp.route('/api/jobs/<job_id>', methods=['GET'])
+def api_job_status(job_id):
+    user_id = session.get('user_id')
+    if not user_id:
+        return jsonify({'success': False, 'message': 'Please log in.'}), 401
+
+    body = _job_status(job_id, user_id)
+    if body is None:
+        return jsonify({'success': False, 'message': 'Job not found.'}), 404
+    return jsonify({'success': True, **body}), 200
+
+@image_bp.route('/api/jobs/<job_id>/events', methods=['GET'])
+def api_job_events(job_id):
+    user_id = session.get('user_id')
+    if not user_id:
+        return jsonify({'success': False, 'message': 'Please log in.'}), 401
+
+    body = _job_status(job_id, user_id)
+    if body is None:
+        return jsonify({'success': False, 'message': 'Job not found.'}), 404
+
+    def generate():
+        current = body
+        yield f"event: status\ndata: {json.dumps(current)}\n\n"
+        deadline = time.monotonic() + JOB_EVENTS_TIMEOUT
+        while current['status'] not in ('done', 'failed') and time.monotonic() < deadline:
+            if _job_queue is not None and _job_queue.get(job_id) is not None:
+                _job_queue.wait(job_id, since_status=current['status'], timeout=15)
+            else:
+                time.sleep(1)
+            latest = _job_status(job_id, user_id)
+            if latest is None:
+                yield f"event: status\ndata: {json.dumps({'job_id': str(job_id), 'status': 'unknown'})}\n\n"
+                break
+            if latest['status'] == current['status']:
+                yield ": keep-alive\n\n"
+                continue
+            current = latest
+            yield f"event: status\ndata: {json.dumps(current)}\n\n"
+
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+_decode_pool = ThreadPoolExecutor(max_workers=BATCH_DECODE_WORKERS, thread_name_prefix='batch-decode')
+
+def _iter_batch_uploads(images, archives):
+    """Yield (original filename, bytes) for every image in a batch request.
+
+    Images come from repeated ``images`` fields and/or ``archive`` zip files.
+    """
+    for file in images:
+        if file.filename:
+            yield file.filename, file.read()
+    for archive in archives:
+        try:
+            with zipfile.ZipFile(archive.stream) as zf:
+                for info in zf.infolist():
+                    if info.is_dir() or os.path.basename(info.filename).startswith('.'):
+                        continue
+                    name = os.path.basename(info.filename)
+                    if not allowed_file(name) or info.file_size > MAX_IMAGE_BYTES:
+                        yield name, None
+                        continue
+                    try:
+                        data = zf.read(info)
+                    except (RuntimeError, NotImplementedError, zipfile.BadZipFile, zlib.error):
+                        # Encrypted, unsupported or corrupt entry; skip just this one.
+                        data = None
+                    yield name, data
+        except zipfile.BadZipFile:
+            yield archive.filename, None
+
+def _prepare_batch_item(index, name, data, top_k=0, tta=False, crop=None):
+    """Decode one batch image on the decode pool; never raises."""
+    item = {'index': index, 'filename': name}
+    if not allowed_file(name):
+        item['error'] = 'Only png, jpg, jpeg and gif files are allowed.'
+        return item
+    if data is None:
+        item['error'] = 'Could not read this file (too large, encrypted or corrupt).'
+        return item
+    try:
+        item['array'] = _preprocess(data)
+    except Exception as exc:
+        PREDICTION_ERRORS.inc(where='batch_decode')
+        item['error'] = f"Could not decode image: {exc}"
+        return item
+
+    item['digest'] = content_hash(data)
+    item['stored_as'] = _store_upload(name, data, item['digest'])
+    model_id = _cache_model_id(tta, crop)
+    if model_id is not None and not top_k:
+        cached = prediction_cache.get(item['digest'], model_id)
+        if cached is not None:
+            PREDICTIONS_TOTAL.inc(source='cache')
+            item['result'] = cached
+            item['cached'] = True
+            del item['array']
+    return item
+
+def _predict_batch_items(items, top_k=0, tta=False, crop=None):
+    """Run decoded batch items through the model in one submission."""
+    model_id = _cache_model_id(tta, crop)
+    try:
+        if model is None:
+            raise RuntimeError("Model not loaded.")
+        arrays = np.stack([item.pop('array') for item in items])
+        scores = _predict_scores(arrays, tta, crop=crop, digests=[item['digest'] for item in items])
+    except Exception as exc:
+        PREDICTION_ERRORS.inc(amount=len(items), where='batch')
+        print(f"Error during batch prediction: {exc}")
+        for item in items:
+            item.pop('array', None)
+            item['result'] = (f"Error: {exc}", 0.0)
+        return items
+
+    PREDICTIONS_TOTAL.inc(amount=len(items), source='model')
+    ranked = _top_k(scores, top_k) if top_k else [None] * len(items)
+    for item, result, top in zip(items, _postprocess_batch(scores), ranked):
+        item['result'] = result
+        if top is not None:
+            item['top_k'] = _format_top_k(top)
+        if model_id is not None:
+            prediction_cache.put(item['digest'], model_id, *result)
+    return items
+
+def _batch_result_line(item):
+    if 'error' in item:
+        body = {'index': item['index'], 'filename': item['filename'], 'success': False, 'message': item['error']}
+    else:
+        predicted_label, confidence = item['result']
+        body = {
+            'index': item['index'],
+            'filename': item['filename'],
+            'success': True,
+            'stored_as': item['stored_as'],
+            'prediction': predicted_label,
+            'confidence': round(confidence * 100, 2),
+            'cached': item.get('cached', False),
+            **_image_urls(item['stored_as']),
+        }
+        if 'top_k' in item:
+            body['top_k'] = item['top_k']
+    return json.dumps(body) + '\n'
+
+@image_bp.route('/api/upload/batch', methods=['POST'])
+def api_upload_batch():
+    user_id = session.get('user_id')
+    if not user_id:
+        return jsonify({'success': False, 'message': 'You must be logged in to upload.'}), 401
+
+    request.max_content_length = BATCH_UPLOAD_MAX_BYTES
+    images = request.files.getlist('images')
+    archives = request.files.getlist('archive')
+    if not images and not archives:
+        return jsonify({'success': False, 'message': 'No images selected.'}), 400
+    try:
+        top_k, tta, crop = _prediction_options(request.values)
+    except ValueError as exc:
+        return jsonify({'success': False, 'message': str(exc)}), 400
+
+    if not model_loader.wait(MODEL_READY_TIMEOUT):
+        response = jsonify({
+            'success': False,
+            'warming_up': True,
+            'message': 'The model is still warming up. Please try again in a moment.',
+        })
+        response.headers['Retry-After'] = '5'
+        return response, 503
+    if np is None:
+        return jsonify({'success': False, 'message': 'NumPy not available.'}), 503
+
+    def generate():
+        try:
+            yield from process()
+        finally:
+            for file in images + archives:
+                file.close()
+
+    def process():
+        rows = []
+        digests = []
+        ready = []
+        in_flight = set()
+        max_in_flight = max(BATCH_PREDICT_SIZE, BATCH_DECODE_WORKERS) * 2
+        total = 0
+
+        def finish(items):
+            for item in items:
+                if 'error' not in item:
+                    rows.append(Image(filename=item['stored_as'], user_id=user_id, prediction=item['result'][0]))
+                    digests.append(item['digest'])
+                yield _batch_result_line(item)
+
+        def drain(return_when):
+            done, _ = wait(in_flight, return_when=return_when)
+            for future in done:
+                in_flight.discard(future)
+                item = future.result()
+                if 'array' in item:
+                    ready.append(item)
+                else:
+                    yield from finish([item])
+            while len(ready) >= BATCH_PREDICT_SIZE or (ready and not in_flight):
+                chunk = ready[:BATCH_PREDICT_SIZE]
+                del ready[:BATCH_PREDICT_SIZE]
+                yield from finish(_predict_batch_items(chunk, top_k, tta, crop))
+
+        for name, data in _iter_batch_uploads(images, archives):
+            if total >= BATCH_UPLOAD_MAX_IMAGES:
+                yield json.dumps({
+                    'index': total,
+                    'filename': name,
+                    'success': False,
+                    'message': f'Batch limit of {BATCH_UPLOAD_MAX_IMAGES} images reached; remaining files were skipped.',
+                }) + '\n'
+                break
+            in_flight.add(_decode_pool.submit(_prepare_batch_item, total, name, data, top_k, tta, crop))
+            total += 1
+            if len(in_flight) >= max_in_flight:
+                yield from drain(FIRST_COMPLETED)
+        while in_flight or ready:
+            yield from drain(FIRST_COMPLETED)
+
+        # All rows for the batch land in a single transaction.
+        summary = {'done': True, 'total': total, 'saved': len(rows), 'failed': total - len(rows)}
+        try:
+            db.session.add_all(rows)
+            with STAGE_SECONDS.time(stage='db_commit'):
+                db.session.commit()
+            summary['success'] = True
+            for row, digest in zip(rows, digests):
+                _queue_embedding(row.id, user_id, row.filename, digest)
+        except Exception as exc:
+            PREDICTION_ERRORS.inc(where='batch_commit')
+            db.session.rollback()
+            print(f"Error saving batch upload: {exc}")
+            # No rows point at the stored files now, so drop them too.
+            for row in rows:
+                _remove_upload(row)
+            summary.update(success=False, saved=0, message='Could not save batch results.')
+        yield json.dumps(summary) + '\n'
+
+    # The uploads are read while the response streams, after Flask would
+    # normally have closed them; generate() closes them when it finishes.
+    request.keep_files_open = True
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+@REGISTRY.collector
+def _inference_gauges():
+    yield 'agrovision_model_ready', 'gauge', 'Whether a model is loaded and serving (1) or not (0).', int(model_loader.status == 'ready')
+    if _batcher is not None:
+        batching = _batcher.stats()
+        yield 'agrovision_batcher_pending', 'gauge', 'Requests waiting for the micro-batcher.', batching['pending']
+    cache = prediction_cache.stats()
+    yield 'agrovision_cache_memory_entries', 'gauge', 'Entries in the in-memory prediction cache.', cache['memory_entries']
+    yield 'agrovision_cache_memory_hits_total', 'counter', 'Prediction cache hits served from memory.', cache['memory_hits']
+    yield 'agrovision_cache_disk_hits_total', 'counter', 'Prediction cache hits served from SQLite.', cache['disk_hits']
+    yield 'agrovision_cache_misses_total', 'counter', 'Prediction cache misses.', cache['misses']
+    yield 'agrovision_cache_evictions_total', 'counter', 'Entries evicted from the in-memory prediction cache.', cache['evictions']
+    yield 'agrovision_cache_disk_evictions_total', 'counter', 'Rows evicted from the SQLite prediction cache.', cache['disk_evictions']
+    if _job_queue is not None:
+        jobs = _job_queue.stats()
+        yield 'agrovision_job_queue_depth', 'gauge', 'Prediction jobs waiting for a worker.', jobs['depth']
+        yield 'agrovision_job_workers_busy', 'gauge', 'Prediction workers currently running a job.', jobs['busy_workers']
+        yield 'agrovision_job_worker_utilization', 'gauge', 'Fraction of worker time spent running jobs since start.', jobs['utilization']
+        yield 'agrovision_job_wait_seconds_avg', 'gauge', 'Average time jobs spent queued.', jobs['avg_wait_ms'] / 1000
+
+@image_bp.route('/api/inference-stats', methods=['GET'])
+def api_inference_stats():
+    stats = {
+        'model': model_loader.snapshot(),
+        'forward': FORWARD_LATENCY.snapshot(),
+        'predict': PREDICT_LATENCY.snapshot(),
+    }
+    if _batcher is not None:
+        stats['batching'] = _batcher.stats()
+    stats['cache'] = prediction_cache.stats()
+    if _job_queue is not None:
+        stats['jobs'] = _job_queue.stats()
+    if isinstance(model, TFLiteModel):
+        stats['accuracy_drift'] = model.drift
+    stats['crops'] = {'mode': CROP_INFERENCE_MODE, 'available': available_crops(), 'heads': sorted(crop_heads)}
+    if embedding_store is not None:
+        stats['embeddings'] = embedding_store.stats()
+    return jsonify({'success': True, 'stats': stats}), 200
+
 @image_bp.route('/api/my-images', methods=['GET'])
 def api_my_images():
     user_id = session.get('user_id')
     if not user_id:
         return jsonify({'success': False, 'message': 'Please log in to see your images.'}), 401
 
-    user = User.query.get(user_id)
-    images = []
-    for img in user.images:
-        images.append({
-            'id': img.id,
-            'filename': img.filename,
-            'prediction': img.prediction if hasattr(img, 'prediction') else 'Unknown',
-            'image_url': f'/static/uploads/{img.filename}',
-            'created_at': img.created_at.isoformat() if hasattr(img, 'created_at') else None
-        })
-    
-    return jsonify({'success': True, 'images': images}), 200
+    try:
+        rows, next_cursor = _history_page(user_id, request.args)
+    except ValueError as exc:
+        return jsonify({'success': False, 'message': str(exc)}), 400
+
+    images = [{
+        'id': row.id,
+        'filename': row.filename,
+        'prediction': row.prediction,
+        **_image_urls(row.filename),
+        'created_at': row.created_at.isoformat() if row.created_at else None
+    } for row in rows]
+
+    return jsonify({'success': True, 'images': images, 'next_cursor': next_cursor}), 200
+
+@image_bp.route('/api/similar/<filename>', methods=['GET'])
+def api_similar_images(filename):
+    user_id = session.get('user_id')
+    if not user_id:
+        return jsonify({'success': False, 'message': 'Please log in.'}), 401
+
+    image = Image.query.filter_by(filename=filename, user_id=user_id).first()
+    if not image:
+        return jsonify({'success': False, 'message': 'Image not found.'}), 404
+
+    scope = request.args.get('scope', 'user')
+    if scope not in ('user', 'fleet'):
+        return jsonify({'success': False, 'message': 'scope must be "user" or "fleet".'}), 400
+    try:
+        k = max(1, min(int(request.args.get('k', SIMILAR_DEFAULT_K)), SIMILAR_MAX_K))
+    except ValueError:
+        return jsonify({'success': False, 'message': 'Invalid k.'}), 400
+
+    if not model_loader.wait(MODEL_READY_TIMEOUT) or embedding_store is None or SCORE_COLUMNS is None:
+        return jsonify({'success': False, 'message': 'Image embeddings are not available.'}), 503
+
+    row = embedding_store.find(image.id)
+    if row is not None:
+        query = embedding_store.vector(row)
+    else:
+        # Uploaded before the store existed, or its write is still queued.
+        try:
+            with storage.open(image.filename) as fh:
+                data = fh.read()
+            query = _embedding_for(image.filename, content_hash(data), data)
+        except Exception as exc:
+            PREDICTION_ERRORS.inc(where='embedding')
+            return jsonify({'success': False, 'message': f'Could not embed image: {exc}'}), 500
+
+    matches = embedding_store.search(
+        query, k, user_id=user_id if scope == 'user' else None, exclude_id=image.id, nprobe=IVF_NPROBE)
+    rows = {row.id: row for row in Image.query.filter(Image.id.in_([m[0] for m in matches])).all()}
+
+    results = []
+    for image_id, owner_id, similarity in matches:
+        match = rows.get(image_id)
+        if match is None:
+            continue
+        result = {'prediction': match.prediction, 'similarity': round(similarity, 4)}
+        # Other users' uploads stay private; only their diagnosis is shared.
+        if owner_id == user_id:
+            result.update({
+                'filename': match.filename,
+                **_image_urls(match.filename),
+                'created_at': match.created_at.isoformat() if match.created_at else None,
+            })
+        results.append(result)
+
+    return jsonify({'success': True, 'filename': filename, 'scope': scope, 'similar': results}), 200
+
+@image_bp.route('/api/stats', methods=['GET'])
+def api_stats():
+    user_id = session.get('user_id')
+    if not user_id:
+        return jsonify({'success': False, 'message': 'Please log in.'}), 401
+
+    scope = request.args.get('scope', 'user')
+    if scope not in ('user', 'fleet'):
+        return jsonify({'success': False, 'message': 'scope must be "user" or "fleet".'}), 400
+    try:
+        days = max(1, min(int(request.args.get('days', STATS_DEFAULT_DAYS)), STATS_MAX_DAYS))
+    except ValueError:
+        return jsonify({'success': False, 'message': 'Invalid days.'}), 400
+    since = datetime.utcnow().date() - timedelta(days=days - 1)
+
+    # Both tables are maintained on Image insert/update/delete, so these
+    # queries touch at most (days x labels) rows whatever the history size.
+    counts = PredictionDailyCount if scope == 'user' else FleetDailyCount
+    scoped = [counts.user_id == user_id] if scope == 'user' else []
+
+    totals = dict(
+        db.session.query(counts.label, db.func.sum(counts.count)).filter(*scoped).group_by(counts.label).all()
+    )
+    daily = db.session.query(counts.day, counts.label, counts.count).filter(
+        *scoped, counts.day >= since
+    ).order_by(counts.day, counts.label).all()
+
+    total = sum(totals.values())
+    healthy = sum(count for label, count in totals.items() if 'healthy' in label.lower())
+    return jsonify({
+        'success': True,
+        'scope': scope,
+        'total': total,
+        'healthy': healthy,
+        'issues': total - healthy,
+        'by_label': totals,
+        'daily': [{'day': day.isoformat(), 'label': label, 'count': count} for day, label, count in daily],
+    }), 200
 
 @image_bp.route('/api/delete/<filename>', methods=['DELETE'])
 def api_delete_image(filename):
@@ -325,9 +1782,8 @@ def api_delete_image(filename):
     if not image:
         return jsonify({'success': False, 'message': 'Image not found.'}), 404
 
-    file_path = os.path.join(UPLOAD_FOLDER, filename)
-    if os.path.exists(file_path):
-        os.remove(file_path)
+    _remove_upload(image)
+    _remove_embedding(image.id)
 
     db.session.delete(image)
     db.session.commit()
@@ -0,0 +1,229 @@
+"""Dedicated inference worker pool.
+
+Web processes started with ``INFERENCE_BACKEND=remote`` do not load
+TensorFlow or the model. They send preprocessed uint8 image batches to a
+small pool of worker processes that each hold one copy of the model:
+
+    python inference_worker.py --workers 2
+    INFERENCE_BACKEND=remote python app.py
+
+The raw uint8 tensor goes over the socket with ``send_bytes`` from a
+memoryview, without pickling. The receiving side wraps the buffer with
+``np.frombuffer`` and makes no intermediate copy.
+
+Control messages are pickled, so only trusted peers may connect. The
+default unix socket lives in a directory only the service user can enter
+(mode 0700, socket 0600). A TCP address (host:port) additionally needs
+INFERENCE_WORKER_AUTHKEY, set to the same secret on both sides.
+"""
+import argparse
+import multiprocessing
+import os
+import stat
+import tempfile
+import threading
+import time
+from multiprocessing.connection import Client, Listener
+
+import numpy as np
+
+
+SOCKET_DIR = os.path.join(tempfile.gettempdir(), f"agrovision-{os.getuid()}")
+DEFAULT_ADDRESS = "unix:" + os.path.join(SOCKET_DIR, "inference.sock")
+AUTHKEY = os.environ.get("INFERENCE_WORKER_AUTHKEY", "").encode() or None
+CONNECT_TIMEOUT = float(os.environ.get("INFERENCE_WORKER_CONNECT_TIMEOUT", 120))
+
+
+def parse_address(address):
+    """'unix:/path' or '/path' -> socket path; 'host:port' -> (host, port)."""
+    if address.startswith("unix:"):
+        return address[len("unix:"):]
+    if address.startswith("/"):
+        return address
+    host, _, port = address.rpartition(":")
+    return (host or "127.0.0.1", int(port))
+
+
+def check_authkey(address, authkey):
+    if not isinstance(address, str) and not authkey:
+        raise RuntimeError(f"INFERENCE_WORKER_AUTHKEY must be set to use the inference worker over TCP ({address}).")
+
+
+def _private_socket_path(path):
+    """Make sure only this user can reach the socket's directory before binding in it."""
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    info = os.lstat(directory)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid():
+        raise RuntimeError(f"{directory} must be a directory owned by the inference worker's user.")
+    if info.st_mode & 0o077:
+        if directory != SOCKET_DIR:
+            raise RuntimeError(f"{directory} is accessible to other users; use a directory with mode 0700.")
+        os.chmod(directory, 0o700)
+    if os.path.lexists(path):
+        os.remove(path)
+    return path
+
+
+class RemoteModel:
+    """Client-side callable that forwards batches to the worker pool.
+
+    Each calling thread keeps its own connection; a broken connection is
+    re-established once per call before the error is surfaced.
+    """
+
+    def __init__(self, address=None, authkey=AUTHKEY, connect_timeout=CONNECT_TIMEOUT):
+        self.address = parse_address(address or DEFAULT_ADDRESS)
+        self.authkey = authkey
+        check_authkey(self.address, authkey)
+        self._local = threading.local()
+        self.info = self._connect_with_retry(connect_timeout)
+
+    def _connect_with_retry(self, timeout):
+        deadline = time.monotonic() + timeout
+        delay = 0.1
+        while True:
+            try:
+                return self._request_info()
+            except (OSError, EOFError) as exc:
+                if time.monotonic() >= deadline:
+                    raise RuntimeError(f"Inference worker at {self.address} unreachable: {exc}") from exc
+                time.sleep(delay)
+                delay = min(delay * 2, 2.0)
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = Client(self.address, authkey=self.authkey)
+            self._local.conn = conn
+        return conn
+
+    def _drop_connection(self):
+        conn = getattr(self._local, "conn", None)
+        self._local.conn = None
+        if conn is not None:
+            try:
+                conn.close()
+            except OSError:
+                pass
+
+    def _roundtrip(self, send):
+        for attempt in range(2):
+            try:
+                conn = self._connection()
+                send(conn)
+                reply = conn.recv()
+                if reply[0] == "error":
+                    raise RuntimeError(f"Inference worker error: {reply[1]}")
+                return conn, reply
+            except (OSError, EOFError):
+                self._drop_connection()
+                if attempt:
+                    raise
+
+    def _request_info(self):
+        _, reply = self._roundtrip(lambda conn: conn.send(("info",)))
+        return reply[1]
+
+    def __call__(self, batch):
+        batch = np.ascontiguousarray(batch, dtype=np.uint8)
+
+        def send(conn):
+            conn.send(("predict", batch.shape))
+            conn.send_bytes(memoryview(batch).cast("B"))
+
+        conn, reply = self._roundtrip(send)
+        _, shape, dtype = reply
+        return np.frombuffer(conn.recv_bytes(), dtype=dtype).reshape(shape)
+
+
+def _serve_connection(conn, image_routes, info):
+    with conn:
+        while True:
+            try:
+                request = conn.recv()
+            except (EOFError, OSError):
+                return
+
+            try:
+                if request[0] == "info":
+                    conn.send(("ok", info))
+                elif request[0] == "predict":
+                    batch = np.frombuffer(conn.recv_bytes(), dtype=np.uint8).reshape(request[1])
+                    # Clients only ever see class scores, never the pooled embedding.
+                    outputs = image_routes._get_batcher().submit(batch)
+                    scores = np.ascontiguousarray(image_routes._split_outputs(outputs)[0], dtype=np.float32)
+                    conn.send(("ok", scores.shape, str(scores.dtype)))
+                    conn.send_bytes(memoryview(scores).cast("B"))
+                else:
+                    conn.send(("error", f"Unknown request {request[0]!r}"))
+            except (EOFError, OSError):
+                return
+            except Exception as exc:
+                conn.send(("error", str(exc)))
+
+
+def _worker_main(listener, index):
+    # TensorFlow is imported here, after the fork, so every worker owns a
+    # clean runtime.
+    import image_routes
+
+    image_routes.model_loader.start()
+    image_routes.model_loader.wait()
+    if image_routes.model is None:
+        print(f"Inference worker {index}: no model available ({image_routes.model_loader.status}); exiting.")
+        return
+
+    info = {
+        "model_path": os.path.abspath(image_routes.MODEL_PATH),
+        "model_id": image_routes.MODEL_ID,
+        "class_names": image_routes.CLASS_NAMES,
+        "backend": image_routes.INFERENCE_BACKEND,
+    }
+    print(f"Inference worker {index} (pid {os.getpid()}) serving {info['model_path']}")
+    while True:
+        try:
+            conn = listener.accept()
+        except Exception as exc:
+            print(f"Inference worker {index}: accept failed: {exc}")
+            continue
+        threading.Thread(target=_serve_connection, args=(conn, image_routes, info), daemon=True).start()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the AgroVision inference worker pool.")
+    parser.add_argument("--address", default=os.environ.get("INFERENCE_WORKER_ADDRESS", DEFAULT_ADDRESS))
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("INFERENCE_WORKERS", 1)))
+    parser.add_argument("--backend", choices=["keras", "tflite"], default=None,
+                        help="Model backend inside the workers (defaults to INFERENCE_BACKEND or keras).")
+    args = parser.parse_args()
+
+    backend = args.backend or os.environ.get("INFERENCE_BACKEND", "keras")
+    os.environ["INFERENCE_BACKEND"] = "keras" if backend == "remote" else backend
+
+    address = parse_address(args.address)
+    check_authkey(address, AUTHKEY)
+    if isinstance(address, str):
+        _private_socket_path(address)
+    # Bind once in the parent; forked workers share the listening socket and
+    # the kernel hands each new connection to one of them.
+    listener = Listener(address, authkey=AUTHKEY)
+    if isinstance(address, str):
+        os.chmod(address, 0o600)
+    print(f"Inference worker pool listening on {args.address} with {args.workers} worker(s)")
+
+    ctx = multiprocessing.get_context("fork")
+    processes = [ctx.Process(target=_worker_main, args=(listener, i), daemon=True) for i in range(args.workers)]
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        listener.close()
+
+
+if __name__ == "__main__":
+    main()
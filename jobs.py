@@ -0,0 +1,118 @@
+import itertools
+import queue
+import threading
+import time
+from collections import OrderedDict
+
+
+class JobQueue:
+    """In-process job queue drained by a pool of worker threads.
+
+    ``handler(payload)`` runs on a worker and returns the job result (any
+    JSON-serializable value). Job state is kept in memory for the most recent
+    ``max_jobs`` jobs; callers can poll ``get()`` or block in ``wait()`` for
+    the next state change.
+    """
+
+    def __init__(self, handler, workers=2, max_jobs=10000, name="job-worker"):
+        self.handler = handler
+        self.workers = max(1, int(workers))
+        self.max_jobs = max_jobs
+        self._queue = queue.Queue()
+        self._jobs = OrderedDict()
+        self._changed = threading.Condition()
+        self._sequence = itertools.count(1)
+        self._started_at = time.monotonic()
+        self._busy = 0
+        self._busy_seconds = 0.0
+        self._counts = {'submitted': 0, 'completed': 0, 'failed': 0}
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        for index in range(self.workers):
+            threading.Thread(target=self._run, name=f"{name}-{index}", daemon=True).start()
+
+    def submit(self, payload, job_id=None, owner=None):
+        job_id = str(job_id if job_id is not None else next(self._sequence))
+        job = {
+            'id': job_id,
+            'owner': owner,
+            'status': 'queued',
+            'result': None,
+            'error': None,
+            'enqueued_at': time.time(),
+            'started_at': None,
+            'finished_at': None,
+        }
+        with self._changed:
+            self._jobs[job_id] = job
+            self._counts['submitted'] += 1
+            while len(self._jobs) > self.max_jobs:
+                self._jobs.popitem(last=False)
+        self._queue.put((job_id, payload, time.monotonic()))
+        return job_id
+
+    def get(self, job_id):
+        with self._changed:
+            job = self._jobs.get(str(job_id))
+            return dict(job) if job is not None else None
+
+    def wait(self, job_id, since_status=None, timeout=None):
+        """Block until the job's status differs from ``since_status``."""
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        with self._changed:
+            while True:
+                job = self._jobs.get(str(job_id))
+                if job is None or job['status'] != since_status:
+                    return dict(job) if job is not None else None
+                remaining = deadline - time.monotonic() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    return dict(job)
+                self._changed.wait(remaining)
+
+    def _update(self, job_id, **changes):
+        with self._changed:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                job.update(changes)
+            self._changed.notify_all()
+
+    def _run(self):
+        while True:
+            job_id, payload, enqueued = self._queue.get()
+            started = time.monotonic()
+            with self._changed:
+                self._busy += 1
+                waited = started - enqueued
+                self._wait_total += waited
+                self._wait_max = max(self._wait_max, waited)
+            self._update(job_id, status='running', started_at=time.time())
+
+            try:
+                result = self.handler(payload)
+                outcome = {'status': 'done', 'result': result}
+                counter = 'completed'
+            except Exception as exc:
+                print(f"Job {job_id} failed: {exc}")
+                outcome = {'status': 'failed', 'error': str(exc)}
+                counter = 'failed'
+
+            with self._changed:
+                self._busy -= 1
+                self._busy_seconds += time.monotonic() - started
+                self._counts[counter] += 1
+            self._update(job_id, finished_at=time.time(), **outcome)
+
+    def stats(self):
+        with self._changed:
+            stats = dict(self._counts)
+            started = stats['completed'] + stats['failed'] + self._busy
+            elapsed = max(time.monotonic() - self._started_at, 1e-9)
+            stats.update({
+                'depth': self._queue.qsize(),
+                'workers': self.workers,
+                'busy_workers': self._busy,
+                'utilization': round(self._busy_seconds / (elapsed * self.workers), 4),
+                'avg_wait_ms': round(1000 * self._wait_total / started, 3) if started else 0.0,
+                'max_wait_ms': round(1000 * self._wait_max, 3),
+            })
+        return stats
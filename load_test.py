@@ -0,0 +1,237 @@
+"""Concurrent upload vs. read load test for the database layer.
+
+Starts several app server processes on a scratch SQLite database (like the
+workers of a prefork server), then drives them over HTTP: writer threads
+post images to /api/upload while reader threads hit /api/my-images and
+/api/check-auth. Read latency percentiles show whether upload commits
+block readers. With no --journal-mode it runs DELETE and WAL back to back:
+
+    python load_test.py
+    python load_test.py --journal-mode WAL --servers 4 --writers 8 --readers 8 --seconds 20
+"""
+import argparse
+import http.client
+import io
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PASSWORD = 'loadtest-password'
+
+
+def _percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _png_bytes(seed):
+    from PIL import Image as PILImage
+
+    buffer = io.BytesIO()
+    PILImage.new('RGB', (64, 64), ((seed * 37) % 256, (seed * 91) % 256, 120)).save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+def _server_env(workdir, journal_mode):
+    env = dict(os.environ)
+    env.update({
+        'DATABASE_URL': f"sqlite:///{os.path.join(workdir, 'loadtest.db')}",
+        'SQLITE_JOURNAL_MODE': journal_mode,
+        'SECRET_KEY': 'loadtest-secret',
+        'MODEL_READY_TIMEOUT': '0',
+        'PYTHONPATH': HERE + os.pathsep + env.get('PYTHONPATH', ''),
+    })
+    return env
+
+
+def init_database(users):
+    # Runs inside the scratch directory with the server environment.
+    from app import app
+    from models import User, db
+
+    with app.app_context():
+        db.create_all()
+        for index in range(users):
+            user = User(email=f"loadtest{index}@example.com")
+            user.set_password(PASSWORD)
+            db.session.add(user)
+        db.session.commit()
+
+
+def serve(port):
+    from app import app
+
+    app.run(host='127.0.0.1', port=port, threaded=True, debug=False, use_reloader=False)
+
+
+def _request(port, method, path, body=None, headers=None):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    try:
+        conn.request(method, path, body=body, headers=headers or {})
+        response = conn.getresponse()
+        return response.status, response.getheader('Set-Cookie'), response.read()
+    finally:
+        conn.close()
+
+
+def _login(port, email):
+    body = json.dumps({'email': email, 'password': PASSWORD})
+    status, set_cookie, _ = _request(port, 'POST', '/api/login', body, {'Content-Type': 'application/json'})
+    if status != 200 or not set_cookie:
+        raise RuntimeError(f"Login failed for {email}: HTTP {status}")
+    # The session cookie is marked Secure, so pass it by hand over plain HTTP.
+    return set_cookie.split(';', 1)[0]
+
+
+def _multipart(field, filename, data):
+    boundary = uuid.uuid4().hex
+    body = (
+        f"--{boundary}\r\nContent-Disposition: form-data; name=\"{field}\"; filename=\"{filename}\"\r\n"
+        f"Content-Type: image/png\r\n\r\n"
+    ).encode() + data + f"\r\n--{boundary}--\r\n".encode()
+    return body, {'Content-Type': f'multipart/form-data; boundary={boundary}'}
+
+
+def run_mode(args, journal_mode):
+    workdir = tempfile.mkdtemp(prefix='agrovision-loadtest-')
+    env = _server_env(workdir, journal_mode)
+    users = args.writers + args.readers
+    subprocess.run([sys.executable, os.path.abspath(__file__), '--init-users', str(users)],
+                   cwd=workdir, env=env, check=True, capture_output=True)
+
+    ports = [_free_port() for _ in range(args.servers)]
+    servers = [
+        subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve', str(port)],
+                         cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        for port in ports
+    ]
+    try:
+        deadline = time.monotonic() + 60
+        for port in ports:
+            while True:
+                try:
+                    if _request(port, 'GET', '/healthz')[0] == 200:
+                        break
+                except OSError:
+                    pass
+                if time.monotonic() > deadline:
+                    raise RuntimeError(f"Server on port {port} did not start")
+                time.sleep(0.2)
+
+        cookies = [_login(ports[0], f"loadtest{index}@example.com") for index in range(users)]
+        return _drive(args, journal_mode, ports, cookies)
+    finally:
+        for server in servers:
+            server.terminate()
+        for server in servers:
+            server.wait()
+
+
+def _drive(args, journal_mode, ports, cookies):
+    stop = threading.Event()
+    lock = threading.Lock()
+    latencies = {'upload': [], 'my_images': [], 'check_auth': []}
+    errors = {'upload': 0, 'my_images': 0, 'check_auth': 0}
+
+    def timed(kind, port, method, path, body=None, headers=None):
+        start = time.perf_counter()
+        try:
+            ok = _request(port, method, path, body, headers)[0] == 200
+        except OSError:
+            ok = False
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies[kind].append(elapsed)
+            if not ok:
+                errors[kind] += 1
+
+    def writer(index):
+        port = ports[index % len(ports)]
+        sequence = 0
+        while not stop.is_set():
+            sequence += 1
+            body, headers = _multipart('image', 'leaf.png', _png_bytes(index * 100000 + sequence))
+            headers['Cookie'] = cookies[index]
+            timed('upload', port, 'POST', '/api/upload', body, headers)
+
+    def reader(index):
+        port = ports[index % len(ports)]
+        headers = {'Cookie': cookies[index]}
+        while not stop.is_set():
+            timed('my_images', port, 'GET', '/api/my-images?limit=20', headers=headers)
+            timed('check_auth', port, 'GET', '/api/check-auth', headers=headers)
+
+    threads = [threading.Thread(target=writer, args=(i,)) for i in range(args.writers)]
+    threads += [threading.Thread(target=reader, args=(i,)) for i in range(args.writers, args.writers + args.readers)]
+    for thread in threads:
+        thread.start()
+    time.sleep(args.seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    report = {'journal_mode': journal_mode, 'servers': len(ports), 'seconds': args.seconds}
+    for kind, values in latencies.items():
+        report[kind] = {
+            'requests': len(values),
+            'per_second': round(len(values) / args.seconds, 1),
+            'errors': errors[kind],
+            'p50_ms': round(_percentile(values, 50) * 1000, 2),
+            'p95_ms': round(_percentile(values, 95) * 1000, 2),
+            'p99_ms': round(_percentile(values, 99) * 1000, 2),
+            'max_ms': round(max(values) * 1000, 2) if values else 0.0,
+        }
+    return report
+
+
+def print_report(report):
+    print(f"\njournal_mode={report['journal_mode']} ({report['servers']} servers, {report['seconds']}s)")
+    print(f"  {'endpoint':<12}{'req/s':>8}{'errors':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'max ms':>9}")
+    for kind in ('upload', 'my_images', 'check_auth'):
+        row = report[kind]
+        print(f"  {kind:<12}{row['per_second']:>8}{row['errors']:>8}{row['p50_ms']:>9}"
+              f"{row['p95_ms']:>9}{row['p99_ms']:>9}{row['max_ms']:>9}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test concurrent uploads against history/auth reads.")
+    parser.add_argument('--journal-mode', choices=['DELETE', 'WAL'], type=str.upper, default=None,
+                        help="Run a single journal mode (default: run DELETE and WAL and compare).")
+    parser.add_argument('--servers', type=int, default=4, help="App server processes sharing the database.")
+    parser.add_argument('--writers', type=int, default=4)
+    parser.add_argument('--readers', type=int, default=4)
+    parser.add_argument('--seconds', type=float, default=10.0)
+    parser.add_argument('--init-users', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--serve', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.init_users is not None:
+        init_database(args.init_users)
+        return
+    if args.serve is not None:
+        serve(args.serve)
+        return
+
+    for mode in [args.journal_mode] if args.journal_mode else ['DELETE', 'WAL']:
+        print_report(run_mode(args, mode))
+
+
+if __name__ == '__main__':
+    main()
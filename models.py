@@ -1,24 +1,225 @@
+import os
+import secrets
+import sqlite3
 from flask_sqlalchemy import SQLAlchemy
-from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy import event, inspect
+from sqlalchemy.engine import Engine
+from sqlalchemy.dialects import postgresql, sqlite
+from auth_cache import password_stamp, user_cache
+from passwords import hash_password, needs_rehash, verify_password
 from datetime import datetime
 
 db = SQLAlchemy()
 
+# SQLite tuning. WAL lets readers proceed while an upload commits; NORMAL
+# sync is durable across application crashes in WAL mode.
+SQLITE_JOURNAL_MODE = os.environ.get("SQLITE_JOURNAL_MODE", "WAL")
+SQLITE_SYNCHRONOUS = os.environ.get("SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get("SQLITE_BUSY_TIMEOUT_MS", 5000))
+
+def database_uri():
+    uri = os.environ.get("DATABASE_URL", "sqlite:///users.db")
+    # Some hosts still hand out the pre-1.4 SQLAlchemy scheme.
+    if uri.startswith("postgres://"):
+        uri = "postgresql://" + uri[len("postgres://"):]
+    return uri
+
+def engine_options(uri):
+    if uri.startswith("sqlite"):
+        return {'connect_args': {'timeout': SQLITE_BUSY_TIMEOUT_MS / 1000}}
+    return {
+        'pool_size': int(os.environ.get("DB_POOL_SIZE", 10)),
+        'max_overflow': int(os.environ.get("DB_MAX_OVERFLOW", 20)),
+        'pool_timeout': float(os.environ.get("DB_POOL_TIMEOUT", 30)),
+        'pool_recycle': int(os.environ.get("DB_POOL_RECYCLE", 1800)),
+        'pool_pre_ping': True,
+    }
+
+@event.listens_for(Engine, 'connect')
+def _configure_sqlite(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"PRAGMA journal_mode={SQLITE_JOURNAL_MODE}")
+    cursor.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.close()
+
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     email = db.Column(db.String(150), unique=True, nullable=False)
     password_hash = db.Column(db.String(200), nullable=False)
+    # Changes only when the password itself does, not on a rehash; NULL for
+    # accounts that predate the column, which fall back to the hash.
+    auth_stamp = db.Column(db.String(32), nullable=True)
     images = db.relationship('Image', backref='user', lazy=True)
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = hash_password(password)
+        self.auth_stamp = secrets.token_hex(8)
+
+    def rehash_password(self, password):
+        """Re-hash with the current parameters, keeping existing sessions valid."""
+        stamp = self.session_stamp()
+        self.password_hash = hash_password(password)
+        self.auth_stamp = stamp
+
+    def session_stamp(self):
+        return self.auth_stamp or password_stamp(self.password_hash)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return verify_password(self.password_hash, password)
+
+    def password_needs_rehash(self):
+        return needs_rehash(self.password_hash)
 
 class Image(db.Model):
+    # Serves keyset-paginated history: WHERE user_id = ? ORDER BY created_at, id.
+    __table_args__ = (db.Index('ix_image_user_created', 'user_id', 'created_at', 'id'),)
+
     id = db.Column(db.Integer, primary_key=True)
     filename = db.Column(db.String(255), nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     prediction = db.Column(db.String(255), nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class PredictionDailyCount(db.Model):
+    """Images per user, per UTC day, per prediction label.
+
+    Kept up to date by the Image insert/update/delete listeners below, so
+    dashboards never have to scan a user's full history.
+    """
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    label = db.Column(db.String(255), primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+class FleetDailyCount(db.Model):
+    """Images across all users, per UTC day, per prediction label."""
+    day = db.Column(db.Date, primary_key=True)
+    label = db.Column(db.String(255), primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+def stats_label(prediction):
+    # Error predictions embed the exception text; count them under one label.
+    if prediction is None:
+        return None
+    return 'Error' if prediction.startswith('Error') else prediction
+
+def _bump(connection, model, keys, delta):
+    table = model.__table__
+    dialect = connection.dialect.name
+    if delta > 0 and dialect in ('sqlite', 'postgresql'):
+        insert = sqlite.insert if dialect == 'sqlite' else postgresql.insert
+        stmt = insert(table).values(count=delta, **keys)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=list(keys),
+            set_={'count': table.c.count + delta},
+        )
+        connection.execute(stmt)
+        return
+
+    match = [table.c[name] == value for name, value in keys.items()]
+    updated = connection.execute(table.update().where(*match).values(count=table.c.count + delta)).rowcount
+    if not updated and delta > 0:
+        connection.execute(table.insert().values(count=delta, **keys))
+    elif delta < 0:
+        connection.execute(table.delete().where(*match, table.c.count <= 0))
+
+def _count_prediction(connection, user_id, created_at, prediction, delta):
+    label = stats_label(prediction)
+    if label is None:
+        return
+    day = (created_at or datetime.utcnow()).date()
+    _bump(connection, PredictionDailyCount, {'user_id': user_id, 'day': day, 'label': label}, delta)
+    _bump(connection, FleetDailyCount, {'day': day, 'label': label}, delta)
+
+@event.listens_for(Image, 'after_insert')
+def _image_inserted(mapper, connection, target):
+    _count_prediction(connection, target.user_id, target.created_at, target.prediction, 1)
+
+@event.listens_for(Image, 'after_delete')
+def _image_deleted(mapper, connection, target):
+    _count_prediction(connection, target.user_id, target.created_at, target.prediction, -1)
+
+@event.listens_for(Image, 'after_update')
+def _image_updated(mapper, connection, target):
+    # Async jobs fill in the prediction after the row was first inserted.
+    history = inspect(target).attrs.prediction.history
+    if not history.has_changes():
+        return
+    for old in history.deleted:
+        _count_prediction(connection, target.user_id, target.created_at, old, -1)
+    _count_prediction(connection, target.user_id, target.created_at, target.prediction, 1)
+
+@event.listens_for(User, 'after_update')
+def _user_updated(mapper, connection, target):
+    # Refresh rather than drop the cached record so sessions carrying the
+    # old password stamp are rejected immediately in this process.
+    state = inspect(target).attrs
+    if state.password_hash.history.has_changes() or state.email.history.has_changes():
+        user_cache.put(target)
+
+@event.listens_for(User, 'after_delete')
+def _user_deleted(mapper, connection, target):
+    user_cache.invalidate(target.id)
+
+def rebuild_prediction_counts():
+    """Recompute both aggregate tables from the image table."""
+    counts = {}
+    rows = db.session.query(Image.user_id, db.func.date(Image.created_at), Image.prediction, db.func.count()).group_by(
+        Image.user_id, db.func.date(Image.created_at), Image.prediction
+    )
+    for user_id, day, prediction, count in rows:
+        label = stats_label(prediction)
+        if label is None or day is None:
+            continue
+        if isinstance(day, str):
+            day = datetime.strptime(day, '%Y-%m-%d').date()
+        key = (user_id, day, label)
+        counts[key] = counts.get(key, 0) + count
+
+    fleet = {}
+    for (user_id, day, label), count in counts.items():
+        fleet[(day, label)] = fleet.get((day, label), 0) + count
+
+    db.session.query(PredictionDailyCount).delete()
+    db.session.query(FleetDailyCount).delete()
+    db.session.add_all(
+        PredictionDailyCount(user_id=user_id, day=day, label=label, count=count)
+        for (user_id, day, label), count in counts.items()
+    )
+    db.session.add_all(FleetDailyCount(day=day, label=label, count=count) for (day, label), count in fleet.items())
+    db.session.commit()
+
+def ensure_columns():
+    """Add columns declared on the models that an existing table lacks.
+
+    Only nullable columns without server defaults are added this way.
+    """
+    inspector = inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing or not column.nullable:
+                continue
+            column_type = column.type.compile(dialect=db.engine.dialect)
+            with db.engine.begin() as connection:
+                connection.exec_driver_sql(f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {column_type}')
+
+def ensure_indexes():
+    """Create indexes declared on the models that an existing database lacks.
+
+    db.create_all() only creates missing tables, so indexes added to a
+    table that already exists have to be created separately.
+    """
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=db.engine, checkfirst=True)
+
+def ensure_prediction_counts():
+    """Backfill the aggregate tables once for databases that predate them."""
+    if db.session.query(FleetDailyCount.day).first() is None and db.session.query(Image.id).first() is not None:
+        rebuild_prediction_counts()
@@ -0,0 +1,169 @@
+"""Perceptual hashing and near-duplicate grouping for prepare_data.py.
+
+Every image gets a 64-bit DCT perceptual hash, computed from a 32x32
+grayscale thumbnail in batches (one matrix product per batch) across a
+process pool. Hashes are cached by path, size and mtime, so re-runs only
+hash new files.
+
+Near-duplicates are pairs within ``max_distance`` bits. Splitting the hash
+into ``max_distance + 1`` bands means any such pair matches exactly on at
+least one band, so only images sharing a band value are compared, in
+bounded-size blocks. Memory stays at a few bytes per image plus one block.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+
+HASH_SIZE = 8
+THUMBNAIL_SIZE = 32
+HASH_BATCH_SIZE = 256
+COMPARE_BLOCK_ROWS = 64
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def _dct_matrix(n):
+    k = np.arange(n)[:, None]
+    matrix = np.cos(np.pi * (2 * np.arange(n)[None, :] + 1) * k / (2 * n)) * np.sqrt(2 / n)
+    matrix[0] /= np.sqrt(2)
+    return matrix.astype(np.float32)
+
+
+_DCT = _dct_matrix(THUMBNAIL_SIZE)
+
+
+def _thumbnail(path):
+    with Image.open(path) as img:
+        img.draft("L", (THUMBNAIL_SIZE * 2, THUMBNAIL_SIZE * 2))
+        return np.asarray(img.convert("L").resize((THUMBNAIL_SIZE, THUMBNAIL_SIZE), Image.BILINEAR), dtype=np.float32)
+
+
+def phash_batch(thumbnails):
+    """uint64 perceptual hashes for an (n, 32, 32) float batch."""
+    coefficients = _DCT @ thumbnails @ _DCT.T
+    low = coefficients[:, :HASH_SIZE, :HASH_SIZE].reshape(len(thumbnails), -1)
+    # The DC term only reflects overall brightness, so leave it out of the median.
+    bits = low > np.median(low[:, 1:], axis=1, keepdims=True)
+    return np.packbits(bits, axis=1).view(">u8").ravel().astype(np.uint64)
+
+
+def hash_files(paths):
+    """(hashes, ok) for a list of paths; ok is False where an image could not be read."""
+    thumbnails = np.zeros((len(paths), THUMBNAIL_SIZE, THUMBNAIL_SIZE), dtype=np.float32)
+    ok = np.ones(len(paths), dtype=bool)
+    for i, path in enumerate(paths):
+        try:
+            thumbnails[i] = _thumbnail(path)
+        except Exception:
+            ok[i] = False
+    return phash_batch(thumbnails), ok
+
+
+def popcount(values):
+    return _POPCOUNT[values.view(np.uint8)].reshape(values.shape + (8,)).sum(axis=-1, dtype=np.uint8)
+
+
+class HashCache:
+    """Perceptual hashes keyed by path, valid while size and mtime are unchanged."""
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
+            with np.load(path) as data:
+                for key, size, mtime_ns, value in zip(data["keys"], data["sizes"], data["mtimes"], data["hashes"]):
+                    self.entries[str(key)] = (int(size), int(mtime_ns), np.uint64(value))
+
+    def get(self, key, size, mtime_ns):
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] == size and entry[1] == mtime_ns:
+            return entry[2]
+        return None
+
+    def put(self, key, size, mtime_ns, value):
+        self.entries[key] = (size, mtime_ns, np.uint64(value))
+
+    def retain(self, keys):
+        self.entries = {key: self.entries[key] for key in keys if key in self.entries}
+
+    def save(self):
+        keys = list(self.entries)
+        values = [self.entries[key] for key in keys]
+        tmp_path = self.path + ".tmp.npz"
+        np.savez(
+            tmp_path,
+            keys=np.array(keys, dtype=str),
+            sizes=np.array([v[0] for v in values], dtype=np.int64),
+            mtimes=np.array([v[1] for v in values], dtype=np.int64),
+            hashes=np.array([v[2] for v in values], dtype=np.uint64),
+        )
+        os.replace(tmp_path, self.path)
+
+
+def compute_hashes(scanned, cache, workers):
+    """Hash (key, path, size, mtime_ns) items, reusing the cache; returns {key: uint64}."""
+    hashes = {}
+    todo = []
+    for key, path, size, mtime_ns in scanned:
+        value = cache.get(key, size, mtime_ns)
+        if value is None:
+            todo.append((key, path, size, mtime_ns))
+        else:
+            hashes[key] = value
+
+    if todo:
+        print(f"Computing perceptual hashes for {len(todo)} images ({len(hashes)} cached)...")
+        batches = [todo[i:i + HASH_BATCH_SIZE] for i in range(0, len(todo), HASH_BATCH_SIZE)]
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = pool.map(hash_files, [[item[1] for item in batch] for batch in batches])
+            for batch, (values, ok) in zip(batches, results):
+                for (key, _, size, mtime_ns), value, readable in zip(batch, values, ok):
+                    if readable:
+                        hashes[key] = value
+                        cache.put(key, size, mtime_ns, value)
+    cache.retain(key for key, _, _, _ in scanned)
+    return hashes
+
+
+def _bands(max_distance):
+    count = max_distance + 1
+    widths = [64 // count + (1 if i < 64 % count else 0) for i in range(count)]
+    shifts = np.cumsum([0] + widths[:-1])
+    return [(int(shift), (1 << width) - 1) for shift, width in zip(shifts, widths)]
+
+
+def find_groups(keys, hashes, max_distance):
+    """Lists of keys whose hashes are within max_distance bits of each other (transitively)."""
+    hashes = np.asarray(hashes, dtype=np.uint64)
+    parent = np.arange(len(keys))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for shift, mask in _bands(max_distance):
+        band = (hashes >> np.uint64(shift)) & np.uint64(mask)
+        order = np.argsort(band, kind="stable")
+        boundaries = np.flatnonzero(np.diff(band[order])) + 1
+        for bucket in np.split(order, boundaries):
+            if len(bucket) < 2:
+                continue
+            bucket_hashes = hashes[bucket]
+            for start in range(0, len(bucket), COMPARE_BLOCK_ROWS):
+                block = bucket_hashes[start:start + COMPARE_BLOCK_ROWS]
+                distances = popcount(block[:, None] ^ bucket_hashes[None, :])
+                rows, cols = np.nonzero(distances <= max_distance)
+                for row, col in zip(rows + start, cols):
+                    if col > row:
+                        a, b = find(bucket[row]), find(bucket[col])
+                        if a != b:
+                            parent[max(a, b)] = min(a, b)
+
+    groups = {}
+    for i in range(len(keys)):
+        groups.setdefault(find(i), []).append(keys[i])
+    return [sorted(members) for members in groups.values() if len(members) > 1]
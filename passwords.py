@@ -0,0 +1,69 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+
+# Any werkzeug method string, e.g. "scrypt:32768:8:1" or "pbkdf2:sha256:600000".
+PASSWORD_HASH_METHOD = os.environ.get("PASSWORD_HASH_METHOD", "scrypt:32768:8:1")
+# Hashing threads. hashlib's scrypt and pbkdf2 release the GIL, so this caps
+# the cores a login burst can take away from inference.
+PASSWORD_HASH_WORKERS = int(os.environ.get("PASSWORD_HASH_WORKERS", 2))
+# Hashes running or queued before further logins are turned away.
+PASSWORD_HASH_MAX_PENDING = int(os.environ.get("PASSWORD_HASH_MAX_PENDING", 16))
+PASSWORD_HASH_QUEUE_TIMEOUT = float(os.environ.get("PASSWORD_HASH_QUEUE_TIMEOUT", 0.5))
+
+
+class PasswordHasherBusy(Exception):
+    """Raised when too many password hashes are already pending."""
+
+
+_pool = None
+_pool_lock = threading.Lock()
+_slots = threading.BoundedSemaphore(max(1, PASSWORD_HASH_MAX_PENDING))
+_pending = 0
+# werkzeug fills in defaults ("pbkdf2" -> "pbkdf2:sha256:1000000"), so take
+# the canonical prefix from a real hash, once, at import.
+_method_prefix = generate_password_hash("", PASSWORD_HASH_METHOD).split("$", 1)[0]
+
+
+def _get_pool():
+    # Created on first use so forked server workers each get their own threads.
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ThreadPoolExecutor(max_workers=max(1, PASSWORD_HASH_WORKERS), thread_name_prefix="password-hash")
+    return _pool
+
+
+def _run(fn, *args):
+    global _pending
+    if not _slots.acquire(timeout=PASSWORD_HASH_QUEUE_TIMEOUT):
+        raise PasswordHasherBusy("Too many logins in progress")
+    with _pool_lock:
+        _pending += 1
+    try:
+        return _get_pool().submit(fn, *args).result()
+    finally:
+        with _pool_lock:
+            _pending -= 1
+        _slots.release()
+
+
+def hash_password(password):
+    return _run(generate_password_hash, password, PASSWORD_HASH_METHOD)
+
+
+def verify_password(password_hash, password):
+    return _run(check_password_hash, password_hash, password)
+
+
+def needs_rehash(password_hash):
+    """True if the stored hash was made with other parameters than configured."""
+    return password_hash.split("$", 1)[0] != _method_prefix
+
+
+def stats():
+    return {'pending': _pending, 'max_pending': PASSWORD_HASH_MAX_PENDING, 'workers': PASSWORD_HASH_WORKERS}
@@ -0,0 +1,203 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+# Rows are trimmed back to max_disk_entries every this many writes per
+# process, so the row count is checked without scanning on every put.
+DISK_TRIM_INTERVAL = 64
+# A disk hit refreshes the row's last_used only if it is older than this,
+# so hot entries do not turn every lookup into a write.
+LAST_USED_RESOLUTION = 3600
+
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+class PredictionCache:
+    """Two-tier cache of (label, confidence) keyed by image content hash.
+
+    Entries are scoped to a model identity so a retrained or swapped model
+    never serves stale predictions. The in-memory tier is a bounded LRU; the
+    SQLite tier survives restarts and is shared by every worker process on
+    the host. It holds at most about ``max_disk_entries`` rows (0 for no
+    limit); the least recently used are deleted first. Each process opens
+    one SQLite connection, creating the schema once, and shares it between
+    threads under ``_db_lock``.
+    """
+
+    def __init__(self, db_path, max_entries=4096, max_disk_entries=100000):
+        self.db_path = db_path
+        self.max_entries = max(0, int(max_entries))
+        self.max_disk_entries = max(0, int(max_disk_entries))
+        self._writes = 0
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        # Separate from _lock so memory hits never wait on SQLite I/O.
+        self._db_lock = threading.Lock()
+        self._counts = {
+            'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'evictions': 0, 'disk_evictions': 0, 'stale_purged': 0,
+        }
+        self._conn = None
+        self._conn_pid = None
+        self._disabled = False
+        with self._db_lock:
+            self._connection()
+
+    def _connection(self):
+        """The process's shared connection, or None if the database is unusable; call under _db_lock."""
+        if self._disabled:
+            return None
+        # A connection must not cross a fork; the child opens its own.
+        if self._conn is None or self._conn_pid != os.getpid():
+            try:
+                self._conn = self._open()
+                self._conn_pid = os.getpid()
+            except (sqlite3.Error, OSError) as exc:
+                print(f"Prediction cache database unavailable, caching in memory only: {exc}")
+                self._conn = None
+                self._disabled = True
+        return self._conn
+
+    def _open(self):
+        os.makedirs(os.path.dirname(self.db_path) or '.', exist_ok=True)
+        conn = sqlite3.connect(self.db_path, timeout=5.0, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS predictions ('
+            ' digest TEXT NOT NULL,'
+            ' model_id TEXT NOT NULL,'
+            ' label TEXT NOT NULL,'
+            ' confidence REAL NOT NULL,'
+            ' last_used INTEGER,'
+            ' PRIMARY KEY (digest, model_id))'
+        )
+        columns = {row[1] for row in conn.execute('PRAGMA table_info(predictions)')}
+        if 'last_used' not in columns:
+            # Rows written before the size limit existed count as least recently used.
+            conn.execute('ALTER TABLE predictions ADD COLUMN last_used INTEGER')
+        conn.execute('CREATE INDEX IF NOT EXISTS ix_predictions_last_used ON predictions (last_used)')
+        conn.commit()
+        return conn
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self._counts[name] += amount
+
+    def _remember(self, key, value):
+        if not self.max_entries:
+            return
+        with self._lock:
+            self._memory[key] = value
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_entries:
+                self._memory.popitem(last=False)
+                self._counts['evictions'] += 1
+
+    def get(self, digest, model_id):
+        key = (digest, model_id)
+        with self._lock:
+            value = self._memory.get(key)
+            if value is not None:
+                self._memory.move_to_end(key)
+                self._counts['memory_hits'] += 1
+                return value
+
+        row = None
+        try:
+            with self._db_lock:
+                conn = self._connection()
+                if conn is not None:
+                    row = conn.execute(
+                        'SELECT label, confidence, last_used FROM predictions WHERE digest = ? AND model_id = ?',
+                        (digest, model_id),
+                    ).fetchone()
+                    now = int(time.time())
+                    if row is not None and (row[2] is None or now - row[2] > LAST_USED_RESOLUTION):
+                        with conn:
+                            conn.execute(
+                                'UPDATE predictions SET last_used = ? WHERE digest = ? AND model_id = ?',
+                                (now, digest, model_id),
+                            )
+        except sqlite3.Error as exc:
+            print(f"Prediction cache lookup failed: {exc}")
+
+        if row is None:
+            self._count('misses')
+            return None
+        self._count('disk_hits')
+        value = (row[0], float(row[1]))
+        self._remember(key, value)
+        return value
+
+    def put(self, digest, model_id, label, confidence):
+        self._remember((digest, model_id), (label, float(confidence)))
+        try:
+            with self._db_lock:
+                conn = self._connection()
+                if conn is None:
+                    return
+                with conn:
+                    conn.execute(
+                        'INSERT OR REPLACE INTO predictions (digest, model_id, label, confidence, last_used)'
+                        ' VALUES (?, ?, ?, ?, ?)',
+                        (digest, model_id, label, float(confidence), int(time.time())),
+                    )
+                self._writes += 1
+                if self.max_disk_entries and self._writes % DISK_TRIM_INTERVAL == 1:
+                    self._trim(conn)
+        except sqlite3.Error as exc:
+            print(f"Prediction cache write failed: {exc}")
+
+    def _trim(self, conn):
+        """Delete the least recently used rows beyond max_disk_entries; call under _db_lock."""
+        excess = conn.execute('SELECT COUNT(*) FROM predictions').fetchone()[0] - self.max_disk_entries
+        if excess <= 0:
+            return
+        with conn:
+            evicted = conn.execute(
+                'DELETE FROM predictions WHERE rowid IN'
+                ' (SELECT rowid FROM predictions ORDER BY last_used LIMIT ?)',
+                (excess,),
+            ).rowcount
+        self._count('disk_evictions', evicted)
+
+    def purge_stale(self, model_id):
+        """Drop persisted entries produced by any other model.
+
+        Variants of the current model, keyed "<model_id>+<variant>", are kept.
+        """
+        variant_prefix = model_id + '+'
+        with self._lock:
+            for key in [k for k in self._memory if k[1] != model_id and not k[1].startswith(variant_prefix)]:
+                del self._memory[key]
+        try:
+            with self._db_lock:
+                conn = self._connection()
+                if conn is None:
+                    return 0
+                with conn:
+                    purged = conn.execute(
+                        'DELETE FROM predictions WHERE model_id != ? AND substr(model_id, 1, ?) != ?',
+                        (model_id, len(variant_prefix), variant_prefix),
+                    ).rowcount
+        except sqlite3.Error as exc:
+            print(f"Prediction cache purge failed: {exc}")
+            return 0
+        self._count('stale_purged', purged)
+        return purged
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counts)
+            stats['memory_entries'] = len(self._memory)
+        lookups = stats['memory_hits'] + stats['disk_hits'] + stats['misses']
+        stats['hit_rate'] = round((stats['memory_hits'] + stats['disk_hits']) / lookups, 4) if lookups else 0.0
+        stats['max_entries'] = self.max_entries
+        stats['max_disk_entries'] = self.max_disk_entries
+        return stats
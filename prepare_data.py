@@ -1,6 +1,16 @@
+import argparse
+import fcntl
+import hashlib
+import json
 import os
 import random
 import shutil
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from near_duplicates import HashCache, compute_hashes, find_groups
 
 # Base paths
 BASE_DIR = "data"
@@ -8,6 +18,11 @@ SOURCE_DIR = os.path.join(BASE_DIR, "images")
 TRAIN_DIR = os.path.join(BASE_DIR, "train")
 VAL_DIR = os.path.join(BASE_DIR, "val")
 TEST_DIR = os.path.join(BASE_DIR, "test")
+SHARDS_DIR = os.path.join(BASE_DIR, "shards")
+# Which split every source file went to, so re-runs only touch what changed.
+SPLIT_MANIFEST = os.path.join(BASE_DIR, "split_manifest.json")
+PHASH_CACHE = os.path.join(BASE_DIR, "phash_cache.npz")
+DUPLICATES_REPORT = os.path.join(BASE_DIR, "duplicates_report.json")
 
 # Supported image extensions
 IMAGE_EXTS = (".jpg", ".jpeg", ".png", ".bmp", ".webp", ".tif", ".tiff")
@@ -19,6 +34,17 @@ SPLIT_RATIOS = {
     "test": 0.15,
 }
 
+# Shard output: images pre-resized to the model input, as uint8 .npy files
+# that train_model.py memory-maps instead of decoding originals.
+IMAGE_SIZE = (224, 224)
+SHARD_SIZE = 1024
+
+# Images whose perceptual hashes differ by at most this many bits are
+# treated as near-duplicates and kept in one split.
+DUPLICATE_MAX_DISTANCE = 4
+# ioctl that asks btrfs/XFS to share a file's blocks (Linux FICLONE).
+FICLONE = 0x40049409
+
 random.seed(42)  # For reproducibility
 
 
@@ -30,23 +56,250 @@ def is_image(fname: str) -> bool:
     return fname.lower().endswith(IMAGE_EXTS)
 
 
-def check_empty(path: str):
-    """Ensure the directory is empty before writing."""
-    if os.path.exists(path) and os.listdir(path):
-        raise RuntimeError(f"{path} is not empty. Clear it before running.")
+def split_of(key: str) -> str:
+    """Stable split for a "<class>/<file>" key, from its hash rather than a shuffle.
+
+    Adding files never changes where existing ones go, so a grown dataset
+    splits incrementally; per-class ratios are met statistically.
+    """
+    position = int.from_bytes(hashlib.sha1(key.encode("utf-8")).digest()[:8], "big") / 2 ** 64
+    cumulative = 0.0
+    for split_name, ratio in SPLIT_RATIOS.items():
+        cumulative += ratio
+        if position < cumulative:
+            return split_name
+    return split_name
+
+
+def link_or_copy(src: str, dst: str) -> str:
+    """Hardlink src to dst, else reflink, else copy; returns the method used."""
+    try:
+        os.link(src, dst)
+        return "linked"
+    except OSError:
+        pass
+    try:
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        shutil.copystat(src, dst)
+        return "reflinked"
+    except OSError:
+        pass
+    shutil.copy2(src, dst)
+    return "copied"
+
+
+def place_file(src: str, dst: str) -> str:
+    if os.path.lexists(dst):
+        os.remove(dst)
+    ensure_dir(os.path.dirname(dst))
+    return link_or_copy(src, dst)
+
+
+def scan_class(class_name: str):
+    """(key, path, size, mtime_ns) of every image in one class folder."""
+    src_dir = os.path.join(SOURCE_DIR, class_name)
+    found = []
+    with os.scandir(src_dir) as entries:
+        for entry in entries:
+            if entry.is_file() and is_image(entry.name):
+                stat = entry.stat()
+                found.append((f"{class_name}/{entry.name}", entry.path, stat.st_size, stat.st_mtime_ns))
+    return sorted(found)
+
+
+def load_split_manifest() -> dict:
+    if os.path.exists(SPLIT_MANIFEST):
+        with open(SPLIT_MANIFEST, "r", encoding="utf-8") as fh:
+            return json.load(fh)
+    # Split folders written before the manifest existed: keep files where
+    # they are instead of re-assigning them (which could leak across splits).
+    files = {}
+    for split_name in SPLIT_RATIOS:
+        split_dir = os.path.join(BASE_DIR, split_name)
+        if not os.path.isdir(split_dir):
+            continue
+        for class_name in os.listdir(split_dir):
+            class_dir = os.path.join(split_dir, class_name)
+            if os.path.isdir(class_dir):
+                for fname in os.listdir(class_dir):
+                    files[f"{class_name}/{fname}"] = {"split": split_name}
+    if files:
+        print(f"Adopted {len(files)} previously split files into the manifest.")
+    return {"files": files}
+
+
+def save_split_manifest(manifest: dict):
+    tmp_path = SPLIT_MANIFEST + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as fh:
+        json.dump(manifest, fh, indent=1, sort_keys=True)
+    os.replace(tmp_path, SPLIT_MANIFEST)
+
+
+def assign_splits(scanned, manifest, groups, drop_duplicates=False):
+    """Split per file, with every near-duplicate group kept together.
+
+    A group goes where most of its already-placed members are (so only the
+    odd member out moves), or by the hash of its first key if it is new.
+    Returns ({key: split}, report); dropped duplicates get no split.
+    """
+    files = manifest["files"]
+    assignments = {key: files[key]["split"] if key in files else split_of(key) for key, _, _, _ in scanned}
+    report = []
+    for members in groups:
+        placed = [files[key]["split"] for key in members if key in files]
+        if placed:
+            split_name = max(SPLIT_RATIOS, key=lambda name: (placed.count(name), -list(SPLIT_RATIOS).index(name)))
+        else:
+            split_name = split_of(members[0])
+        moved = [key for key in members if key in files and files[key]["split"] != split_name]
+        removed = members[1:] if drop_duplicates else []
+        for key in members:
+            assignments[key] = split_name
+        for key in removed:
+            del assignments[key]
+        report.append({"split": split_name, "files": members, "moved": moved, "removed": removed})
+    return assignments, report
+
+
+def write_duplicates_report(report, max_distance):
+    summary = {
+        "max_distance": max_distance,
+        "groups": len(report),
+        "grouped_files": sum(len(group["files"]) for group in report),
+        "moved": sum(len(group["moved"]) for group in report),
+        "removed": sum(len(group["removed"]) for group in report),
+    }
+    with open(DUPLICATES_REPORT, "w", encoding="utf-8") as fh:
+        json.dump({"summary": summary, "groups": report}, fh, indent=2)
+    print(f"Near-duplicates: {summary['grouped_files']} files in {summary['groups']} groups, "
+          f"{summary['moved']} moved to their group's split, {summary['removed']} removed "
+          f"(details in {DUPLICATES_REPORT})")
+
+
+def sync_splits(scanned, manifest, assignments, workers):
+    """Bring data/<split>/<class> in line with the source folder; returns counts per action."""
+    files = manifest["files"]
+    counts = {"unchanged": 0, "linked": 0, "reflinked": 0, "copied": 0, "moved": 0, "removed": 0}
+    jobs = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for key, path, size, mtime_ns in scanned:
+            split_name = assignments.get(key)
+            if split_name is None:
+                continue
+            entry = files.get(key)
+            dst = os.path.join(BASE_DIR, split_name, *key.split("/"))
+            if entry and entry["split"] != split_name:
+                old_dst = os.path.join(BASE_DIR, entry["split"], *key.split("/"))
+                if os.path.lexists(old_dst):
+                    os.remove(old_dst)
+                counts["moved"] += 1
+            elif entry and entry.get("size") == size and entry.get("mtime_ns") == mtime_ns and os.path.exists(dst):
+                counts["unchanged"] += 1
+                continue
+            files[key] = {"split": split_name, "size": size, "mtime_ns": mtime_ns}
+            jobs[pool.submit(place_file, path, dst)] = key
+
+        for key in [key for key in files if key not in assignments]:
+            dst = os.path.join(BASE_DIR, files.pop(key)["split"], *key.split("/"))
+            if os.path.lexists(dst):
+                os.remove(dst)
+            counts["removed"] += 1
+
+        for future, key in jobs.items():
+            try:
+                counts[future.result()] += 1
+            except OSError as exc:
+                # Leave it out of the manifest so the next run retries it.
+                print(f"  Failed to place {key}: {exc}")
+                files.pop(key, None)
+    return counts
+
+
+def load_image(path: str) -> np.ndarray:
+    """Decode and resize exactly as image_routes._preprocess does at serving time."""
+    with Image.open(path) as img:
+        img.draft("RGB", IMAGE_SIZE)
+        return np.asarray(img.convert("RGB").resize(IMAGE_SIZE), dtype=np.uint8)
+
+
+def write_shard(prefix: str, items):
+    """Write (path, label) items to <prefix>.images.npy / .labels.npy; returns (count, skipped)."""
+    arrays, labels, skipped = [], [], []
+    for path, label in items:
+        try:
+            arrays.append(load_image(path))
+            labels.append(label)
+        except Exception as exc:
+            skipped.append(f"{path}: {exc}")
+
+    images = np.lib.format.open_memmap(
+        prefix + ".images.npy", mode="w+", dtype=np.uint8, shape=(len(arrays),) + IMAGE_SIZE + (3,)
+    )
+    for i, array in enumerate(arrays):
+        images[i] = array
+    images.flush()
+    del images
+    np.save(prefix + ".labels.npy", np.array(labels, dtype=np.int32))
+    return len(arrays), skipped
+
+
+def write_shards(split_items, class_names, out_dir, shard_size, workers):
+    """Write every split as shards in parallel, then the manifest train_model.py reads."""
+    manifest = {
+        "format": "npy",
+        "image_size": list(IMAGE_SIZE),
+        "class_names": class_names,
+        "splits": {},
+        "skipped": [],
+    }
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {}
+        for split_name, items in split_items.items():
+            split_dir = os.path.join(out_dir, split_name)
+            ensure_dir(split_dir)
+            for index, start in enumerate(range(0, len(items), shard_size)):
+                name = f"{split_name}/shard-{index:05d}"
+                futures[(split_name, name)] = pool.submit(
+                    write_shard, os.path.join(out_dir, name), items[start:start + shard_size]
+                )
+
+        for split_name in split_items:
+            manifest["splits"][split_name] = {"count": 0, "shards": []}
+        for (split_name, name), future in futures.items():
+            count, skipped = future.result()
+            split = manifest["splits"][split_name]
+            split["count"] += count
+            split["shards"].append({"images": f"{name}.images.npy", "labels": f"{name}.labels.npy", "count": count})
+            manifest["skipped"].extend(skipped)
+
+    with open(os.path.join(out_dir, "manifest.json"), "w", encoding="utf-8") as fh:
+        json.dump(manifest, fh, indent=2)
+    for split_name, split in manifest["splits"].items():
+        print(f"  {split_name}: {split['count']} images in {len(split['shards'])} shards")
+    if manifest["skipped"]:
+        print(f"Skipped {len(manifest['skipped'])} unreadable images (listed in the manifest).")
+    print(f"Shard manifest written to {os.path.join(out_dir, 'manifest.json')}")
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Split data/images into train/val/test.")
+    parser.add_argument("--shards", action="store_true",
+                        help=f"Write pre-resized uint8 .npy shards to {SHARDS_DIR} instead of linking files.")
+    parser.add_argument("--shard-size", type=int, default=SHARD_SIZE)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="Parallelism for scanning, hashing, linking and shard writing.")
+    parser.add_argument("--duplicate-distance", type=int, default=DUPLICATE_MAX_DISTANCE,
+                        help="Max perceptual-hash bit distance for near-duplicates (-1 disables grouping).")
+    parser.add_argument("--drop-duplicates", action="store_true",
+                        help="Keep only one image of each near-duplicate group.")
+    args = parser.parse_args()
+
     print(f"Source directory: {os.path.abspath(SOURCE_DIR)}")
 
     if not os.path.isdir(SOURCE_DIR):
         raise RuntimeError(f"Source directory not found: {SOURCE_DIR}")
 
-    # Prepare train/val/test dirs
-    for split_dir in [TRAIN_DIR, VAL_DIR, TEST_DIR]:
-        ensure_dir(split_dir)
-        check_empty(split_dir)
-
     # Get all class folders
     class_names = sorted(
         d for d in os.listdir(SOURCE_DIR)
@@ -57,50 +310,49 @@ def main():
     for cname in class_names:
         print(" -", cname)
 
-    total_src = 0
-    total_split = {"train": 0, "val": 0, "test": 0}
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        scanned = [item for found in pool.map(scan_class, class_names) for item in found]
+    manifest = load_split_manifest()
 
-    # Process every class folder
-    for class_name in class_names:
-        src_dir = os.path.join(SOURCE_DIR, class_name)
-        print(f"\nProcessing: {class_name}")
+    groups = []
+    if args.duplicate_distance >= 0:
+        cache = HashCache(PHASH_CACHE)
+        hashes = compute_hashes(scanned, cache, args.workers)
+        cache.save()
+        keys = sorted(hashes)
+        groups = find_groups(keys, [hashes[key] for key in keys], args.duplicate_distance)
+    assignments, report = assign_splits(scanned, manifest, groups, args.drop_duplicates)
+    if args.duplicate_distance >= 0:
+        write_duplicates_report(report, args.duplicate_distance)
 
-        files = [f for f in os.listdir(src_dir) if is_image(f)]
-        files.sort()
-
-        if not files:
-            print("  -> No images found, skipping.")
+    total_split = {split_name: 0 for split_name in SPLIT_RATIOS}
+    split_items = {split_name: [] for split_name in SPLIT_RATIOS}
+    labels = {name: label for label, name in enumerate(class_names)}
+    for key, path, _, _ in scanned:
+        split_name = assignments.get(key)
+        if split_name is None:
             continue
+        total_split[split_name] += 1
+        split_items[split_name].append((path, labels[key.split("/", 1)[0]]))
 
-        random.shuffle(files)
-        n = len(files)
-        total_src += n
-
-        n_train = int(n * SPLIT_RATIOS["train"])
-        n_val = int(n * SPLIT_RATIOS["val"])
-        n_test = n - n_train - n_val  # Remaining goes to test
-
-        splits = {
-            "train": files[:n_train],
-            "val": files[n_train:n_train + n_val],
-            "test": files[n_train + n_val:],
-        }
-
-        for split_name, split_files in splits.items():
-            dst_dir = os.path.join(BASE_DIR, split_name, class_name)
-            ensure_dir(dst_dir)
-
-            print(f"  {split_name}: {len(split_files)} images")
-            total_split[split_name] += len(split_files)
-
-            for fname in split_files:
-                shutil.copy2(os.path.join(src_dir, fname),
-                             os.path.join(dst_dir, fname))
-
-    print(f"Total images: {total_src}")
+    print(f"\nTotal images: {sum(total_split.values())}")
     print(f"Train: {total_split['train']}")
     print(f"Val:   {total_split['val']}")
     print(f"Test:  {total_split['test']}")
+
+    if args.shards:
+        # Shards are rewritten as a whole; the split itself is still the stable one.
+        if os.path.isdir(SHARDS_DIR):
+            shutil.rmtree(SHARDS_DIR)
+        ensure_dir(SHARDS_DIR)
+        # Mix classes within the training shards; the loader only shuffles locally.
+        random.shuffle(split_items["train"])
+        print(f"\nWriting shards with {args.workers} workers...")
+        write_shards(split_items, class_names, SHARDS_DIR, args.shard_size, args.workers)
+    else:
+        counts = sync_splits(scanned, manifest, assignments, args.workers)
+        save_split_manifest(manifest)
+        print("\n" + ", ".join(f"{action}: {count}" for action, count in counts.items()))
     print("Dataset split completed.")
 
 
@@ -15,7 +15,10 @@ async function analyzeImage() {
   formData.append('image', currentImageFile);
   try {
     const response = await fetch('/api/upload', { method: 'POST', credentials: 'include', body: formData });
-    const result = await response.json();
+    let result = await response.json();
+    if (response.status === 202 && result.status_url) {
+      result = { ...result, ...(await waitForJob(result.status_url)) };
+    }
     analyzeBtn.disabled = false;
     analyzeBtn.textContent = originalText;
     if (result.success) {
@@ -30,6 +33,17 @@ async function analyzeImage() {
   }
 }
 
+async function waitForJob(statusUrl) {
+  for (;;) {
+    await new Promise(resolve => setTimeout(resolve, 500));
+    const response = await fetch(statusUrl, { credentials: 'include' });
+    const job = await response.json();
+    if (!job.success || job.status === 'done' || job.status === 'failed') {
+      return job;
+    }
+  }
+}
+
 function generateQRCode(data) {
   const qrContainer = document.getElementById('qrcode');
   if (!qrContainer) return;
@@ -0,0 +1,190 @@
+"""Upload storage backends.
+
+Uploads are addressed by their stored name (a content hash with
+DEDUPLICATE_UPLOADS, otherwise a uuid-prefixed name). The local backend
+shards them two directory levels deep by the first four characters of the
+name (``ab/cd/abcd....jpg``) so no single directory grows unbounded. Files
+written flat by older versions are still found.
+
+How local files reach the client is set by UPLOAD_SERVE_MODE:
+
+    flask     Python streams the file (default, development)
+    sendfile  X-Sendfile header with the absolute path (Apache, lighttpd)
+    accel     X-Accel-Redirect to ACCEL_REDIRECT_PREFIX + relative path (nginx):
+                  location /_uploads/ { internal; alias /srv/agrovision/static/uploads/; }
+
+STORAGE_BACKEND=s3 keeps uploads in an S3-compatible bucket instead (needs
+boto3; S3_ENDPOINT_URL points it at MinIO or another local stand-in) and
+answers downloads with a redirect to a presigned URL.
+"""
+import io
+import os
+import shutil
+import sys
+import uuid
+
+from flask import Response, redirect, request
+from werkzeug.utils import send_file
+
+try:
+    import boto3
+    from botocore.exceptions import ClientError
+except ImportError:
+    boto3 = None
+    ClientError = Exception
+
+
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "local").lower()
+UPLOAD_SERVE_MODE = os.environ.get("UPLOAD_SERVE_MODE", "flask").lower()
+ACCEL_REDIRECT_PREFIX = os.environ.get("ACCEL_REDIRECT_PREFIX", "/_uploads/")
+S3_BUCKET = os.environ.get("S3_BUCKET")
+S3_PREFIX = os.environ.get("S3_PREFIX", "uploads/")
+S3_ENDPOINT_URL = os.environ.get("S3_ENDPOINT_URL")
+S3_URL_EXPIRES = int(os.environ.get("S3_URL_EXPIRES", 3600))
+SHARD_DEPTH = 2
+CHUNK_SIZE = 1024 * 1024
+
+
+def shard_path(name, depth=SHARD_DEPTH):
+    parts = [name[2 * i:2 * i + 2] for i in range(depth)]
+    return '/'.join(parts + [name])
+
+
+def _as_stream(source):
+    return io.BytesIO(source) if isinstance(source, (bytes, bytearray, memoryview)) else source
+
+
+class LocalStorage:
+    def __init__(self, root, serve_mode=UPLOAD_SERVE_MODE, accel_prefix=ACCEL_REDIRECT_PREFIX):
+        self.root = root
+        self.serve_mode = serve_mode
+        self.accel_prefix = accel_prefix.rstrip('/') + '/'
+
+    def _sharded(self, name):
+        return os.path.join(self.root, *shard_path(name).split('/'))
+
+    def path(self, name):
+        sharded = self._sharded(name)
+        if os.path.exists(sharded):
+            return sharded
+        legacy = os.path.join(self.root, name)
+        if os.path.exists(legacy):
+            return legacy
+        return sharded
+
+    def exists(self, name):
+        return os.path.exists(self.path(name))
+
+    def save(self, name, source):
+        """Stream ``source`` (bytes or a binary file object) into place atomically."""
+        path = self._sharded(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.part"
+        try:
+            with open(tmp_path, 'wb') as fh:
+                shutil.copyfileobj(_as_stream(source), fh, CHUNK_SIZE)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def open(self, name):
+        return open(self.path(name), 'rb')
+
+    def delete(self, name):
+        for path in (self._sharded(name), os.path.join(self.root, name)):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def serve(self, name, mimetype=None, max_age=None):
+        path = self.path(name)
+        if not os.path.exists(path):
+            raise FileNotFoundError(name)
+        if self.serve_mode == 'accel':
+            relative = os.path.relpath(path, self.root).replace(os.sep, '/')
+            response = Response(mimetype=mimetype)
+            response.headers['X-Accel-Redirect'] = self.accel_prefix + relative
+            if max_age is not None:
+                response.cache_control.max_age = max_age
+            return response
+        return send_file(
+            os.path.abspath(path),
+            request.environ,
+            mimetype=mimetype,
+            max_age=max_age,
+            conditional=True,
+            etag=True,
+            use_x_sendfile=self.serve_mode == 'sendfile',
+        )
+
+    def migrate_legacy(self):
+        """Move flat legacy uploads into the sharded layout; returns the count moved."""
+        moved = 0
+        with os.scandir(self.root) as entries:
+            for entry in entries:
+                if not entry.is_file() or entry.name.endswith('.part'):
+                    continue
+                target = self._sharded(entry.name)
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                os.replace(entry.path, target)
+                moved += 1
+        return moved
+
+
+class S3Storage:
+    def __init__(self, bucket, prefix=S3_PREFIX, endpoint_url=S3_ENDPOINT_URL, url_expires=S3_URL_EXPIRES):
+        if boto3 is None:
+            raise RuntimeError("STORAGE_BACKEND=s3 requires boto3.")
+        if not bucket:
+            raise RuntimeError("STORAGE_BACKEND=s3 requires S3_BUCKET.")
+        self.bucket = bucket
+        self.prefix = prefix
+        self.url_expires = url_expires
+        self.client = boto3.client('s3', endpoint_url=endpoint_url)
+
+    def _key(self, name):
+        return self.prefix + shard_path(name)
+
+    def exists(self, name):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self._key(name))
+            return True
+        except ClientError:
+            return False
+
+    def save(self, name, source):
+        # upload_fileobj streams in parts rather than buffering the whole body.
+        self.client.upload_fileobj(_as_stream(source), self.bucket, self._key(name))
+
+    def open(self, name):
+        try:
+            body = self.client.get_object(Bucket=self.bucket, Key=self._key(name))['Body']
+        except ClientError as exc:
+            raise FileNotFoundError(name) from exc
+        return io.BytesIO(body.read())
+
+    def delete(self, name):
+        self.client.delete_object(Bucket=self.bucket, Key=self._key(name))
+
+    def serve(self, name, mimetype=None, max_age=None):
+        params = {'Bucket': self.bucket, 'Key': self._key(name)}
+        if mimetype:
+            params['ResponseContentType'] = mimetype
+        url = self.client.generate_presigned_url('get_object', Params=params, ExpiresIn=self.url_expires)
+        response = redirect(url, code=302)
+        # The presigned URL expires, so the redirect itself must not outlive it.
+        response.cache_control.private = True
+        response.cache_control.max_age = min(max_age or self.url_expires, self.url_expires // 2)
+        return response
+
+
+def create_storage(root):
+    if STORAGE_BACKEND == 's3':
+        return S3Storage(S3_BUCKET)
+    return LocalStorage(root)
+
+
+if __name__ == '__main__':
+    # python storage.py static/uploads  -- shard an existing flat upload folder
+    root = sys.argv[1] if len(sys.argv) > 1 else os.path.join('static', 'uploads')
+    print(f"Moved {LocalStorage(root).migrate_legacy()} uploads into the sharded layout under {root}")
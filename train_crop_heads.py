@@ -0,0 +1,104 @@
+"""Train small per-crop classifier heads on the shared MobileNetV2 embedding.
+
+Takes the trained full model, embeds the train and validation splits once
+with its frozen backbone (everything up to global average pooling) and
+fits one softmax layer per crop over just that crop's classes. The heads
+are saved as plain arrays, so serving them is a NumPy matmul on top of the
+embedding (see CROP_INFERENCE_MODE=heads in image_routes.py).
+"""
+import json
+
+import numpy as np
+import tensorflow as tf
+
+from train_model import OUTPUT_DIR, SEED, load_datasets
+
+
+FULL_MODEL_PATH = OUTPUT_DIR / "agrovision_final.keras"
+HEADS_PATH = OUTPUT_DIR / "crop_heads.npz"
+REPORT_PATH = OUTPUT_DIR / "crop_heads_report.json"
+HEAD_EPOCHS = 50
+HEAD_BATCH_SIZE = 64
+
+
+def crop_of(label):
+    return label.split("_", 1)[0].lower()
+
+
+def embed(backbone, full_model, dataset):
+    embeddings, full_scores, labels = [], [], []
+    for images, y in dataset:
+        embeddings.append(backbone(images, training=False).numpy())
+        full_scores.append(full_model(images, training=False).numpy())
+        labels.append(y.numpy())
+    return np.concatenate(embeddings), np.concatenate(full_scores), np.concatenate(labels)
+
+
+def train_head(train_x, train_y, val_x, val_y, num_classes):
+    tf.keras.utils.set_random_seed(SEED)
+    head = tf.keras.Sequential([
+        tf.keras.Input(shape=(train_x.shape[1],)),
+        tf.keras.layers.Dense(num_classes, activation="softmax"),
+    ])
+    head.compile(
+        optimizer=tf.keras.optimizers.Adam(learning_rate=1e-3),
+        loss=tf.keras.losses.SparseCategoricalCrossentropy(),
+        metrics=["accuracy"],
+    )
+    head.fit(
+        train_x,
+        train_y,
+        validation_data=(val_x, val_y),
+        epochs=HEAD_EPOCHS,
+        batch_size=HEAD_BATCH_SIZE,
+        callbacks=[tf.keras.callbacks.EarlyStopping(monitor="val_accuracy", patience=5, restore_best_weights=True)],
+        verbose=0,
+    )
+    return head
+
+
+def main():
+    train_ds, val_ds, _, class_names = load_datasets()
+    full_model = tf.keras.models.load_model(FULL_MODEL_PATH)
+    pooling = next(layer for layer in full_model.layers if isinstance(layer, tf.keras.layers.GlobalAveragePooling2D))
+    backbone = tf.keras.Model(full_model.inputs, pooling.output)
+
+    print("Embedding train and validation splits...")
+    train_x, _, train_y = embed(backbone, full_model, train_ds)
+    val_x, val_scores, val_y = embed(backbone, full_model, val_ds)
+
+    arrays = {}
+    report = {}
+    crops = sorted({crop_of(name) for name in class_names})
+    for crop in crops:
+        class_indices = np.array([i for i, name in enumerate(class_names) if crop_of(name) == crop])
+        remap = {int(index): position for position, index in enumerate(class_indices)}
+        train_mask = np.isin(train_y, class_indices)
+        val_mask = np.isin(val_y, class_indices)
+        head_train_y = np.array([remap[int(y)] for y in train_y[train_mask]])
+        head_val_y = np.array([remap[int(y)] for y in val_y[val_mask]])
+
+        head = train_head(train_x[train_mask], head_train_y, val_x[val_mask], head_val_y, len(class_indices))
+        kernel, bias = head.layers[-1].get_weights()
+        arrays[f"{crop}_kernel"] = kernel.astype(np.float32)
+        arrays[f"{crop}_bias"] = bias.astype(np.float32)
+        arrays[f"{crop}_labels"] = np.array([class_names[i] for i in class_indices])
+
+        # Compare against masking the full model's output to the same crop.
+        head_accuracy = float((head.predict(val_x[val_mask], verbose=0).argmax(axis=1) == head_val_y).mean())
+        masked_accuracy = float((val_scores[val_mask][:, class_indices].argmax(axis=1) == head_val_y).mean())
+        report[crop] = {
+            "classes": len(class_indices),
+            "val_images": int(val_mask.sum()),
+            "head_accuracy": round(head_accuracy, 4),
+            "masked_full_model_accuracy": round(masked_accuracy, 4),
+        }
+        print(f"{crop:<10} head={head_accuracy:.4f}  masked full model={masked_accuracy:.4f}  ({val_mask.sum()} val images)")
+
+    np.savez(HEADS_PATH, crops=np.array(crops), **arrays)
+    REPORT_PATH.write_text(json.dumps(report, indent=2), encoding="utf-8")
+    print(f"Saved crop heads to {HEADS_PATH} and report to {REPORT_PATH}")
+
+
+if __name__ == "__main__":
+    main()
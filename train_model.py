@@ -1,8 +1,11 @@
+import argparse
+import hashlib
 import json
+import os
+import time
 from pathlib import Path
 import numpy as np
 import tensorflow as tf
-from sklearn.utils.class_weight import compute_class_weight
 from sklearn.metrics import classification_report, confusion_matrix
 import matplotlib.pyplot as plt
 import seaborn as sns
@@ -12,82 +15,281 @@ BASE_DIR = Path("data")
 TRAIN_DIR = BASE_DIR / "train"
 VAL_DIR = BASE_DIR / "val"
 TEST_DIR = BASE_DIR / "test"
+# Decoded, resized uint8 images are cached here after the first epoch.
+CACHE_DIR = BASE_DIR / "cache"
+# A cache lock this old with no finished cache next to it belongs to a
+# killed run, not one that is still filling the cache.
+CACHE_LOCK_STALE_SECONDS = 6 * 3600
+# Pre-resized shards written by `python prepare_data.py --shards`.
+SHARDS_DIR = BASE_DIR / "shards"
 
 IMAGE_SIZE = (224, 224)
 BATCH_SIZE = 32
 SEED = 42
 EPOCHS = 25
+SHUFFLE_BUFFER = 2048
+# Second phase: unfreeze the top MobileNetV2 blocks and train them slowly.
+FINE_TUNE_EPOCHS = 10
+FINE_TUNE_BLOCKS = 3
+LEARNING_RATE = 1e-4
+FINE_TUNE_LEARNING_RATE = 1e-5
+# Batches traced by the TensorBoard profiler with --profile (after warm-up).
+PROFILE_BATCHES = (20, 25)
+# Same formats image_dataset_from_directory accepts.
+IMAGE_EXTS = (".jpg", ".jpeg", ".png", ".bmp", ".gif")
 
 OUTPUT_DIR = Path("models")
 OUTPUT_DIR.mkdir(exist_ok=True)
 
 
-def load_datasets():
-    train_ds = tf.keras.utils.image_dataset_from_directory(
-        TRAIN_DIR,
-        labels="inferred",
-        label_mode="int",
-        image_size=IMAGE_SIZE,
-        batch_size=BATCH_SIZE,
-        shuffle=True,
-        seed=SEED,
-    )
-
-    val_ds = tf.keras.utils.image_dataset_from_directory(
-        VAL_DIR,
-        labels="inferred",
-        label_mode="int",
-        image_size=IMAGE_SIZE,
-        batch_size=BATCH_SIZE,
-        shuffle=False,
+def list_split(directory, class_names=None):
+    """Image paths and integer labels of a split, one class per subfolder."""
+    directory = Path(directory)
+    if class_names is None:
+        class_names = sorted(d.name for d in directory.iterdir() if d.is_dir())
+    paths, labels = [], []
+    for label, name in enumerate(class_names):
+        class_dir = directory / name
+        if not class_dir.is_dir():
+            continue
+        files = sorted(f for f in class_dir.iterdir() if f.suffix.lower() in IMAGE_EXTS)
+        paths.extend(str(f) for f in files)
+        labels.extend([label] * len(files))
+    return paths, np.array(labels, dtype=np.int32), class_names
+
+
+def _cache_path(name, paths):
+    # Keyed on the file list, sizes and mtimes so a changed split never
+    # reads a stale cache.
+    digest = hashlib.sha1(repr(IMAGE_SIZE).encode())
+    for path in paths:
+        stat = os.stat(path)
+        digest.update(f"{path}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode())
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    cache_file = CACHE_DIR / f"{name}-{digest.hexdigest()[:16]}"
+    # A run killed while filling the cache leaves a lock file behind that
+    # would make tf.data refuse to write it again. Locks of a run that may
+    # still be writing (recent, no .index yet) are left alone.
+    if not cache_file.with_name(cache_file.name + ".index").exists():
+        now = time.time()
+        for lockfile in CACHE_DIR.glob(f"{cache_file.name}_*.lockfile"):
+            try:
+                if now - lockfile.stat().st_mtime > CACHE_LOCK_STALE_SECONDS:
+                    lockfile.unlink()
+                    print(f"Removed stale cache lock {lockfile}")
+            except FileNotFoundError:
+                pass
+    return str(cache_file)
+
+
+def _decode(path, label):
+    image = tf.io.decode_image(tf.io.read_file(path), channels=3, expand_animations=False)
+    image = tf.image.resize(image, IMAGE_SIZE)
+    return tf.cast(tf.round(image), tf.uint8), label
+
+
+def _to_float(images, labels):
+    return tf.cast(images, tf.float32), labels
+
+
+def make_dataset(name, paths, labels, shuffle=False, cache=True):
+    """Batched (float32 image, int label) dataset; decodes each file only once when cached."""
+    if shuffle:
+        # Shuffle the file order once so the cached order is already mixed;
+        # the buffer below then reshuffles locally every epoch.
+        order = np.random.default_rng(SEED).permutation(len(paths))
+        paths, labels = [paths[i] for i in order], labels[order]
+    autotune = tf.data.AUTOTUNE
+    ds = tf.data.Dataset.from_tensor_slices((paths, labels))
+    ds = ds.map(_decode, num_parallel_calls=autotune)
+    if cache:
+        ds = ds.cache(_cache_path(name, paths))
+    if shuffle:
+        ds = ds.shuffle(SHUFFLE_BUFFER, seed=SEED, reshuffle_each_iteration=True)
+    ds = ds.batch(BATCH_SIZE).map(_to_float, num_parallel_calls=autotune)
+    options = tf.data.Options()
+    options.deterministic = True
+    return ds.with_options(options).prefetch(autotune)
+
+
+def load_shard_manifest(shards_dir=SHARDS_DIR):
+    manifest = json.loads((Path(shards_dir) / "manifest.json").read_text(encoding="utf-8"))
+    if tuple(manifest["image_size"]) != IMAGE_SIZE:
+        raise ValueError(f"Shards in {shards_dir} are {manifest['image_size']}, the model expects {list(IMAGE_SIZE)}.")
+    return manifest
+
+
+def shard_dataset(shards_dir, manifest, split, shuffle=False):
+    """Stream a split's memory-mapped .npy shards; nothing is decoded at training time."""
+    shards_dir = Path(shards_dir)
+    shards = manifest["splits"][split]["shards"]
+
+    def read_shard(index):
+        entry = shards[int(index)]
+        images = np.load(shards_dir / entry["images"], mmap_mode="r")
+        labels = np.load(shards_dir / entry["labels"])
+        for start in range(0, len(labels), BATCH_SIZE):
+            yield np.asarray(images[start:start + BATCH_SIZE]), labels[start:start + BATCH_SIZE]
+
+    signature = (
+        tf.TensorSpec((None,) + IMAGE_SIZE + (3,), tf.uint8),
+        tf.TensorSpec((None,), tf.int32),
     )
-
-    test_ds = tf.keras.utils.image_dataset_from_directory(
-        TEST_DIR,
-        labels="inferred",
-        label_mode="int",
-        image_size=IMAGE_SIZE,
-        batch_size=BATCH_SIZE,
-        shuffle=False,
+    autotune = tf.data.AUTOTUNE
+    ds = tf.data.Dataset.range(len(shards))
+    if shuffle:
+        ds = ds.shuffle(len(shards), seed=SEED, reshuffle_each_iteration=True)
+    ds = ds.interleave(
+        lambda index: tf.data.Dataset.from_generator(read_shard, output_signature=signature, args=(index,)),
+        cycle_length=4,
+        num_parallel_calls=autotune,
+        deterministic=True,
     )
+    if shuffle:
+        ds = ds.unbatch().shuffle(SHUFFLE_BUFFER, seed=SEED, reshuffle_each_iteration=True).batch(BATCH_SIZE)
+    ds = ds.map(_to_float, num_parallel_calls=autotune)
+    return ds.prefetch(autotune)
+
+
+def shard_labels(shards_dir, manifest, split):
+    return np.concatenate([
+        np.load(Path(shards_dir) / entry["labels"]) for entry in manifest["splits"][split]["shards"]
+    ] or [np.zeros(0, dtype=np.int32)])
+
+
+def load_datasets(cache=True, shards_dir=None):
+    if shards_dir is not None:
+        manifest = load_shard_manifest(shards_dir)
+        print(f"Streaming shards from {shards_dir}: " + ", ".join(
+            f"{split} {info['count']}" for split, info in manifest["splits"].items()))
+        return (
+            shard_dataset(shards_dir, manifest, "train", shuffle=True),
+            shard_dataset(shards_dir, manifest, "val"),
+            shard_dataset(shards_dir, manifest, "test"),
+            manifest["class_names"],
+        )
+
+    train_paths, train_labels, class_names = list_split(TRAIN_DIR)
+    val_paths, val_labels, _ = list_split(VAL_DIR, class_names)
+    test_paths, test_labels, _ = list_split(TEST_DIR, class_names)
+    print(f"Found {len(train_paths)} train, {len(val_paths)} val and {len(test_paths)} test images "
+          f"in {len(class_names)} classes.")
+
+    train_ds = make_dataset("train", train_paths, train_labels, shuffle=True, cache=cache)
+    val_ds = make_dataset("val", val_paths, val_labels, cache=cache)
+    test_ds = make_dataset("test", test_paths, test_labels, cache=cache)
+    return train_ds, val_ds, test_ds, class_names
 
-    class_names = train_ds.class_names
-
-    autotune = tf.data.AUTOTUNE
-    train_ds = train_ds.prefetch(autotune)
-    val_ds = val_ds.prefetch(autotune)
-    test_ds = test_ds.prefetch(autotune)
 
-    return train_ds, val_ds, test_ds, class_names
+def balanced_weights(labels, num_classes):
+    counts = np.bincount(labels, minlength=num_classes)
+    # Same formula as sklearn's class_weight="balanced".
+    weights = len(labels) / (num_classes * np.maximum(counts, 1))
+    return {int(i): float(w) for i, w in enumerate(weights)}
 
 
-def compute_weights():
-    raw_train = tf.keras.utils.image_dataset_from_directory(
-        TRAIN_DIR,
-        labels="inferred",
-        label_mode="int",
-        image_size=IMAGE_SIZE,
-        batch_size=BATCH_SIZE,
-        shuffle=True,
-        seed=SEED,
+def compute_weights(directory=TRAIN_DIR, class_names=None):
+    """Balanced class weights from per-class file counts, without decoding anything."""
+    _, labels, class_names = list_split(directory, class_names)
+    return balanced_weights(labels, len(class_names))
+
+
+class ThroughputCallback(tf.keras.callbacks.Callback):
+    """Prints training images/sec for every epoch (validation excluded).
+
+    Only the last batch of an epoch can be partial, so the image count is
+    steps * BATCH_SIZE capped at the size of the training set.
+    """
+
+    def __init__(self, train_size):
+        super().__init__()
+        self.train_size = train_size
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.steps = 0
+        self.start = time.perf_counter()
+        self.last = self.start
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.steps += 1
+        self.last = time.perf_counter()
+
+    def on_epoch_end(self, epoch, logs=None):
+        elapsed = self.last - self.start
+        images = min(self.steps * BATCH_SIZE, self.train_size)
+        print(f"Epoch {epoch + 1}: {images / max(elapsed, 1e-9):.1f} train images/sec ({elapsed:.1f}s)")
+
+
+def benchmark_input(epochs=3, shards_dir=None):
+    """Images/sec of the input pipelines alone, cold vs. cached, against the old loader."""
+    pipelines = {}
+    if TRAIN_DIR.is_dir():
+        train_paths, train_labels, _ = list_split(TRAIN_DIR)
+        pipelines["image_dataset_from_directory"] = tf.keras.utils.image_dataset_from_directory(
+            TRAIN_DIR,
+            labels="inferred",
+            label_mode="int",
+            image_size=IMAGE_SIZE,
+            batch_size=BATCH_SIZE,
+            shuffle=True,
+            seed=SEED,
+        ).prefetch(tf.data.AUTOTUNE)
+        pipelines["tf.data (cached)"] = make_dataset("train", train_paths, train_labels, shuffle=True)
+    if shards_dir is not None:
+        pipelines["npy shards"] = shard_dataset(shards_dir, load_shard_manifest(shards_dir), "train", shuffle=True)
+
+    for name, ds in pipelines.items():
+        for epoch in range(epochs):
+            start = time.perf_counter()
+            images = sum(int(x.shape[0]) for x, _ in ds)
+            elapsed = time.perf_counter() - start
+            print(f"{name:<30} epoch {epoch + 1}: {images / elapsed:.1f} images/sec ({elapsed:.1f}s)")
+
+
+def cpu_supports_bf16():
+    """True if the CPU has native bfloat16 instructions (AVX512-BF16 or AMX)."""
+    try:
+        with open("/proc/cpuinfo", "r", encoding="utf-8") as fh:
+            flags = next((line for line in fh if line.startswith("flags")), "").split()
+    except OSError:
+        return False
+    return "avx512_bf16" in flags or "amx_bf16" in flags
+
+
+def compile_model(model, learning_rate, jit_compile=False):
+    model.compile(
+        optimizer=tf.keras.optimizers.Adam(learning_rate=learning_rate),
+        loss=tf.keras.losses.SparseCategoricalCrossentropy(),
+        metrics=[
+            "accuracy",
+            tf.keras.metrics.SparseTopKCategoricalAccuracy(
+                k=3, name="top3_accuracy"
+            ),
+        ],
+        jit_compile=jit_compile,
     )
 
-    labels = []
-    for _, y in raw_train.unbatch():
-        labels.append(int(y.numpy()))
-    labels = np.array(labels)
 
-    classes = np.arange(labels.max() + 1)
-    weights = compute_class_weight(
-        class_weight="balanced",
-        classes=classes,
-        y=labels,
-    )
+def set_trainable_blocks(model, blocks):
+    """Freeze the backbone except its top ``blocks`` inverted-residual blocks (and Conv_1).
 
-    return {int(i): float(w) for i, w in enumerate(weights)}
+    BatchNormalization layers stay frozen; the backbone is called with
+    training=False, so their statistics are kept either way.
+    """
+    backbone = next(layer for layer in model.layers if layer.name.startswith("mobilenetv2"))
+    backbone.trainable = blocks > 0
+    if blocks <= 0:
+        return 0
+    first = f"block_{max(1, 17 - blocks)}_"
+    start = next(i for i, layer in enumerate(backbone.layers) if layer.name.startswith(first))
+    unfrozen = 0
+    for i, layer in enumerate(backbone.layers):
+        layer.trainable = i >= start and not isinstance(layer, tf.keras.layers.BatchNormalization)
+        unfrozen += layer.trainable
+    return unfrozen
 
 
-def build_model(num_classes):
+def build_model(num_classes, jit_compile=False):
     data_augmentation = tf.keras.Sequential(
         [
             tf.keras.layers.RandomFlip("horizontal"),
@@ -113,22 +315,46 @@ def build_model(num_classes):
     x = base_model(x, training=False)
     x = tf.keras.layers.GlobalAveragePooling2D()(x)
     x = tf.keras.layers.Dropout(0.3)(x)
-    outputs = tf.keras.layers.Dense(num_classes, activation="softmax")(x)
+    # Softmax in float32 even under a mixed precision policy.
+    outputs = tf.keras.layers.Dense(num_classes, activation="softmax", dtype="float32")(x)
 
     model = tf.keras.Model(inputs, outputs, name="agrovision_mobilenetv2")
+    compile_model(model, LEARNING_RATE, jit_compile)
+    return model
 
-    model.compile(
-        optimizer=tf.keras.optimizers.Adam(learning_rate=1e-4),
-        loss=tf.keras.losses.SparseCategoricalCrossentropy(),
-        metrics=[
-            "accuracy",
-            tf.keras.metrics.SparseTopKCategoricalAccuracy(
-                k=3, name="top3_accuracy"
-            ),
-        ],
-    )
 
-    return model
+def float32_copy(model, num_classes):
+    """The same weights in a float32 model, so saved models serve at full precision on any CPU."""
+    tf.keras.mixed_precision.set_global_policy("float32")
+    export = build_model(num_classes)
+    # Same trainable flags on both sides keeps get/set_weights order aligned.
+    set_trainable_blocks(model, 0)
+    export.set_weights(model.get_weights())
+    return export
+
+
+def training_callbacks(checkpoint, train_size, profile_dir=None):
+    callbacks = [
+        checkpoint,
+        tf.keras.callbacks.EarlyStopping(
+            monitor="val_accuracy",
+            patience=5,
+            restore_best_weights=True,
+            verbose=1,
+        ),
+        tf.keras.callbacks.ReduceLROnPlateau(
+            monitor="val_loss",
+            factor=0.5,
+            patience=3,
+            verbose=1,
+        ),
+        ThroughputCallback(train_size),
+    ]
+    if profile_dir is not None:
+        # Trace a few steps after warm-up; open with `tensorboard --logdir models/logs`
+        # and look at the Profile tab for the per-step input/compute breakdown.
+        callbacks.append(tf.keras.callbacks.TensorBoard(log_dir=str(profile_dir), profile_batch=PROFILE_BATCHES))
+    return callbacks
 
 
 def plot_history(history, out_path):
@@ -191,7 +417,35 @@ def evaluate_on_test(model, test_ds, class_names, out_cm_path):
 
 
 def main():
-    train_ds, val_ds, test_ds, class_names = load_datasets()
+    parser = argparse.ArgumentParser(description="Train the AgroVision classifier.")
+    parser.add_argument("--no-cache", action="store_true", help="Decode images every epoch instead of caching them.")
+    parser.add_argument("--shards", nargs="?", const=str(SHARDS_DIR), default=None, metavar="DIR",
+                        help=f"Train from prepare_data.py shards (default {SHARDS_DIR}).")
+    parser.add_argument("--benchmark-input", type=int, metavar="EPOCHS", default=0,
+                        help="Only time the input pipeline for this many epochs.")
+    parser.add_argument("--fine-tune-epochs", type=int, default=FINE_TUNE_EPOCHS,
+                        help="Epochs of the second phase with the top backbone blocks unfrozen (0 skips it).")
+    parser.add_argument("--fine-tune-blocks", type=int, default=FINE_TUNE_BLOCKS)
+    parser.add_argument("--mixed-precision", action="store_true",
+                        help="Train in mixed bfloat16 when the CPU supports it natively.")
+    parser.add_argument("--xla", action="store_true", help="JIT-compile the training step with XLA.")
+    parser.add_argument("--profile", action="store_true",
+                        help=f"Record a TensorBoard profile of batches {PROFILE_BATCHES} in each phase.")
+    args = parser.parse_args()
+    if args.benchmark_input:
+        benchmark_input(args.benchmark_input, args.shards)
+        return
+
+    mixed_precision = False
+    if args.mixed_precision:
+        if cpu_supports_bf16() or tf.config.list_physical_devices("GPU"):
+            tf.keras.mixed_precision.set_global_policy("mixed_bfloat16")
+            mixed_precision = True
+            print("Training with mixed bfloat16 precision.")
+        else:
+            print("This CPU has no native bfloat16 support; training in float32.")
+
+    train_ds, val_ds, test_ds, class_names = load_datasets(cache=not args.no_cache, shards_dir=args.shards)
     num_classes = len(class_names)
 
     (OUTPUT_DIR / "class_names.json").write_text(
@@ -199,40 +453,58 @@ def main():
         encoding="utf-8",
     )
 
-    class_weight = compute_weights()
-    model = build_model(num_classes)
+    if args.shards:
+        train_labels = shard_labels(args.shards, load_shard_manifest(args.shards), "train")
+    else:
+        _, train_labels, _ = list_split(TRAIN_DIR, class_names)
+    class_weight = balanced_weights(train_labels, num_classes)
+    model = build_model(num_classes, jit_compile=args.xla)
 
     checkpoint_path = OUTPUT_DIR / "agrovision_best.keras"
+    # One checkpoint callback for both phases so "best" spans the whole run.
+    checkpoint = tf.keras.callbacks.ModelCheckpoint(
+        filepath=str(checkpoint_path),
+        monitor="val_accuracy",
+        save_best_only=True,
+        verbose=1,
+    )
+    log_dir = OUTPUT_DIR / "logs" if args.profile else None
 
-    callbacks = [
-        tf.keras.callbacks.ModelCheckpoint(
-            filepath=str(checkpoint_path),
-            monitor="val_accuracy",
-            save_best_only=True,
-            verbose=1,
-        ),
-        tf.keras.callbacks.EarlyStopping(
-            monitor="val_accuracy",
-            patience=5,
-            restore_best_weights=True,
-            verbose=1,
-        ),
-        tf.keras.callbacks.ReduceLROnPlateau(
-            monitor="val_loss",
-            factor=0.5,
-            patience=3,
-            verbose=1,
-        ),
-    ]
-
+    print("\nPhase 1: training the classifier head on the frozen backbone")
     history = model.fit(
         train_ds,
         validation_data=val_ds,
         epochs=EPOCHS,
         class_weight=class_weight,
-        callbacks=callbacks,
+        callbacks=training_callbacks(checkpoint, len(train_labels), log_dir and log_dir / "head"),
     )
 
+    if args.fine_tune_epochs > 0 and args.fine_tune_blocks > 0:
+        head_best = max(history.history["val_accuracy"])
+        head_weights = model.get_weights()
+        unfrozen = set_trainable_blocks(model, args.fine_tune_blocks)
+        compile_model(model, FINE_TUNE_LEARNING_RATE, args.xla)
+        print(f"\nPhase 2: fine-tuning the top {args.fine_tune_blocks} backbone blocks ({unfrozen} layers)")
+        fine_tune = model.fit(
+            train_ds,
+            validation_data=val_ds,
+            initial_epoch=len(history.epoch),
+            epochs=len(history.epoch) + args.fine_tune_epochs,
+            class_weight=class_weight,
+            callbacks=training_callbacks(checkpoint, len(train_labels), log_dir and log_dir / "fine_tune"),
+        )
+        for key, values in fine_tune.history.items():
+            history.history.setdefault(key, []).extend(values)
+        if max(fine_tune.history["val_accuracy"]) < head_best:
+            print("Fine-tuning did not beat the head-only model; keeping the phase 1 weights.")
+            set_trainable_blocks(model, 0)
+            model.set_weights(head_weights)
+
+    if mixed_precision:
+        model = float32_copy(model, num_classes)
+        # The checkpoint was written with the mixed policy; serving wants float32.
+        model.save(checkpoint_path)
+
     hist_path = OUTPUT_DIR / "training_curves.png"
     plot_history(history, hist_path)
 